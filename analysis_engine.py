@@ -0,0 +1,482 @@
+import numpy as np
+import pandas as pd
+
+from assays import get_assay
+from running_stats import RunningStats
+
+
+class AnalysisResult:
+    """
+    Output of a single AnalysisEngine pass.
+
+    Attributes:
+    - frame (pd.DataFrame): The analysis DataFrame, laid out like the one built by the AnalysisUtilities chain.
+    - stats (dict): Per-channel statistics (slope, mean, sd, cutoff, corrected mean and sd).
+    - hit_masks (dict): Per-channel boolean arrays marking the rows that are hits.
+    - drift_groups (list): The group labels of a per-group drift fit, in the order of the per-group statistics; None for a single fit.
+    - aggregates (dict): Per-channel RunningStats of the values the z-scores are taken against, to merge into campaign statistics.
+    """
+
+    def __init__(self, frame, stats, hit_masks, drift_groups=None, aggregates=None):
+        self.frame = frame
+        self.stats = stats
+        self.hit_masks = hit_masks
+        self.drift_groups = drift_groups
+        self.aggregates = aggregates or {}
+
+
+class AnalysisEngine:
+    """
+    Single-pass replacement for the step-by-step AnalysisUtilities chain.
+
+    The ratio channels of an assay are stacked into one N x C float matrix (wells x channels)
+    and the drift correction, cutoff and z-score steps run on every channel at once with
+    NumPy broadcasting; the output DataFrame is assembled once at the end.
+    """
+
+    # Default outlier cutoff (mean + CUTOFF_MULTIPLIER * sd) and z-score below which a well is a hit
+    CUTOFF_MULTIPLIER = 1.5
+    HIT_THRESHOLD = -5
+
+    # Rounds of outlier clipping; 1 is the single mean + CUTOFF_MULTIPLIER * sd cutoff of the original analysis
+    CLIP_ITERATIONS = 1
+    MAX_CLIP_ITERATIONS = 100
+
+    # Drift correction fitted across the whole workbook, or separately for every sheet
+    DRIFT_GLOBAL = 'global'
+    DRIFT_SHEET = 'sheet'
+    DRIFT_MODES = (DRIFT_GLOBAL, DRIFT_SHEET)
+
+    # Column recording the sheet of every row when a plate is read for per-sheet drift correction
+    SHEET_COLUMN = 'sheet'
+
+    # z-scores taken against the plate alone, or against every plate of a campaign so far
+    NORMALISE_PLATE = 'plate'
+    NORMALISE_CAMPAIGN = 'campaign'
+    NORMALISATIONS = (NORMALISE_PLATE, NORMALISE_CAMPAIGN)
+
+    # Memory budget per well of the KCP1 assay, from DataFrame.memory_usage(deep=True) on 1536 x 10 plates:
+    # - the plate as read_plate returns it takes about 47 bytes: 9 float32 counts and measurements (36),
+    #   the categorical well name (2 bytes of code, ~8 bytes of names shared by the plates) and sheet (1)
+    # - the analysed plate takes about 150 bytes: the plate's columns, shared rather than copied (46),
+    #   the int64 relative well number (8) and 12 float64 derived columns (96)
+
+    @staticmethod
+    def nan_mean_sd(values):
+        """
+        Calculate the mean and sample standard deviation of an array, ignoring NaN values.
+
+        Mirrors pandas' Series.mean() and Series.std() (ddof=1), returning NaN when there
+        are not enough values instead of warning. A 2D array is reduced column by column.
+
+        Parameters:
+        - values (np.ndarray): The values, 1D or N x C.
+
+        Returns:
+        - tuple: The mean and the standard deviation (arrays of C values for a 2D input).
+        """
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(valid, values, 0.0).sum(axis=0) / count
+            deviation = np.where(valid, values - mean, 0.0)
+            sd = np.sqrt((deviation * deviation).sum(axis=0) / (count - 1))
+
+        # Not enough values: NaN instead of inf or a negative count
+        mean = np.where(count > 0, mean, np.nan)
+        sd = np.where(count > 1, sd, np.nan)
+
+        if np.ndim(values) == 1:
+            return mean.item(), sd.item()
+
+        return mean, sd
+
+    @staticmethod
+    def least_squares_slope(x, y):
+        """
+        Calculate the slope of the ordinary least-squares fit of y against x.
+
+        Equivalent to the slope returned by scipy.stats.linregress. An N x C y is fitted
+        column by column in one matrix product.
+
+        Parameters:
+        - x (np.ndarray): The N independent values.
+        - y (np.ndarray): The dependent values, N or N x C.
+
+        Returns:
+        - float or np.ndarray: The slope of the linear regression (C slopes for a 2D y).
+        """
+        x_centered = x - x.mean()
+        sxx = (x_centered * x_centered).sum()
+
+        if sxx == 0:
+            return np.nan if np.ndim(y) == 1 else np.full(y.shape[1], np.nan)
+
+        return x_centered @ (y - y.mean(axis=0)) / sxx
+
+    @staticmethod
+    def get_group_codes(labels):
+        """
+        Number the groups of a label array in order of first appearance.
+
+        Parameters:
+        - labels (array-like): The group label of every row; missing labels form a group of their own.
+
+        Returns:
+        - tuple: The integer group code of every row and the list of group labels.
+        """
+        codes, uniques = pd.factorize(np.asarray(labels, dtype=object))
+        groups = list(uniques)
+
+        if (codes < 0).any():
+            codes = np.where(codes < 0, len(groups), codes)
+            groups.append(None)
+
+        return codes, groups
+
+    @staticmethod
+    def grouped_relative_well_number(codes, group_count):
+        """
+        Number the rows 1..n within each group, keeping their order.
+
+        Parameters:
+        - codes (np.ndarray): The group code of every row.
+        - group_count (int): The number of groups.
+
+        Returns:
+        - np.ndarray: The relative well number of every row within its group.
+        """
+        counts = np.bincount(codes, minlength=group_count)
+        starts = np.cumsum(counts) - counts
+
+        # Rows sorted by group, keeping their order within each group
+        order = np.argsort(codes, kind='stable')
+
+        relative_well_number = np.empty(len(codes), dtype=np.int64)
+        relative_well_number[order] = np.arange(len(codes)) - np.repeat(starts, counts) + 1
+
+        return relative_well_number
+
+    @staticmethod
+    def grouped_least_squares(x, y, codes, group_count):
+        """
+        Fit y against x separately for every group with segmented closed-form sums.
+
+        Every sum is a single np.bincount over the rows, so the cost does not depend on the
+        number of groups. A group containing a NaN gets a NaN fit, like least_squares_slope.
+
+        Parameters:
+        - x (np.ndarray): The N independent values.
+        - y (np.ndarray): N x C matrix of dependent values.
+        - codes (np.ndarray): The group code (0..group_count - 1) of every row.
+        - group_count (int): The number of groups.
+
+        Returns:
+        - tuple: The group_count x C slopes and intercepts.
+        """
+        channel_count = y.shape[1]
+
+        # Flat (group, channel) bins, so one bincount sums every channel of every group
+        bins = (codes[:, np.newaxis] * channel_count + np.arange(channel_count)).ravel()
+
+        def sum_by_group(values):
+            return np.bincount(bins, weights=values.ravel(), minlength=group_count * channel_count).reshape(group_count, channel_count)
+
+        counts = np.bincount(codes, minlength=group_count).astype(np.float64)
+        x_means = np.bincount(codes, weights=x, minlength=group_count) / counts
+        y_means = sum_by_group(y) / counts[:, np.newaxis]
+
+        # Centred sums of squares and products within each group
+        x_centered = x - x_means[codes]
+        sxx = np.bincount(codes, weights=x_centered * x_centered, minlength=group_count)
+        sxy = sum_by_group(x_centered[:, np.newaxis] * (y - y_means[codes]))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            slopes = np.where(sxx[:, np.newaxis] > 0, sxy / sxx[:, np.newaxis], np.nan)
+
+        intercepts = y_means - slopes * x_means[:, np.newaxis]
+
+        return slopes, intercepts
+
+    @staticmethod
+    def sigma_clip_cutoffs(values, means, cutoffs, cutoff_multipliers, clip_iterations):
+        """
+        Iterate the upper outlier cutoff: every round the cutoff becomes mean + cutoff_multiplier * sd
+        of the values at or below the previous cutoff, until the kept values stop changing.
+
+        Every channel is sorted once. A round then only needs a binary search for the number of
+        kept values and a lookup in the prefix sums of the values and of their squares, so extra
+        rounds cost O(log N) each instead of a pass over the column.
+
+        Parameters:
+        - values (np.ndarray): N x C matrix of the values to clip.
+        - means (np.ndarray): Per channel, the mean of all values; the sums are taken around it to keep their precision.
+        - cutoffs (np.ndarray): Per channel, the cutoff of the first round.
+        - cutoff_multipliers (np.ndarray): Per channel, the number of standard deviations above the mean.
+        - clip_iterations (int): The maximum number of rounds, including the first.
+
+        Returns:
+        - tuple: Per channel, the final cutoffs and the number of rounds run.
+        """
+        cutoffs = np.array(cutoffs, dtype=np.float64)
+        rounds = np.ones(len(cutoffs), dtype=np.int64)
+
+        # NaN values sort last, so the first count rows of every column are its sorted values
+        counts = (~np.isnan(values)).sum(axis=0)
+        centered = np.sort(values, axis=0) - means
+        prefix_sums = np.cumsum(centered, axis=0)
+        prefix_squares = np.cumsum(centered * centered, axis=0)
+
+        for index in range(values.shape[1]):
+            column = centered[:counts[index], index]
+            if np.isnan(cutoffs[index]):
+                continue
+
+            kept = np.searchsorted(column, cutoffs[index] - means[index], side='right')
+
+            while rounds[index] < clip_iterations and kept >= 2:
+                # Mean and sd of the kept values, from the prefix sums
+                kept_mean = prefix_sums[kept - 1, index] / kept
+                kept_variance = (prefix_squares[kept - 1, index] - kept * kept_mean * kept_mean) / (kept - 1)
+                cutoff = kept_mean + cutoff_multipliers[index] * np.sqrt(max(kept_variance, 0.0))
+
+                cutoffs[index] = means[index] + cutoff
+                rounds[index] += 1
+
+                new_kept = np.searchsorted(column, cutoff, side='right')
+                if new_kept == kept:
+                    break
+                kept = new_kept
+
+        return cutoffs, rounds
+
+    @staticmethod
+    def analyse_channels(ratios, relative_well_number, cutoff_multipliers, drift_codes=None, group_count=1, clip_iterations=1):
+        """
+        Run the drift correction, cutoff and z-score steps for every ratio channel at once.
+
+        Parameters:
+        - ratios (np.ndarray): N x C matrix of the numerator/denominator ratios.
+        - relative_well_number (np.ndarray): The N relative well numbers.
+        - cutoff_multipliers (np.ndarray): Per channel, values above mean + cutoff_multiplier * sd are censored.
+        - drift_codes (np.ndarray): Group code of every row to fit the drift per group, None for a single fit.
+        - group_count (int): The number of drift groups.
+        - clip_iterations (int): Maximum rounds of outlier clipping, 1 for a single cutoff.
+
+        Returns:
+        - tuple: The N x C derived matrices (slope corrected values, values below the cutoff, z-scores) and the per-channel
+          statistics arrays; the slopes and intercepts are group_count x C for a per-group fit.
+        """
+        # Remove the drift along the plate, or along every group
+        if drift_codes is None:
+            slopes = AnalysisEngine.least_squares_slope(relative_well_number, ratios)
+            intercepts = ratios.mean(axis=0) - slopes * relative_well_number.mean()
+            row_slopes = slopes
+        else:
+            slopes, intercepts = AnalysisEngine.grouped_least_squares(relative_well_number, ratios, drift_codes, group_count)
+            row_slopes = slopes[drift_codes]
+
+        slope_corrected = ratios - relative_well_number[:, np.newaxis] * row_slopes
+
+        # Censor everything above mean + cutoff_multiplier * sd
+        means, sds = AnalysisEngine.nan_mean_sd(slope_corrected)
+        cutoffs = means + cutoff_multipliers * sds
+        clip_rounds = np.ones(len(cutoffs), dtype=np.int64)
+
+        # Optionally keep clipping until the cutoff converges
+        if clip_iterations > 1:
+            cutoffs, clip_rounds = AnalysisEngine.sigma_clip_cutoffs(slope_corrected, means, cutoffs, cutoff_multipliers, clip_iterations)
+        with np.errstate(invalid='ignore'):
+            below_cutoff = np.where(slope_corrected > cutoffs, np.nan, slope_corrected)
+
+        # z-scores against the censored population
+        corrected_means, corrected_sds = AnalysisEngine.nan_mean_sd(below_cutoff)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z_scores = (below_cutoff - corrected_means) / corrected_sds
+
+        stats = {
+            'slope': slopes,
+            'intercept': intercepts,
+            'mean': means,
+            'sd': sds,
+            'cutoff': cutoffs,
+            'clip_rounds': clip_rounds,
+            'corrected_mean': corrected_means,
+            'corrected_sd': corrected_sds,
+        }
+
+        return slope_corrected, below_cutoff, z_scores, stats
+
+    @staticmethod
+    def hit_column(z_score, hit_mask):
+        """
+        Build a hits column: the z-score where the row is a hit and NaN elsewhere.
+
+        Parameters:
+        - z_score (np.ndarray): The z-scores.
+        - hit_mask (np.ndarray): Boolean array marking the hits.
+
+        Returns:
+        - np.ndarray: A float array matching the populate_hits_* columns.
+        """
+        return np.where(hit_mask, z_score, np.nan)
+
+    @staticmethod
+    def analyse(combined_df, renamed_column_names_list=None, new_column_names_list=None, cutoff_multiplier=None,
+                hit_threshold=None, assay=None, drift_groups=None, reference_stats=None, clip_iterations=None):
+        """
+        Calculate every derived column of the analysis DataFrame in one pass.
+
+        Produces the same frame as rewrite_column_names followed by the calculate_*/populate_*
+        chain in AnalysisUtilities, without re-indexing the DataFrame at every step.
+
+        Parameters:
+        - combined_df (pd.DataFrame): The DataFrame returned by prepare_analysis_df.
+        - renamed_column_names_list (list): The new names of the instrument columns, defaults to the assay's.
+        - new_column_names_list (list): The names of the derived columns, in output order, defaults to the assay's.
+        - cutoff_multiplier (float): Outlier cutoff in standard deviations for every channel, defaults to the
+          channel's own or CUTOFF_MULTIPLIER.
+        - hit_threshold (float): z-score below which a well is a hit for every channel, defaults to the
+          channel's own or HIT_THRESHOLD.
+        - assay (AssaySpec): The channels to analyse, defaults to the DEFAULT_ASSAY of the registry.
+        - drift_groups (str or array-like): Fit the drift separately per group, given as a column name (e.g. SHEET_COLUMN)
+          or a label per row; the relative well numbers then restart in every group. None fits the whole frame at once.
+        - reference_stats (dict): Channel name -> RunningStats of earlier plates of a campaign. The z-scores of those
+          channels are taken against the campaign including this plate instead of against this plate alone.
+        - clip_iterations (int): Maximum rounds of outlier clipping, defaults to CLIP_ITERATIONS (a single cutoff).
+
+        Returns:
+        - AnalysisResult: The analysis DataFrame together with the channel statistics and hit masks.
+        """
+        if assay is None:
+            assay = get_assay()
+        if renamed_column_names_list is None:
+            renamed_column_names_list = assay.renamed_columns
+        if new_column_names_list is None:
+            new_column_names_list = assay.get_output_columns()
+        if clip_iterations is None:
+            clip_iterations = AnalysisEngine.CLIP_ITERATIONS
+
+        def get_setting(override, channel_value, default):
+            if override is not None:
+                return override
+            return channel_value if channel_value is not None else default
+
+        # Rename the instrument columns by position
+        old_column_name_list = combined_df.columns.tolist()
+        renamed = dict(zip(old_column_name_list, renamed_column_names_list))
+        # The arrays are shared with combined_df, categorical columns stay categorical
+        columns = {renamed.get(name, name): combined_df[name].array for name in old_column_name_list}
+
+        def read_measurements(names):
+            # Read the measurement columns once into a contiguous N x C float matrix
+            return np.column_stack([np.asarray(columns[name], dtype=np.float64) for name in names])
+
+        row_count = len(combined_df)
+        channels = assay.channels
+
+        # Number the wells along the whole frame, or within every drift group
+        drift_codes = None
+        group_labels = None
+        group_count = 1
+        if drift_groups is None:
+            relative_well_number = np.arange(1, row_count + 1)
+        else:
+            labels = columns[drift_groups] if isinstance(drift_groups, str) else drift_groups
+            drift_codes, group_labels = AnalysisEngine.get_group_codes(labels)
+            group_count = len(group_labels)
+            relative_well_number = AnalysisEngine.grouped_relative_well_number(drift_codes, group_count)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ratios = (read_measurements([channel.numerator for channel in channels])
+                      / read_measurements([channel.denominator for channel in channels]))
+
+        cutoff_multipliers = np.array([get_setting(cutoff_multiplier, channel.cutoff_multiplier, AnalysisEngine.CUTOFF_MULTIPLIER)
+                                       for channel in channels], dtype=np.float64)
+        hit_thresholds = np.array([get_setting(hit_threshold, channel.hit_threshold, AnalysisEngine.HIT_THRESHOLD)
+                                   for channel in channels], dtype=np.float64)
+
+        slope_corrected, below_cutoff, z_scores, channel_stats = AnalysisEngine.analyse_channels(ratios, relative_well_number, cutoff_multipliers,
+                                                                                                 drift_codes, group_count, clip_iterations)
+
+        kept = ~np.isnan(below_cutoff)
+        has_values = kept.any(axis=0)
+
+        # This plate's share of the campaign statistics, rebuilt from the censored mean and sd
+        kept_counts = kept.sum(axis=0)
+        aggregates = {
+            channel.name: RunningStats.from_mean_sd(kept_counts[index], channel_stats['corrected_mean'][index], channel_stats['corrected_sd'][index])
+            for index, channel in enumerate(channels)
+        }
+        reference_stats = reference_stats or {}
+        normalisation = {}
+
+        # Campaign normalised channels: z-scores against the merged aggregate, O(plate size)
+        if any(channel.name in reference_stats for channel in channels):
+            means = channel_stats['corrected_mean'].copy()
+            sds = channel_stats['corrected_sd'].copy()
+            for index, channel in enumerate(channels):
+                if channel.name in reference_stats:
+                    normalisation[channel.name] = reference_stats[channel.name].merge(aggregates[channel.name])
+                    means[index] = normalisation[channel.name].get_mean()
+                    sds[index] = normalisation[channel.name].get_sd()
+            with np.errstate(invalid='ignore', divide='ignore'):
+                z_scores = (below_cutoff - means) / sds
+
+        # z-score columns stay empty (NaN) when no value survived the cutoff, as in populate_*_z_score
+        empty = np.full(row_count, np.nan)
+        with np.errstate(invalid='ignore'):
+            channel_hits = has_values & kept & (z_scores < hit_thresholds)
+
+        derived = {'relative_well_number': relative_well_number}
+        hit_masks = {}
+        stats = {}
+
+        for index, channel in enumerate(channels):
+            derived[channel.ratio_column] = ratios[:, index]
+            derived[channel.corrected_column] = slope_corrected[:, index]
+            derived[channel.below_cutoff_column] = below_cutoff[:, index]
+            derived[channel.z_score_column] = z_scores[:, index]
+            derived[channel.hits_column] = AnalysisEngine.hit_column(z_scores[:, index], channel_hits[:, index])
+            hit_masks[channel.name] = channel_hits[:, index]
+            # Per-group slopes and intercepts become lists, one value per group
+            stats[channel.name] = {name: values[..., index].tolist() for name, values in channel_stats.items()}
+            if channel.name in normalisation:
+                stats[channel.name]['campaign'] = normalisation[channel.name].to_dict()
+
+        # Viability channels are taken against the full population, reported when their gate channel kept any value
+        channel_indices = {channel.name: index for index, channel in enumerate(channels)}
+
+        for viability in assay.viability:
+            values = np.asarray(columns[viability.column], dtype=np.float64)
+            mean, sd = AnalysisEngine.nan_mean_sd(values)
+            aggregates[viability.name] = RunningStats.from_mean_sd(int((~np.isnan(values)).sum()), mean, sd)
+
+            z_mean, z_sd = mean, sd
+            if viability.name in reference_stats:
+                normalisation[viability.name] = reference_stats[viability.name].merge(aggregates[viability.name])
+                z_mean, z_sd = normalisation[viability.name].get_mean(), normalisation[viability.name].get_sd()
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                z_score = (values - z_mean) / z_sd
+
+            gated = viability.gate_channel is None or bool(has_values[channel_indices[viability.gate_channel]])
+            threshold = get_setting(hit_threshold, viability.hit_threshold, AnalysisEngine.HIT_THRESHOLD)
+            with np.errstate(invalid='ignore'):
+                hit_mask = gated & (z_score < threshold)
+
+            derived[viability.z_score_column] = z_score if gated else empty
+            derived[viability.hits_column] = AnalysisEngine.hit_column(z_score, hit_mask)
+            hit_masks[viability.name] = hit_mask
+            stats[viability.name] = {'mean': mean, 'sd': sd}
+            if viability.name in normalisation:
+                stats[viability.name]['campaign'] = normalisation[viability.name].to_dict()
+
+        for name in new_column_names_list:
+            columns[name] = derived[name]
+
+        # Build the output frame once, around the arrays above rather than a consolidated copy of them
+        analysis_df = pd.DataFrame(columns, index=combined_df.index, copy=False)
+
+        return AnalysisResult(analysis_df, stats, hit_masks, group_labels, aggregates)
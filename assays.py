@@ -0,0 +1,147 @@
+class ChannelSpec:
+    """
+    A ratio channel: numerator / denominator, drift corrected, censored and z-scored.
+
+    Attributes:
+    - name (str): Short channel name, used for the '<name>_z_score' and 'hits_<name>_z_score' columns.
+    - numerator (str): The renamed instrument column in the numerator of the ratio.
+    - denominator (str): The renamed instrument column in the denominator of the ratio.
+    - ratio_column (str): Output column of the raw ratio.
+    - corrected_column (str): Output column of the drift corrected ratio.
+    - below_cutoff_column (str): Output column of the corrected ratio with the outliers removed.
+    - cutoff_multiplier (float): Outlier cutoff in standard deviations, None for the engine default.
+    - hit_threshold (float): z-score below which a well is a hit, None for the engine default.
+    """
+
+    def __init__(self, name, numerator, denominator, ratio_column=None, corrected_column=None, below_cutoff_column=None,
+                 cutoff_multiplier=None, hit_threshold=None):
+        self.name = name
+        self.numerator = numerator
+        self.denominator = denominator
+        self.ratio_column = ratio_column or f"{name}_{numerator}_{denominator}"
+        self.corrected_column = corrected_column or f"slope_corrected_{self.ratio_column}"
+        self.below_cutoff_column = below_cutoff_column or f"cutoff_{self.ratio_column}_below_cuttoff"
+        self.cutoff_multiplier = cutoff_multiplier
+        self.hit_threshold = hit_threshold
+
+    @property
+    def z_score_column(self):
+        return f"{self.name}_z_score"
+
+    @property
+    def hits_column(self):
+        return f"hits_{self.name}_z_score"
+
+
+class ViabilitySpec:
+    """
+    A percentage column z-scored against the whole plate, without drift correction or cutoff.
+
+    Attributes:
+    - name (str): Short channel name, used for the '<name>_z_score' and 'hits_<name>_z_score' columns.
+    - column (str): The renamed instrument column.
+    - gate_channel (str): The z-scores are only reported when this ratio channel kept any value after its cutoff.
+    - hit_threshold (float): z-score below which a well is a hit, None for the engine default.
+    """
+
+    def __init__(self, name, column, gate_channel=None, hit_threshold=None):
+        self.name = name
+        self.column = column
+        self.gate_channel = gate_channel
+        self.hit_threshold = hit_threshold
+
+    @property
+    def z_score_column(self):
+        return f"{self.name}_z_score"
+
+    @property
+    def hits_column(self):
+        return f"hits_{self.name}_z_score"
+
+
+class AssaySpec:
+    """
+    Declarative description of an assay: where its wells are read from and which channels are analysed.
+
+    Attributes:
+    - name (str): The assay name, as selected on the upload form (case-insensitive).
+    - file_keyword (str): Keyword every workbook of this assay has in its file name.
+    - sheet_names (list): The sheets holding the wells, read in order.
+    - renamed_columns (list): Names given to the instrument columns, by position.
+    - channels (list): The ChannelSpec of every ratio channel.
+    - viability (list): The ViabilitySpec of every percentage channel.
+    """
+
+    def __init__(self, name, file_keyword, sheet_names, renamed_columns, channels, viability=()):
+        self.name = name
+        self.file_keyword = file_keyword
+        self.sheet_names = list(sheet_names)
+        self.renamed_columns = list(renamed_columns)
+        self.channels = list(channels)
+        self.viability = list(viability)
+
+    def get_output_columns(self):
+        """
+        List the derived columns in output order: ratios, well number, corrected ratios,
+        censored ratios, z-scores and hits.
+
+        Returns:
+        - list: The derived column names.
+        """
+        every_channel = self.channels + self.viability
+
+        return ([channel.ratio_column for channel in self.channels]
+                + ["relative_well_number"]
+                + [channel.corrected_column for channel in self.channels]
+                + [channel.below_cutoff_column for channel in self.channels]
+                + [channel.z_score_column for channel in every_channel]
+                + [channel.hits_column for channel in every_channel])
+
+    def get_hit_columns(self):
+        return [channel.hits_column for channel in self.channels + self.viability]
+
+    def get_channel_names(self):
+        # Every channel with a z-score, ratio channels first, as recorded in the results store
+        return [channel.name for channel in self.channels + self.viability]
+
+
+# Flow cytometry read-out of the KCP1 pHL/YEMK plates
+PHL_YEMK_COLUMNS = ["well_number", "total_count", "phl_count", "yemk_count", "live_percentage", "dead_percentage",
+                    "phl_vl2", "phl_bl1", "yemk_vl2", "yemk_bl1"]
+
+PHL_YEMK_CHANNELS = [
+    ChannelSpec('phl', 'phl_vl2', 'phl_bl1', ratio_column="pHL_VL2_BL1",
+                corrected_column="slope_corrected_phl_vl2_bl1", below_cutoff_column="cutoff_PHL_VL2_BL1_below_cuttoff"),
+    ChannelSpec('yemk', 'yemk_vl2', 'yemk_bl1', ratio_column="yemk_vl2_bl1",
+                corrected_column="slope_corrected_yemk_vl2_bl1", below_cutoff_column="cutoff_yemk_vl2_bl1_below_cuttoff"),
+]
+
+PHL_YEMK_VIABILITY = [ViabilitySpec('live', 'live_percentage', gate_channel='yemk')]
+
+DEFAULT_ASSAY = 'pl1'
+
+ASSAYS = {
+    'pl1': AssaySpec('pl1', "KCP1", ["Samples", "High Controls"], PHL_YEMK_COLUMNS, PHL_YEMK_CHANNELS, PHL_YEMK_VIABILITY),
+    # XXXX plates are read out on the same panel as PL1
+    'xxxx': AssaySpec('xxxx', "XXXX", ["Samples", "High Controls"], PHL_YEMK_COLUMNS, PHL_YEMK_CHANNELS, PHL_YEMK_VIABILITY),
+}
+
+
+def get_assay(name=None):
+    """
+    Look up an assay by name, ignoring case.
+
+    Parameters:
+    - name (str): The assay name, defaults to DEFAULT_ASSAY.
+
+    Returns:
+    - AssaySpec: The assay.
+
+    Raises:
+    - KeyError: When no assay has that name.
+    """
+    key = (name or DEFAULT_ASSAY).strip().lower()
+    if key not in ASSAYS:
+        raise KeyError(f"Unknown assay: {name!r}")
+
+    return ASSAYS[key]
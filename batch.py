@@ -0,0 +1,224 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from analysis_engine import AnalysisEngine
+from assays import DEFAULT_ASSAY, get_assay
+from excel_writer import StreamingExcelWriter
+from utilities import AnalysisUtilities
+
+
+class BatchAnalysis:
+    """
+    Analyse many workbooks in parallel and merge them into one campaign workbook.
+
+    Every workbook is analysed in its own worker process; a failing workbook is
+    reported in the "Errors" sheet instead of stopping the batch. The campaign workbook
+    has one "All_P_YEMK_pHL_Live" and one "All_hits" sheet covering every workbook,
+    each row tagged with its source file, written once at the end.
+    """
+
+    @staticmethod
+    def find_workbooks(paths):
+        """
+        Expand directories into the workbooks they contain.
+
+        Parameters:
+        - paths (list): Workbook paths and/or directories.
+
+        Returns:
+        - list: The workbook paths, sorted within each directory.
+        """
+        workbooks = []
+
+        for path in paths:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    # Skip Excel's "~$" lock files
+                    if name.endswith('.xlsx') and not name.startswith('~$'):
+                        workbooks.append(os.path.join(path, name))
+            else:
+                workbooks.append(path)
+
+        return workbooks
+
+    @staticmethod
+    def analyse_workbook(file_path, assay_name=None, cutoff_multiplier=None, hit_threshold=None, drift_mode=None, clip_iterations=None):
+        """
+        Analyse one workbook; runs inside a worker process.
+
+        Parameters:
+        - file_path (str): The path to the workbook.
+        - assay_name (str): The assay of the workbook, defaults to the registry's default assay.
+        - cutoff_multiplier (float): Outlier cutoff in standard deviations.
+        - hit_threshold (float): z-score below which a well is a hit.
+        - drift_mode (str): AnalysisEngine.DRIFT_SHEET to fit the drift per sheet, otherwise across the workbook.
+        - clip_iterations (int): Maximum rounds of outlier clipping.
+
+        Returns:
+        - dict: The plate z-scores, the hit rows and masks and the time taken, or the error raised.
+        """
+        started = time.perf_counter()
+
+        try:
+            assay = get_assay(assay_name)
+            sheet_column = AnalysisEngine.SHEET_COLUMN if drift_mode == AnalysisEngine.DRIFT_SHEET else None
+            plate_df = AnalysisUtilities.read_plate(file_path, assay.sheet_names[0], assay.sheet_names[1], assay.renamed_columns, sheet_column)
+            result = AnalysisEngine.analyse(plate_df, cutoff_multiplier=cutoff_multiplier, hit_threshold=hit_threshold, assay=assay,
+                                            drift_groups=sheet_column, clip_iterations=clip_iterations)
+        except Exception as e:
+            return {'file_path': file_path, 'error': f"{type(e).__name__}: {e}", 'seconds': time.perf_counter() - started}
+
+        # Only the slices that go into the campaign workbook are sent back to the parent process
+        analysis_df = result.frame
+        every_channel = assay.channels + assay.viability
+        plates_df = analysis_df[['well_number'] + [channel.z_score_column for channel in every_channel]]
+        hit_rows = np.logical_or.reduce([result.hit_masks[channel.name] for channel in every_channel])
+        hits_df = analysis_df.loc[hit_rows, ['well_number'] + assay.get_hit_columns()]
+
+        return {
+            'file_path': file_path,
+            'plates_df': plates_df,
+            'hits_df': hits_df,
+            'hit_masks': result.hit_masks,
+            'aggregates': result.aggregates,
+            'seconds': time.perf_counter() - started,
+        }
+
+    @staticmethod
+    def merge_results(results):
+        """
+        Stack the per-workbook results into campaign-wide sheets.
+
+        Parameters:
+        - results (list): analyse_workbook results, in input order.
+
+        Returns:
+        - list: (sheet_name, DataFrame) pairs for the campaign workbook.
+        """
+        succeeded = [result for result in results if 'error' not in result]
+        failed = [result for result in results if 'error' in result]
+
+        def stack(key):
+            frames = [result[key] for result in succeeded]
+            if not frames:
+                return pd.DataFrame(columns=['source_file', 'well_number'])
+            merged = pd.concat(frames, keys=[os.path.basename(result['file_path']) for result in succeeded],
+                               names=['source_file', None])
+            return merged.reset_index(level='source_file').reset_index(drop=True)
+
+        errors_df = pd.DataFrame({
+            'source_file': [result['file_path'] for result in failed],
+            'error': [result['error'] for result in failed],
+        })
+
+        return [
+            ("All_P_YEMK_pHL_Live", stack('plates_df')),
+            ("All_hits", stack('hits_df')),
+            ("Errors", errors_df),
+        ]
+
+    @staticmethod
+    def run(paths, output_path, workers=None, assay_name=None, cutoff_multiplier=None, hit_threshold=None, drift_mode=None,
+            clip_iterations=None, results_store=None, campaign=None):
+        """
+        Analyse every workbook across a process pool and write the campaign workbook.
+
+        Parameters:
+        - paths (list): Workbook paths and/or directories.
+        - output_path (str): Where to write the campaign workbook.
+        - workers (int): Number of worker processes, defaults to the number of CPUs.
+        - assay_name (str): The assay of the workbooks, defaults to the registry's default assay.
+        - cutoff_multiplier (float): Outlier cutoff in standard deviations.
+        - hit_threshold (float): z-score below which a well is a hit.
+        - drift_mode (str): AnalysisEngine.DRIFT_SHEET to fit the drift per sheet, otherwise across the workbook.
+        - clip_iterations (int): Maximum rounds of outlier clipping.
+        - results_store (ResultsStore): When given, every analysed workbook is also recorded as a run.
+        - campaign (str): When given with a results_store, every analysed workbook is added to this campaign's statistics.
+
+        Returns:
+        - list: The per-workbook results, in input order.
+        """
+        workbooks = BatchAnalysis.find_workbooks(paths)
+        results = [None] * len(workbooks)
+
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = {
+                executor.submit(BatchAnalysis.analyse_workbook, file_path, assay_name=assay_name,
+                                cutoff_multiplier=cutoff_multiplier, hit_threshold=hit_threshold, drift_mode=drift_mode,
+                                clip_iterations=clip_iterations): index
+                for index, file_path in enumerate(workbooks)
+            }
+
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    # The worker itself died, e.g. it ran out of memory
+                    results[index] = {'file_path': workbooks[index], 'error': f"{type(e).__name__}: {e}", 'seconds': 0.0}
+
+        if results_store is not None:
+            channels = get_assay(assay_name).get_channel_names()
+            for result in results:
+                if 'error' not in result:
+                    results_store.append_run(result['plates_df'], channels, source=AnalysisUtilities.getfile_name(result['file_path']),
+                                             hit_masks=result['hit_masks'])
+                    if campaign:
+                        results_store.add_campaign_stats(campaign, result['aggregates'])
+
+        StreamingExcelWriter.write_frames(output_path, BatchAnalysis.merge_results(results))
+
+        return results
+
+
+def add_arguments(parser):
+    parser.add_argument('paths', nargs='+', help="workbooks and/or directories of workbooks")
+    parser.add_argument('-o', '--output', default="campaign.xlsx", help="campaign workbook to write (default: campaign.xlsx)")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="worker processes (default: number of CPUs)")
+    parser.add_argument('--assay', default=None, help="assay of the workbooks, e.g. PL1 (default: %s)" % DEFAULT_ASSAY)
+    parser.add_argument('--cutoff-multiplier', type=float, default=None, help="outlier cutoff in SD (default: 1.5)")
+    parser.add_argument('--hit-threshold', type=float, default=None, help="z-score below which a well is a hit (default: -5)")
+    parser.add_argument('--drift-mode', choices=AnalysisEngine.DRIFT_MODES, default=AnalysisEngine.DRIFT_GLOBAL,
+                        help="fit the drift across the whole workbook or per sheet (default: global)")
+    parser.add_argument('--clip-iterations', type=int, default=None, help="maximum rounds of outlier clipping (default: 1)")
+    parser.add_argument('--results-db', default=None, help="also record every workbook as a run in this results store")
+    parser.add_argument('--campaign', default=None, help="add every workbook to this campaign's statistics (needs --results-db)")
+
+
+def run_from_args(args):
+    if args.campaign and not args.results_db:
+        raise ValueError("--campaign needs --results-db")
+
+    results_store = None
+    if args.results_db:
+        from results_store import ResultsStore
+        results_store = ResultsStore(args.results_db)
+
+    started = time.perf_counter()
+    results = BatchAnalysis.run(args.paths, args.output, workers=args.workers, assay_name=args.assay,
+                                cutoff_multiplier=args.cutoff_multiplier, hit_threshold=args.hit_threshold,
+                                drift_mode=args.drift_mode, clip_iterations=args.clip_iterations,
+                                results_store=results_store, campaign=args.campaign)
+
+    failed = [result for result in results if 'error' in result]
+    for result in failed:
+        print(f"FAILED {result['file_path']}: {result['error']}")
+    print(f"Analysed {len(results) - len(failed)}/{len(results)} workbooks in {time.perf_counter() - started:.1f}s -> {args.output}")
+
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyse many plate workbooks in parallel into one campaign workbook.")
+    add_arguments(parser)
+
+    return run_from_args(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,200 @@
+import argparse
+import os
+import string
+
+import numpy as np
+import pandas as pd
+
+from excel_writer import StreamingExcelWriter
+
+# Instrument columns of a KCP1 flow cytometry export, in order
+INSTRUMENT_COLUMNS = ["Well", "Total Count", "pHL Count", "YEMK Count", "Live %", "Dead %",
+                      "pHL VL2", "pHL BL1", "YEMK VL2", "YEMK BL1"]
+
+# Rows x columns of the supported plate formats
+PLATE_SHAPES = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+
+class PlateGenerator:
+    """
+    Synthetic "Samples" / "High Controls" workbooks shaped like the instrument exports.
+
+    Every plate keeps its last column as high controls and the rest as samples. Each plate
+    block of a sheet ends with a blank row and the "Mean" and "SD" summary rows the
+    instrument writes, and a small fraction of the sample wells is turned into hits.
+    """
+
+    @staticmethod
+    def get_row_labels(row_count):
+        # A..Z then AA, AB, ... as on 1536 well plates
+        letters = string.ascii_uppercase
+        return [letters[i] if i < 26 else letters[i // 26 - 1] + letters[i % 26] for i in range(row_count)]
+
+    @staticmethod
+    def get_well_names(wells):
+        """
+        Name the wells of a plate in row-major order, split into sample and control wells.
+
+        Parameters:
+        - wells (int): The plate format, one of PLATE_SHAPES.
+
+        Returns:
+        - tuple: (sample well names, control well names) as lists.
+        """
+        if wells not in PLATE_SHAPES:
+            raise ValueError(f"wells must be one of {sorted(PLATE_SHAPES)}, got {wells}")
+
+        row_count, column_count = PLATE_SHAPES[wells]
+        samples = []
+        controls = []
+        for row_label in PlateGenerator.get_row_labels(row_count):
+            for column in range(1, column_count + 1):
+                name = f"{row_label}{column:02d}"
+                if column == column_count:
+                    controls.append(name)
+                else:
+                    samples.append(name)
+
+        return samples, controls
+
+    @staticmethod
+    def generate_block(rng, well_names, hit_rate=0.0):
+        """
+        Generate the rows of one plate of one sheet, followed by a blank row and the Mean and SD rows.
+
+        Parameters:
+        - rng (np.random.Generator): The random generator.
+        - well_names (list): The names of the wells.
+        - hit_rate (float): Fraction of the wells given a hit in one of the channels.
+
+        Returns:
+        - pd.DataFrame: The rows, with the instrument column names.
+        """
+        count = len(well_names)
+
+        # Ratios around 0.5 and 0.33 with a slow drift along the plate
+        block = pd.DataFrame({
+            "Well": well_names,
+            "Total Count": rng.integers(1000, 5000, count),
+            "pHL Count": rng.integers(100, 900, count),
+            "YEMK Count": rng.integers(100, 900, count),
+            "Live %": rng.normal(80, 3, count),
+            "Dead %": rng.normal(20, 3, count),
+            "pHL VL2": rng.normal(500, 20, count) + np.arange(count) * 0.1,
+            "pHL BL1": rng.normal(1000, 30, count),
+            "YEMK VL2": rng.normal(300, 15, count),
+            "YEMK BL1": rng.normal(900, 30, count),
+        })
+
+        # Inject hits: a collapsed pHL or YEMK signal, or a dead well
+        hit_count = int(round(count * hit_rate))
+        if hit_count:
+            hit_rows = rng.choice(count, size=hit_count, replace=False)
+            hit_columns = np.array(["pHL VL2", "YEMK VL2", "Live %"])[rng.integers(0, 3, hit_count)]
+            for column in ("pHL VL2", "YEMK VL2", "Live %"):
+                rows = hit_rows[hit_columns == column]
+                block.loc[rows, column] = block.loc[rows, column] * 0.1
+
+        # A blank row, then the summary rows
+        values = block.iloc[:, 1:]
+        summary = pd.DataFrame([[np.nan] * values.shape[1], values.mean().tolist(), values.std().tolist()],
+                               columns=INSTRUMENT_COLUMNS[1:])
+        summary.insert(0, "Well", [None, "Mean", "SD"])
+
+        return pd.concat([block, summary], ignore_index=True)
+
+    @staticmethod
+    def generate_sheets(wells=384, plates=1, hit_rate=0.01, seed=0):
+        """
+        Generate the "Samples" and "High Controls" sheets of plates stacked in one workbook.
+
+        Parameters:
+        - wells (int): The plate format, one of PLATE_SHAPES.
+        - plates (int): The number of plates.
+        - hit_rate (float): Fraction of the sample wells given a hit.
+        - seed (int): Seed of the random generator.
+
+        Returns:
+        - list: (sheet_name, DataFrame) pairs.
+        """
+        if plates < 1:
+            raise ValueError(f"plates must be at least 1, got {plates}")
+
+        rng = np.random.default_rng(seed)
+        sample_wells, control_wells = PlateGenerator.get_well_names(wells)
+
+        samples = [PlateGenerator.generate_block(rng, sample_wells, hit_rate) for _ in range(plates)]
+        controls = [PlateGenerator.generate_block(rng, control_wells) for _ in range(plates)]
+
+        return [("Samples", pd.concat(samples, ignore_index=True)),
+                ("High Controls", pd.concat(controls, ignore_index=True))]
+
+    @staticmethod
+    def write_workbook(file_path, wells=384, plates=1, hit_rate=0.01, seed=0):
+        """
+        Write a synthetic workbook with every plate stacked in its "Samples" and "High Controls" sheets.
+
+        Parameters:
+        - file_path (str): The workbook to write.
+        - wells (int): The plate format, one of PLATE_SHAPES.
+        - plates (int): The number of plates.
+        - hit_rate (float): Fraction of the sample wells given a hit.
+        - seed (int): Seed of the random generator.
+
+        Returns:
+        - str: The path of the workbook.
+        """
+        StreamingExcelWriter.write_frames(file_path, PlateGenerator.generate_sheets(wells, plates, hit_rate, seed))
+
+        return file_path
+
+    @staticmethod
+    def write_workbooks(directory, wells=384, plates=1, hit_rate=0.01, seed=0):
+        """
+        Write one single-plate workbook per plate, named like the KCP1 uploads.
+
+        Parameters:
+        - directory (str): The directory to write to, created if missing.
+        - wells (int): The plate format, one of PLATE_SHAPES.
+        - plates (int): The number of workbooks.
+        - hit_rate (float): Fraction of the sample wells given a hit.
+        - seed (int): Seed of the first workbook, the next ones use the following seeds.
+
+        Returns:
+        - list: The paths of the workbooks.
+        """
+        os.makedirs(directory, exist_ok=True)
+
+        paths = []
+        for plate in range(plates):
+            file_path = os.path.join(directory, f"KCP1_synthetic_{wells}_{plate + 1:04d}.xlsx")
+            paths.append(PlateGenerator.write_workbook(file_path, wells, 1, hit_rate, seed + plate))
+
+        return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic Samples/High Controls workbooks.")
+    parser.add_argument('output', help="workbook to write, or a directory with --split")
+    parser.add_argument('-w', '--wells', type=int, choices=sorted(PLATE_SHAPES), default=384, help="plate format (default: 384)")
+    parser.add_argument('-p', '--plates', type=int, default=1, help="number of plates, 1 to 1000 (default: 1)")
+    parser.add_argument('--hit-rate', type=float, default=0.01, help="fraction of the sample wells made hits (default: 0.01)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument('--split', action='store_true', help="write one workbook per plate into the output directory")
+    args = parser.parse_args(argv)
+
+    if not 1 <= args.plates <= 1000:
+        parser.error("--plates must be between 1 and 1000")
+
+    if args.split:
+        paths = PlateGenerator.write_workbooks(args.output, args.wells, args.plates, args.hit_rate, args.seed)
+        print(f"Wrote {len(paths)} workbooks of {args.wells} wells to {args.output}")
+    else:
+        PlateGenerator.write_workbook(args.output, args.wells, args.plates, args.hit_rate, args.seed)
+        print(f"Wrote {args.plates} plates of {args.wells} wells to {args.output}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,369 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from analysis_engine import AnalysisEngine
+from assays import get_assay
+from benchmarks.generate_plates import PLATE_SHAPES, PlateGenerator
+from excel_writer import StreamingExcelWriter
+from results_store import ResultsStore
+from utilities import AnalysisUtilities
+
+# Timings are machine specific: save the baseline on the machine that runs the comparison
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+# Slower or bigger than the baseline by more than this fraction is a regression
+DEFAULT_TOLERANCE = 0.25
+
+# Differences below these are noise, whatever the ratio
+NOISE_SECONDS = 0.01
+NOISE_BYTES = 1 << 20
+
+
+class BenchmarkContext:
+    """
+    The inputs of the pipeline stages of one scenario, built once before timing.
+
+    Attributes:
+    - workbook_path (str): The synthetic workbook.
+    - output_dir (str): Where the exports and results stores are written.
+    - assay (AssaySpec): The assay of the synthetic workbooks.
+    - combined_df (pd.DataFrame): The workbook rows as read, before renaming.
+    - plate_df (pd.DataFrame): The plate as read by the web app, with its sheet column.
+    - analysis_df (pd.DataFrame): The analysed plate, as exported and recorded.
+    - results_store (ResultsStore): The store runs are appended to.
+    - history_store (ResultsStore): A store holding the scenario's plate once, the history workbooks are rendered from it.
+    """
+
+    def __init__(self, workbook_path, output_dir):
+        self.workbook_path = workbook_path
+        self.output_dir = output_dir
+        self.assay = get_assay()
+
+        remove_columns_names = AnalysisUtilities.remove_columns_names_list()
+        self.combined_df = AnalysisUtilities.prepare_analysis_df(workbook_path, "Samples", "High Controls", remove_columns_names)
+        self.plate_df = AnalysisUtilities.read_plate(workbook_path, "Samples", "High Controls", self.assay.renamed_columns,
+                                                     AnalysisEngine.SHEET_COLUMN)
+        self.analysis_df = AnalysisEngine.analyse(self.get_engine_df(), assay=self.assay).frame
+
+        self.results_store = ResultsStore(os.path.join(output_dir, "results.sqlite3"))
+        self.history_store = ResultsStore(os.path.join(output_dir, "history.sqlite3"))
+        if self.history_store.select_runs().empty:
+            self.history_store.append_run(self.analysis_df, self.assay.get_channel_names())
+
+    def get_engine_df(self):
+        # The web app drops the sheet column without copying the plate unless the drift is fitted per sheet
+        plate_df = self.plate_df.copy(deep=False)
+        plate_df.pop(AnalysisEngine.SHEET_COLUMN)
+
+        return plate_df
+
+    def get_output_path(self, file_name):
+        # The exports append a sheet to an existing workbook, every run starts from no file
+        file_path = os.path.join(self.output_dir, file_name)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+        return file_path
+
+
+def run_statistics_chain(analysis_df):
+    """
+    Run the step by step AnalysisUtilities statistics, in the order the web app originally called them.
+
+    Parameters:
+    - analysis_df (pd.DataFrame): The renamed plate with the derived columns added.
+
+    Returns:
+    - pd.DataFrame: The analysed plate.
+    """
+    analysis_df = AnalysisUtilities.calculate_pHL_VL2_BL1(analysis_df)
+    analysis_df = AnalysisUtilities.calculate_yemk_vl2_bl1(analysis_df)
+    analysis_df = AnalysisUtilities.calculate_relative_well_number(analysis_df)
+
+    slope_phl = AnalysisUtilities.calculate_slope_phl_vl2_phl_bl1(analysis_df)
+    slope_yemk = AnalysisUtilities.calculate_slope_yemk_vl2_bl1(analysis_df)
+    analysis_df = AnalysisUtilities.calculate_slope_corrected_phl_vl2_bl1(analysis_df, slope_phl)
+    analysis_df = AnalysisUtilities.calculate_slope_corrected_yemk_vl2_bl1(analysis_df, slope_yemk)
+
+    cutoff_phl = AnalysisUtilities.calculate_cuttoff_phl_vl2_phl_bl1(AnalysisUtilities.calculate_mean_phl_vl2_phl_bl1(analysis_df),
+                                                                     AnalysisUtilities.calculate_sd_phl_vl2_phl_bl1(analysis_df))
+    cutoff_yemk = AnalysisUtilities.calculate_cuttoff_yemk_vl2_yemk_bl1(AnalysisUtilities.calculate_mean_yemk_vl2_yemk_bl1(analysis_df),
+                                                                        AnalysisUtilities.calculate_sd_yemk_vl2_yemk_bl1(analysis_df))
+    analysis_df = AnalysisUtilities.populate_cutoff_PHL_VL2_BL1_below_cuttoff(analysis_df, cutoff_phl)
+    analysis_df = AnalysisUtilities.populate_cutoff_yemk_vl2_bl1_below_cuttoff(analysis_df, cutoff_yemk)
+
+    analysis_df = AnalysisUtilities.populate_phl_z_score(analysis_df,
+                                                         AnalysisUtilities.calculate_corrected_mean_phl_vl2_phl_bl1(analysis_df),
+                                                         AnalysisUtilities.calculate_corrected_sd_phl_vl2_phl_bl1(analysis_df))
+    analysis_df = AnalysisUtilities.populate_yemk_z_score(analysis_df,
+                                                          AnalysisUtilities.calculate_corrected_mean_yemk_vl2_yemk_bl1(analysis_df),
+                                                          AnalysisUtilities.calculate_corrected_sd_yemk_vl2_yemk_bl1(analysis_df))
+    analysis_df = AnalysisUtilities.populate_live_z_score(analysis_df,
+                                                          AnalysisUtilities.calculate_live_mean(analysis_df),
+                                                          AnalysisUtilities.calculate_live_sd(analysis_df))
+
+    analysis_df = AnalysisUtilities.populate_hits_phl_z_score(analysis_df)
+    analysis_df = AnalysisUtilities.populate_hits_yemk_z_score(analysis_df)
+    analysis_df = AnalysisUtilities.populate_hits_live_z_score(analysis_df)
+
+    return analysis_df
+
+
+def render_history(results_store, view, base_sheet_name):
+    """
+    Render a history workbook of every run in the store, streamed the way /download_file sends it.
+
+    Parameters:
+    - results_store (ResultsStore): The store to render from.
+    - view (str): ResultsStore.VIEW_PLATES or ResultsStore.VIEW_HITS.
+    - base_sheet_name (str): Sheet name prefix, followed by the run timestamp.
+
+    Returns:
+    - int: The size of the workbook in bytes.
+    """
+    sheets = results_store.generate_run_sheets(results_store.select_runs(), view, base_sheet_name)
+
+    return sum(len(chunk) for chunk in StreamingExcelWriter.iter_workbook_chunks(sheets))
+
+
+# Every stage is (name, setup, function): setup builds fresh arguments outside the timed region
+STAGES = [
+    ('read_plate',
+     lambda context: (context.workbook_path, "Samples", "High Controls", context.assay.renamed_columns, AnalysisEngine.SHEET_COLUMN),
+     AnalysisUtilities.read_plate),
+    ('rewrite_column_names',
+     lambda context: (context.combined_df, AnalysisUtilities.get_old_column_names(context.combined_df),
+                      AnalysisUtilities.get_renamed_column_names(), AnalysisUtilities.get_new_column_names()),
+     AnalysisUtilities.rewrite_column_names),
+    ('statistics_utilities',
+     lambda context: (AnalysisUtilities.rewrite_column_names(context.combined_df,
+                                                             AnalysisUtilities.get_old_column_names(context.combined_df),
+                                                             AnalysisUtilities.get_renamed_column_names(),
+                                                             AnalysisUtilities.get_new_column_names()),),
+     run_statistics_chain),
+    ('statistics_engine',
+     lambda context: (context.get_engine_df(),),
+     AnalysisEngine.analyse),
+    ('export_analysis_sheet',
+     lambda context: (context.analysis_df, context.get_output_path("analysis.xlsx"), "Analysis"),
+     AnalysisUtilities.write_analysis_sheet),
+    ('append_run',
+     lambda context: (context.results_store, context.analysis_df, context.assay.get_channel_names()),
+     ResultsStore.append_run),
+    ('render_history_plates',
+     lambda context: (context.history_store, ResultsStore.VIEW_PLATES, "All_P_YEMK_pHL_Live"),
+     render_history),
+    ('render_history_hits',
+     lambda context: (context.history_store, ResultsStore.VIEW_HITS, "All_hits"),
+     render_history),
+]
+
+
+def measure(setup, function, repeat):
+    """
+    Time a stage and measure its peak memory.
+
+    The wall time is the best of repeat runs without tracing; the peak memory comes from one
+    more run under tracemalloc, which slows the code down too much to be timed.
+
+    Parameters:
+    - setup (callable): Returns the arguments of one run.
+    - function (callable): The stage.
+    - repeat (int): The number of timed runs.
+
+    Returns:
+    - dict: 'seconds' and 'peak_bytes'.
+    """
+    timings = []
+    for _ in range(repeat):
+        args = setup()
+        started = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - started)
+
+    args = setup()
+    tracemalloc.start()
+    try:
+        function(*args)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(timings), 'peak_bytes': peak_bytes}
+
+
+def get_scenario_name(wells, plates):
+    return f"{wells}w_x{plates}"
+
+
+def run_scenario(wells, plates, work_dir, repeat, stage_names=None):
+    """
+    Generate a workbook and measure every stage of the pipeline on it.
+
+    Parameters:
+    - wells (int): The plate format.
+    - plates (int): The number of plates stacked in the workbook.
+    - work_dir (str): Scratch directory for the workbook and the exports.
+    - repeat (int): The number of timed runs per stage.
+    - stage_names (list): The stages to run, all of them when None.
+
+    Returns:
+    - dict: The measurements by stage name, with the peak memory also given per plate row.
+    """
+    scenario_dir = os.path.join(work_dir, get_scenario_name(wells, plates))
+    os.makedirs(scenario_dir, exist_ok=True)
+
+    workbook_path = PlateGenerator.write_workbook(os.path.join(scenario_dir, "KCP1_synthetic.xlsx"), wells, plates)
+    context = BenchmarkContext(workbook_path, scenario_dir)
+
+    results = {}
+    for name, setup, function in STAGES:
+        if stage_names and name not in stage_names:
+            continue
+        results[name] = measure(lambda: setup(context), function, repeat)
+        results[name]['peak_bytes_per_row'] = results[name]['peak_bytes'] / len(context.combined_df)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare the measurements against the baseline.
+
+    Parameters:
+    - results (dict): Measurements by scenario then stage.
+    - baseline (dict): The stored measurements, in the same layout.
+    - tolerance (float): Allowed relative slowdown or growth of the peak memory.
+
+    Returns:
+    - list: One row per measured stage: scenario, stage, measurement, baseline measurement (None if missing) and regressions.
+    """
+    rows = []
+    for scenario, stages in results.items():
+        for stage, measured in stages.items():
+            reference = baseline.get(scenario, {}).get(stage)
+            regressions = []
+            if reference is not None:
+                if (measured['seconds'] > reference['seconds'] * (1 + tolerance)
+                        and measured['seconds'] - reference['seconds'] > NOISE_SECONDS):
+                    regressions.append('time')
+                if (measured['peak_bytes'] > reference['peak_bytes'] * (1 + tolerance)
+                        and measured['peak_bytes'] - reference['peak_bytes'] > NOISE_BYTES):
+                    regressions.append('memory')
+            rows.append((scenario, stage, measured, reference, regressions))
+
+    return rows
+
+
+def format_change(value, reference):
+    if not reference:
+        return "-"
+
+    return f"{(value / reference - 1) * 100:+.0f}%"
+
+
+def print_report(rows):
+    print(f"{'scenario':<12} {'stage':<22} {'seconds':>9} {'change':>7} {'peak MiB':>9} {'change':>7} {'B/row':>7}  status")
+    for scenario, stage, measured, reference, regressions in rows:
+        if reference is None:
+            status = "no baseline"
+        elif regressions:
+            status = "REGRESSION (" + ", ".join(regressions) + ")"
+        else:
+            status = "ok"
+
+        time_change = format_change(measured['seconds'], reference and reference['seconds'])
+        memory_change = format_change(measured['peak_bytes'], reference and reference['peak_bytes'])
+        print(f"{scenario:<12} {stage:<22} {measured['seconds']:>9.4f} {time_change:>7} "
+              f"{measured['peak_bytes'] / (1 << 20):>9.1f} {memory_change:>7} {measured['peak_bytes_per_row']:>7.0f}  {status}")
+
+
+def load_baseline(baseline_path):
+    if not os.path.isfile(baseline_path):
+        return {}
+
+    with open(baseline_path) as baseline_file:
+        return json.load(baseline_file).get('scenarios', {})
+
+
+def save_baseline(baseline_path, results):
+    # Keep the scenarios that were not run this time
+    scenarios = load_baseline(baseline_path)
+    scenarios.update(results)
+
+    baseline = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'machine': platform.machine(),
+        },
+        'scenarios': scenarios,
+    }
+    with open(baseline_path, 'w') as baseline_file:
+        json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    stage_choices = [name for name, _, _ in STAGES]
+
+    parser = argparse.ArgumentParser(description="Time every stage of the plate analysis on synthetic workbooks.")
+    parser.add_argument('-w', '--wells', type=int, nargs='+', choices=sorted(PLATE_SHAPES), default=sorted(PLATE_SHAPES),
+                        help="plate formats to run (default: all)")
+    parser.add_argument('-p', '--plates', type=int, nargs='+', default=[1, 10], help="plates per workbook (default: 1 10)")
+    parser.add_argument('-s', '--stages', nargs='+', choices=stage_choices, default=None, help="stages to run (default: all)")
+    parser.add_argument('-r', '--repeat', type=int, default=3, help="timed runs per stage, the best one is kept (default: 3)")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline file (default: benchmarks/baseline.json)")
+    parser.add_argument('--save-baseline', action='store_true', help="store the measurements as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed relative slowdown or memory growth (default: 0.25)")
+    parser.add_argument('--work-dir', default=None, help="keep the workbooks and exports in this directory")
+    args = parser.parse_args(argv)
+
+    if any(not 1 <= plates <= 1000 for plates in args.plates):
+        parser.error("--plates must be between 1 and 1000")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    # The timestamped export sheet names are longer than Excel's 31 characters, which openpyxl warns about on every run
+    warnings.filterwarnings('ignore', message="Title is more than 31 characters")
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="plate_benchmarks_")
+    try:
+        results = {}
+        for wells in args.wells:
+            for plates in args.plates:
+                results[get_scenario_name(wells, plates)] = run_scenario(wells, plates, work_dir, args.repeat, args.stages)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    rows = compare(results, load_baseline(args.baseline), args.tolerance)
+    print_report(rows)
+
+    if args.save_baseline:
+        save_baseline(args.baseline, results)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+
+    # A regression fails the run so it can gate a deploy
+    if any(regressions for _, _, _, _, regressions in rows):
+        print("Performance regressions against the baseline", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,236 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import zlib
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class UploadOffsetError(Exception):
+    """Raised when a chunk does not start where the upload stands; carries the offset to resume from."""
+
+    def __init__(self, message, offset):
+        super().__init__(message)
+        self.offset = offset
+
+
+class UploadChecksumError(ValueError):
+    """Raised when a chunk, or the assembled file, does not match its checksum."""
+
+
+class ChunkedUpload:
+    """
+    A workbook sent in chunks into a job's upload directory, resumable after a failure.
+
+    The upload id is the id of the job that analyses it, so the assembled file is the job's
+    spilled input, uploads/<job_id>/<file name>. Chunks are appended in order: the length
+    of the file is the offset a client resumes from. upload.json next to it records the
+    declared size and checksum, the analysis settings and the checksum of every chunk, so
+    a chunk sent again after a lost response is acknowledged instead of rejected.
+    """
+
+    MANIFEST_NAME = 'upload.json'
+
+    # Per-chunk checksums, sent as "Upload-Checksum: <algorithm> <digest>"
+    CHECKSUM_ALGORITHMS = ('sha256', 'crc32')
+
+    STATUS_RECEIVING = 'receiving'
+    STATUS_COMPLETE = 'complete'
+
+    def __init__(self, workspace):
+        self.workspace = workspace
+        self.manifest_path = os.path.join(workspace.input_dir, self.MANIFEST_NAME)
+
+    @staticmethod
+    def compute_checksum(algorithm, data):
+        """
+        Checksum a chunk.
+
+        Parameters:
+        - algorithm (str): One of CHECKSUM_ALGORITHMS.
+        - data (bytes): The chunk.
+
+        Returns:
+        - str: The digest, hex encoded, crc32 as 8 hex digits.
+        """
+        if algorithm == 'sha256':
+            return hashlib.sha256(data).hexdigest()
+        if algorithm == 'crc32':
+            return f"{zlib.crc32(data):08x}"
+
+        raise ValueError(f"Unsupported checksum algorithm: {algorithm!r}")
+
+    @staticmethod
+    def parse_checksum(header):
+        """
+        Parse an Upload-Checksum header.
+
+        Parameters:
+        - header (str): "<algorithm> <digest>", the digest hex or base64 encoded.
+
+        Returns:
+        - tuple: The algorithm and the digest, hex encoded.
+        """
+        parts = (header or '').split()
+        if len(parts) != 2 or parts[0].lower() not in ChunkedUpload.CHECKSUM_ALGORITHMS:
+            raise ValueError(f"Upload-Checksum must be one of {', '.join(ChunkedUpload.CHECKSUM_ALGORITHMS)} followed by the digest")
+
+        algorithm, digest = parts[0].lower(), parts[1]
+        hex_length = 64 if algorithm == 'sha256' else 8
+
+        if len(digest) != hex_length:
+            try:
+                digest = base64.b64decode(digest, validate=True).hex()
+            except ValueError:
+                raise ValueError("Upload-Checksum digest must be hex or base64 encoded")
+
+        return algorithm, digest.lower()
+
+    def get_file_path(self, manifest):
+        return self.workspace.input_path(manifest['file_name'])
+
+    def load(self):
+        try:
+            with open(self.manifest_path) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, manifest):
+        # Replaced atomically, which also keeps the upload directory's mtime fresh for remove_expired
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='.', suffix='.json', dir=self.workspace.input_dir)
+        try:
+            with os.fdopen(file_descriptor, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+            os.replace(temp_path, self.manifest_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def create(self, file_name, size, sha256=None, settings=None):
+        """
+        Start an upload.
+
+        Parameters:
+        - file_name (str): The workbook's file name, already made safe.
+        - size (int): The workbook's size in bytes.
+        - sha256 (str): Hex SHA-256 of the whole workbook, checked once it is assembled.
+        - settings (dict): JSON serialisable analysis settings, kept until the job starts.
+
+        Returns:
+        - dict: The upload manifest.
+        """
+        manifest = {
+            'file_name': file_name,
+            'size': size,
+            'sha256': sha256.lower() if sha256 else None,
+            'settings': settings or {},
+            'status': self.STATUS_RECEIVING,
+            'chunks': [],
+        }
+
+        # The file exists from the start, it is what concurrent requests lock
+        open(self.get_file_path(manifest), 'wb').close()
+        self.save(manifest)
+
+        return manifest
+
+    @contextmanager
+    def locked(self):
+        # Serialise the requests of one upload, across worker processes where flock is available
+        manifest = self.load()
+        if manifest is None:
+            raise FileNotFoundError(f"Unknown upload {self.workspace.job_id}")
+
+        with open(self.get_file_path(manifest), 'r+b') as upload_file:
+            if fcntl is not None:
+                fcntl.flock(upload_file, fcntl.LOCK_EX)
+            try:
+                # Read the manifest again now that no other request can change it
+                yield self.load(), upload_file
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(upload_file, fcntl.LOCK_UN)
+
+    def get_offset(self, manifest):
+        return os.path.getsize(self.get_file_path(manifest))
+
+    def append(self, offset, data, checksum):
+        """
+        Append a chunk at the end of the upload.
+
+        Parameters:
+        - offset (int): Where the chunk starts, which must be the current length of the upload.
+        - data (bytes): The chunk.
+        - checksum (tuple): The (algorithm, hex digest) the chunk must match.
+
+        Returns:
+        - tuple: The new offset, and True when this chunk completed the upload (False for a repeated chunk).
+        """
+        algorithm, digest = checksum
+        if self.compute_checksum(algorithm, data) != digest:
+            raise UploadChecksumError(f"Chunk at offset {offset} does not match its {algorithm} checksum, please send it again")
+
+        with self.locked() as (manifest, upload_file):
+            current = upload_file.seek(0, os.SEEK_END)
+
+            # A chunk already received, sent again because its response was lost
+            for chunk in manifest['chunks']:
+                if chunk['offset'] == offset and chunk['length'] == len(data) and chunk[algorithm] == digest:
+                    return current, False
+
+            if offset != current:
+                raise UploadOffsetError(f"Chunk starts at offset {offset}, the upload is at {current}", current)
+            if current + len(data) > manifest['size']:
+                raise ValueError(f"Chunk ends at {current + len(data)}, past the declared size of {manifest['size']} bytes")
+
+            upload_file.write(data)
+            upload_file.flush()
+            os.fsync(upload_file.fileno())
+            current += len(data)
+
+            # Both checksums are kept so a resent chunk is recognised whichever one the client uses
+            manifest['chunks'].append({'offset': offset, 'length': len(data),
+                                       'sha256': self.compute_checksum('sha256', data) if algorithm != 'sha256' else digest,
+                                       'crc32': self.compute_checksum('crc32', data) if algorithm != 'crc32' else digest})
+
+            completed = current == manifest['size']
+            if completed:
+                self.check_file(manifest)
+                manifest['status'] = self.STATUS_COMPLETE
+            self.save(manifest)
+
+        return current, completed
+
+    def check_file(self, manifest):
+        # The whole workbook against its declared checksum; a mismatch starts the upload over
+        if not manifest['sha256']:
+            return
+
+        digest = hashlib.sha256()
+        with open(self.get_file_path(manifest), 'rb') as upload_file:
+            for block in iter(lambda: upload_file.read(1024 * 1024), b''):
+                digest.update(block)
+
+        if digest.hexdigest() != manifest['sha256']:
+            with open(self.get_file_path(manifest), 'wb'):
+                pass
+            manifest['chunks'] = []
+            self.save(manifest)
+            raise UploadChecksumError("The assembled workbook does not match its sha256, please upload it again")
+
+    def get_status(self, manifest):
+        return {
+            'upload_id': self.workspace.job_id,
+            'file_name': manifest['file_name'],
+            'size': manifest['size'],
+            'offset': self.get_offset(manifest),
+            'status': manifest['status'],
+        }
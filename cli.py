@@ -0,0 +1,129 @@
+import argparse
+import os
+import sys
+import time
+
+# Only the standard library is imported here; pandas, openpyxl and the analysis modules are
+# imported by the command that needs them so "--help" and argument errors return immediately.
+
+
+def analyse_command(args):
+    from analysis_engine import AnalysisEngine
+    from assays import get_assay
+    from excel_writer import StreamingExcelWriter
+    from utilities import AnalysisUtilities
+
+    if args.campaign and not args.results_db:
+        raise ValueError("--campaign needs --results-db")
+    if args.normalisation == 'campaign' and not args.campaign:
+        raise ValueError("--normalisation campaign needs --campaign")
+
+    started = time.perf_counter()
+
+    results_store = None
+    reference_stats = None
+    if args.results_db:
+        from results_store import ResultsStore
+        results_store = ResultsStore(args.results_db)
+
+        # Campaign normalised z-scores only need the campaign's running aggregates
+        if args.normalisation == AnalysisEngine.NORMALISE_CAMPAIGN:
+            reference_stats = results_store.get_campaign_stats(args.campaign)
+
+    # Combine the Samples and High Controls rows, remove the mean and SD rows and rename the instrument columns
+    assay = get_assay(args.assay)
+    sheet_column = AnalysisEngine.SHEET_COLUMN if args.drift_mode == AnalysisEngine.DRIFT_SHEET else None
+    plate_df = AnalysisUtilities.read_plate(args.workbook,
+                                            args.samples_sheet or assay.sheet_names[0],
+                                            args.controls_sheet or assay.sheet_names[1],
+                                            assay.renamed_columns,
+                                            sheet_column)
+
+    result = AnalysisEngine.analyse(plate_df,
+                                    cutoff_multiplier=args.cutoff_multiplier,
+                                    hit_threshold=args.hit_threshold,
+                                    assay=assay,
+                                    drift_groups=sheet_column,
+                                    reference_stats=reference_stats,
+                                    clip_iterations=args.clip_iterations)
+
+    if results_store is not None:
+        results_store.append_run(result.frame, assay.get_channel_names(), source=AnalysisUtilities.getfile_name(args.workbook),
+                                 hit_masks=result.hit_masks)
+        if args.campaign:
+            results_store.add_campaign_stats(args.campaign, result.aggregates)
+
+    output_path = args.output or AnalysisUtilities.getfile_name(args.workbook) + "_analysis.xlsx"
+    StreamingExcelWriter.write_frames(output_path, [(args.sheet_name, result.frame)])
+
+    hit_counts = ", ".join(f"{channel}={int(mask.sum())}" for channel, mask in result.hit_masks.items())
+    print(f"Analysed {args.workbook} in {time.perf_counter() - started:.2f}s ({hit_counts} hits) -> {output_path}")
+
+    return 0
+
+
+def batch_command(args):
+    import batch
+
+    return batch.main(args.forwarded_args)
+
+
+def watch_command(args):
+    import watcher
+
+    return watcher.main(args.forwarded_args)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Run the pHL/YEMK plate analysis without the web app.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    analyse_parser = subparsers.add_parser('analyse', help="analyse one workbook")
+    analyse_parser.add_argument('workbook', help="the instrument workbook")
+    analyse_parser.add_argument('-o', '--output', default=None, help="workbook to write (default: <workbook>_analysis.xlsx)")
+    analyse_parser.add_argument('--sheet-name', default="Analysis", help="name of the output sheet (default: Analysis)")
+    analyse_parser.add_argument('--assay', default=None, help="assay of the workbook, e.g. PL1 (default: pl1)")
+    analyse_parser.add_argument('--samples-sheet', default=None, help="sheet with the sample wells (default: the assay's)")
+    analyse_parser.add_argument('--controls-sheet', default=None, help="sheet with the control wells (default: the assay's)")
+    analyse_parser.add_argument('--cutoff-multiplier', type=float, default=None, help="outlier cutoff in SD (default: 1.5)")
+    analyse_parser.add_argument('--hit-threshold', type=float, default=None, help="z-score below which a well is a hit (default: -5)")
+    analyse_parser.add_argument('--drift-mode', choices=('global', 'sheet'), default='global',
+                                help="fit the drift across the whole workbook or per sheet (default: global)")
+    analyse_parser.add_argument('--clip-iterations', type=int, default=None, help="maximum rounds of outlier clipping (default: 1)")
+    analyse_parser.add_argument('--results-db', default=None, help="also record the run in this results store")
+    analyse_parser.add_argument('--campaign', default=None, help="add the plate to this campaign's statistics (needs --results-db)")
+    analyse_parser.add_argument('--normalisation', choices=('plate', 'campaign'), default='plate',
+                                help="take the z-scores against this plate or the whole campaign (default: plate)")
+    analyse_parser.set_defaults(handler=analyse_command)
+
+    # The batch options are parsed by batch.py itself, which is only imported when it runs
+    batch_parser = subparsers.add_parser('batch', help="analyse many workbooks in parallel", add_help=False)
+    batch_parser.set_defaults(handler=batch_command, forwards_arguments=True)
+
+    # The watch options are parsed by watcher.py, which imports the web app to run the jobs
+    watch_parser = subparsers.add_parser('watch', help="analyse new workbooks of an instrument export directory", add_help=False)
+    watch_parser.set_defaults(handler=watch_command, forwards_arguments=True)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, extra_args = parser.parse_known_args(argv)
+
+    if getattr(args, 'forwards_arguments', False):
+        args.forwarded_args = extra_args
+    elif extra_args:
+        parser.error(f"unrecognized arguments: {' '.join(extra_args)}")
+
+    try:
+        return args.handler(args)
+    except (OSError, KeyError, ValueError) as e:
+        # KeyError quotes its message
+        message = e.args[0] if isinstance(e, KeyError) and e.args else e
+        print(f"{os.path.basename(sys.argv[0])}: error: {message}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,150 @@
+import io
+import queue
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class QueueWriter(io.RawIOBase):
+    """
+    Non-seekable file object that hands every written chunk to a bounded queue.
+
+    zipfile falls back to streaming mode on non-seekable files, so an xlsx can be
+    produced straight into an HTTP response while it is being written.
+    """
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        # Discard the rest of the workbook once the reader has gone away, e.g. the client disconnected
+        if not self.cancelled.is_set():
+            self.chunks.put(bytes(data))
+
+        return len(data)
+
+
+class StreamingExcelWriter:
+    """
+    Write DataFrames to xlsx with openpyxl's write-only mode.
+
+    Rows are serialised one at a time instead of building the whole workbook in memory,
+    so peak memory stays flat as the number of rows and sheets grows.
+    """
+
+    CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    # Chunks buffered between the writer thread and the HTTP response
+    MAX_QUEUED_CHUNKS = 64
+
+    @staticmethod
+    def iter_rows(frame):
+        """
+        Iterate over the rows of a DataFrame as cell values, NaN becoming an empty cell.
+
+        Parameters:
+        - frame (pd.DataFrame): The frame to write.
+
+        Returns:
+        - iterator: Tuples of cell values.
+        """
+        columns = []
+        for _, column in frame.items():
+            if column.dtype == np.float32:
+                # float32 values are written with their shortest decimal form, 80.12 rather than 80.12000274658203
+                values = column.to_numpy().astype(str).astype(np.float64).astype(object)
+            else:
+                values = column.to_numpy(dtype=object)
+            values[pd.isna(values)] = None
+            columns.append(values)
+
+        return zip(*columns)
+
+    @staticmethod
+    def write_frames(target, sheets, cancelled=None):
+        """
+        Write one sheet per DataFrame.
+
+        Parameters:
+        - target (str or file-like): Where to write the workbook.
+        - sheets (iterable): (sheet_name, DataFrame) pairs, consumed lazily.
+        - cancelled (threading.Event): When set, the remaining rows and sheets are skipped.
+
+        Returns:
+        - int: The number of sheets written.
+        """
+        # openpyxl is only imported when a workbook is written, it is slow to import
+        from openpyxl import Workbook
+
+        workbook = Workbook(write_only=True)
+        sheet_count = 0
+
+        for sheet_name, frame in sheets:
+            worksheet = workbook.create_sheet(title=sheet_name)
+            worksheet.append([str(name) for name in frame.columns])
+            for row in StreamingExcelWriter.iter_rows(frame):
+                if cancelled is not None and cancelled.is_set():
+                    break
+                worksheet.append(row)
+            sheet_count += 1
+
+            if cancelled is not None and cancelled.is_set():
+                break
+
+        # A workbook needs at least one sheet
+        if sheet_count == 0:
+            workbook.create_sheet()
+
+        workbook.save(target)
+
+        return sheet_count
+
+    @staticmethod
+    def iter_workbook_chunks(sheets):
+        """
+        Produce the bytes of an xlsx workbook while it is being written.
+
+        Parameters:
+        - sheets (iterable): (sheet_name, DataFrame) pairs, consumed lazily.
+
+        Returns:
+        - generator: Chunks of the workbook, suitable as a streamed response body.
+        """
+        chunks = queue.Queue(maxsize=StreamingExcelWriter.MAX_QUEUED_CHUNKS)
+        cancelled = threading.Event()
+        finished = object()
+        errors = []
+
+        def write():
+            try:
+                StreamingExcelWriter.write_frames(QueueWriter(chunks, cancelled), sheets, cancelled)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                chunks.put(finished)
+
+        writer_thread = threading.Thread(target=write, daemon=True)
+        writer_thread.start()
+
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is finished:
+                    break
+                yield chunk
+        finally:
+            # Unblock the writer if the response was closed early
+            cancelled.set()
+            while writer_thread.is_alive():
+                try:
+                    chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+        if errors:
+            raise errors[0]
@@ -0,0 +1,117 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at its depth limit."""
+
+
+class JobQueue:
+    """
+    Run analysis jobs on a local thread or process pool and track their status.
+
+    At most max_workers jobs run at once and at most max_queued more wait for a
+    worker; submitting beyond that raises QueueFullError so the web tier can reject
+    the upload instead of blocking.
+    """
+
+    STATUS_QUEUED = 'queued'
+    STATUS_RUNNING = 'running'
+    STATUS_FINISHED = 'finished'
+    STATUS_FAILED = 'failed'
+
+    # Finished jobs kept around for status and result lookups
+    MAX_FINISHED_JOBS = 1000
+
+    def __init__(self, max_workers=2, max_queued=16, use_processes=False):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.use_processes = use_processes
+        self.executor = None
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        # Created on first use so importing the app does not start a pool
+        if self.executor is None:
+            executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+            self.executor = executor_class(max_workers=self.max_workers)
+
+        return self.executor
+
+    def count_pending(self):
+        return sum(1 for job in self.jobs.values() if not job['future'].done())
+
+    def prune_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['future'].done()]
+        for job_id in finished[:max(len(finished) - self.MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    @staticmethod
+    def new_job_id():
+        return uuid.uuid4().hex
+
+    def get_pending_count(self):
+        with self.lock:
+            return self.count_pending()
+
+    def submit(self, function, *args, job_id=None, on_done=None, **kwargs):
+        """
+        Queue a job.
+
+        Parameters:
+        - function (callable): The job function; must be picklable when using processes.
+        - args, kwargs: Arguments passed to the function.
+        - job_id (str): Id to register the job under, a new one is generated by default.
+        - on_done (callable): Called in this process with the job's future once it finished or failed.
+
+        Returns:
+        - str: The id of the new job.
+        """
+        with self.lock:
+            if self.count_pending() >= self.max_workers + self.max_queued:
+                raise QueueFullError(f"The analysis queue is full ({self.max_workers + self.max_queued} jobs pending)")
+
+            self.prune_finished()
+
+            job_id = job_id or self.new_job_id()
+            future = self.get_executor().submit(function, *args, **kwargs)
+            self.jobs[job_id] = {'future': future, 'submitted_at': time.time()}
+
+        if on_done is not None:
+            future.add_done_callback(on_done)
+
+        return job_id
+
+    def get_status(self, job_id):
+        """
+        Describe a job.
+
+        Parameters:
+        - job_id (str): The job id returned by submit.
+
+        Returns:
+        - dict: The job status, its result once finished or its error once failed; None for an unknown job.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+
+        if job is None:
+            return None
+
+        future = job['future']
+        status = {'job_id': job_id, 'submitted_at': job['submitted_at']}
+
+        if not future.done():
+            status['status'] = self.STATUS_RUNNING if future.running() else self.STATUS_QUEUED
+        elif future.exception() is not None:
+            status['status'] = self.STATUS_FAILED
+            status['error'] = str(future.exception())
+        else:
+            status['status'] = self.STATUS_FINISHED
+            status['result'] = future.result()
+
+        return status
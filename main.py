@@ -1,98 +1,337 @@
 from utilities import AnalysisUtilities
-from flask import Flask, render_template, request, send_file, abort
+from analysis_engine import AnalysisEngine
+from assays import get_assay
+from results_store import ResultsStore
+from job_queue import JobQueue, QueueFullError
+from workspace import DATA_ROOT, JobWorkspace
+from result_cache import ResultCache
+from plate_store import PlateStore
+from excel_writer import StreamingExcelWriter
+from workbook_reader import WorkbookReader
+from metrics import JobTrace, MetricsRegistry, iter_counted
+from table_formats import TableFormats
+from chunked_upload import ChunkedUpload, UploadChecksumError, UploadOffsetError
+from flask import Flask, render_template, request, send_file, send_from_directory, abort, jsonify, Response, stream_with_context, url_for
+from werkzeug.exceptions import HTTPException
+from werkzeug.utils import secure_filename
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import hashlib
+import json
+import multiprocessing
 import os
+import tempfile
+import threading
+import time
 
 app = Flask(__name__)
 
-def generate_files_phl_bl1_yemk_vl1(uploaded_file_path, sheet1, sheet2, final_sheet):
+# Worker pool settings: ANALYSIS_WORKERS jobs run at once, ANALYSIS_QUEUE_DEPTH more may wait,
+# ANALYSIS_EXECUTOR selects a "thread" or "process" pool
+app.config['ANALYSIS_WORKERS'] = int(os.environ.get('ANALYSIS_WORKERS', 2))
+app.config['ANALYSIS_QUEUE_DEPTH'] = int(os.environ.get('ANALYSIS_QUEUE_DEPTH', 16))
+app.config['ANALYSIS_EXECUTOR'] = os.environ.get('ANALYSIS_EXECUTOR', 'thread')
+
+job_queue = JobQueue(max_workers=app.config['ANALYSIS_WORKERS'],
+                     max_queued=app.config['ANALYSIS_QUEUE_DEPTH'],
+                     use_processes=app.config['ANALYSIS_EXECUTOR'] == 'process')
+
+# Jobs asking for several outputs or formats write them as separate tasks on a pool of EXPORT_WORKERS processes,
+# next to the rest of the job; a single export is written in the job's own process
+app.config['EXPORT_WORKERS'] = int(os.environ.get('EXPORT_WORKERS', 2))
+
+# Export workers are started from a clean server process rather than forked from the threaded web process,
+# whose locks (SQLite, logging, the job queue) a forked child could inherit while held
+EXPORT_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+export_executor = None
+export_executor_lock = threading.Lock()
+
+# Job outputs are removed OUTPUT_RETENTION_SECONDS after they were written
+app.config['OUTPUT_RETENTION_SECONDS'] = int(os.environ.get('OUTPUT_RETENTION_SECONDS', 24 * 60 * 60))
+
+RESULTS_DB_PATH = os.path.join(JobWorkspace.DOWNLOADS_ROOT, "results.sqlite3")
+
+# Uploads larger than UPLOAD_SPILL_THRESHOLD bytes are saved to disk, smaller ones are analysed from memory
+app.config['UPLOAD_SPILL_THRESHOLD'] = int(os.environ.get('UPLOAD_SPILL_THRESHOLD', 32 * 1024 * 1024))
+
+# Chunked uploads take workbooks of up to UPLOAD_MAX_BYTES in chunks of up to UPLOAD_CHUNK_BYTES
+app.config['UPLOAD_CHUNK_BYTES'] = int(os.environ.get('UPLOAD_CHUNK_BYTES', 8 * 1024 * 1024))
+app.config['UPLOAD_MAX_BYTES'] = int(os.environ.get('UPLOAD_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+
+# Stream history workbooks into the response while they are rendered instead of spooling them first
+app.config['STREAM_DOWNLOADS'] = os.environ.get('STREAM_DOWNLOADS', '1') == '1'
+
+# Measure the peak memory of every job with tracemalloc, for sizing the workers; slows the jobs down.
+# Off by default: the traces then report peak_memory_bytes as null and only the worker's lifetime peak RSS
+app.config['TRACE_MEMORY'] = os.environ.get('TRACE_MEMORY', '0') == '1'
+
+# Outputs of repeated uploads are served from an on-disk cache bounded by size and entry count
+app.config['RESULT_CACHE_DIR'] = os.path.abspath(os.environ.get('RESULT_CACHE_DIR', os.path.join(DATA_ROOT, 'cache')))
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+app.config['RESULT_CACHE_MAX_ENTRIES'] = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 256))
+
+result_cache = ResultCache(app.config['RESULT_CACHE_DIR'],
+                           max_bytes=app.config['RESULT_CACHE_MAX_BYTES'],
+                           max_entries=app.config['RESULT_CACHE_MAX_ENTRIES'])
+
+# Parsed plates kept for re-analysis with other thresholds
+app.config['PLATE_STORE_DIR'] = os.path.abspath(os.environ.get('PLATE_STORE_DIR', os.path.join(DATA_ROOT, 'plates')))
+app.config['PLATE_STORE_MAX_ENTRIES'] = int(os.environ.get('PLATE_STORE_MAX_ENTRIES', 512))
+
+plate_store = PlateStore(app.config['PLATE_STORE_DIR'], max_entries=app.config['PLATE_STORE_MAX_ENTRIES'])
+
+# Stage timings, rows and bytes of the jobs run by this process, served at /metrics
+metrics_registry = MetricsRegistry()
+
+ANALYSIS_FILE_NAME = "LC2-032_KCP1 pHL-YEMK DC 20231030.xlsx"
+
+# History workbooks rendered from the results store: file name -> (view, base sheet name)
+HISTORY_VIEWS = {
+    "All_P_YEMK_pHL_Live.xlsx": (ResultsStore.VIEW_PLATES, "All_P_YEMK_pHL_Live"),
+    "All_hits.xlsx": (ResultsStore.VIEW_HITS, "All_hits"),
+}
+
+# The outputs a job can be asked for: form value -> file name
+OUTPUTS = {
+    'analysis': ANALYSIS_FILE_NAME,
+    'plates': "All_P_YEMK_pHL_Live.xlsx",
+    'hits': "All_hits.xlsx",
+}
+
+# Outputs written by the job itself, as (export, columns): export(analysis_df[columns], file_path, sheet_name) writes
+# the xlsx file and columns None is every column; the other outputs are HISTORY_VIEWS rendered on download
+JOB_EXPORTS = {
+    'analysis': (AnalysisUtilities.write_analysis_sheet, None),
+}
+
+# Formats the job's own outputs can be written in, xlsx being the JOB_EXPORTS above and the others TableFormats
+XLSX_FORMAT = 'xlsx'
+FORMATS = [XLSX_FORMAT] + TableFormats.get_formats()
+
+def generate_files_phl_bl1_yemk_vl1(uploaded_file, sheet1, sheet2, final_sheet, workspace=None, input_file_name=None,
+                                    plate_id=None, cutoff_multiplier=None, hit_threshold=None, assay=None, drift_mode=None,
+                                    campaign=None, normalisation=None, clip_iterations=None, trace=None, outputs=None, formats=None):
     
-    # Specify the path to your Excel file
-    file_name = AnalysisUtilities.getfile_name(uploaded_file_path)
-    file_path = "uploads/" + file_name + ".xlsx"
+    # The upload is either a path on disk or the workbook contents (bytes or a file-like buffer)
+    if input_file_name is None:
+        input_file_name = uploaded_file if isinstance(uploaded_file, str) else "upload.xlsx"
+    file_name = AnalysisUtilities.getfile_name(input_file_name)
+
+    if trace is None:
+        trace = JobTrace()
+    if isinstance(uploaded_file, (bytes, bytearray)):
+        trace.bytes_read += len(uploaded_file)
+    elif isinstance(uploaded_file, (str, os.PathLike)):
+        trace.bytes_read += os.path.getsize(uploaded_file)
+    else:
+        # A file-like upload, e.g. a spooled form file: the bytes from its position to its end, leaving the position as it was
+        position = uploaded_file.tell()
+        trace.bytes_read += uploaded_file.seek(0, os.SEEK_END) - position
+        uploaded_file.seek(position)
     
     #get functions to retreave the desired data
-    renamed_column_names_list = AnalysisUtilities.get_renamed_column_names()
-    new_column_names_list = AnalysisUtilities.get_new_column_names()
     sheet1_name = AnalysisUtilities.getsheet1_name(sheet1)
     sheet2_name = AnalysisUtilities.getsheet2_name(sheet2)
     new_sheet_name = AnalysisUtilities.get_new_sheet_name(final_sheet)
-    removed_columns_names_list = AnalysisUtilities.remove_columns_names_list()    
     
-    # Prepare analysis DataFrame by combining data from Samples and High Controls and removing mean and SD rows
-    combined_df = AnalysisUtilities.prepare_analysis_df(file_path, sheet1_name, sheet2_name, removed_columns_names_list)
+    # Combine the Samples and High Controls rows, remove the mean and SD rows and rename the instrument columns
+    # The sheet of every row is kept so the plate can also be re-analysed with per-sheet drift correction
+    with trace.stage('read_plate'):
+        plate_df = AnalysisUtilities.read_plate(uploaded_file, sheet1_name, sheet2_name, assay.renamed_columns if assay else None,
+                                                sheet_column=AnalysisEngine.SHEET_COLUMN)
 
-    # get current combined_df column names
-    old_column_name_list = AnalysisUtilities.get_old_column_names(combined_df)
+    # Keep the parsed plate so it can be re-analysed with other thresholds without reading the workbook again
+    if plate_id is not None:
+        with trace.stage('store_plate'):
+            plate_store.save(plate_id, plate_df)
 
-    # rewrite columns and add new columns
-    analysis_df = AnalysisUtilities.rewrite_column_names(combined_df, old_column_name_list,  renamed_column_names_list, new_column_names_list)
+    analyse_plate(plate_df, new_sheet_name, workspace, cutoff_multiplier, hit_threshold, history_source=file_name, assay=assay,
+                  drift_mode=drift_mode, campaign=campaign, normalisation=normalisation, clip_iterations=clip_iterations, trace=trace,
+                  plate_id=plate_id, outputs=outputs, formats=formats)
 
-    # Calculate 'pHL_VL2_BL1' column
-    analysis_df = AnalysisUtilities.calculate_pHL_VL2_BL1(analysis_df)
+def analyse_plate(plate_df, new_sheet_name, workspace=None, cutoff_multiplier=None, hit_threshold=None, history_source=None, assay=None,
+                  drift_mode=None, campaign=None, normalisation=None, clip_iterations=None, trace=None, plate_id=None, outputs=None,
+                  formats=None):
+    if assay is None:
+        assay = get_assay()
+    if trace is None:
+        trace = JobTrace()
+    trace.rows += len(plate_df)
 
-    # Calculate 'yemk_vl2_bl1' column
-    analysis_df = AnalysisUtilities.calculate_yemk_vl2_bl1(analysis_df)
+    # Fit the drift per sheet, or across the whole workbook without reporting the sheet column
+    drift_groups = None
+    if drift_mode == AnalysisEngine.DRIFT_SHEET:
+        if AnalysisEngine.SHEET_COLUMN not in plate_df.columns:
+            raise ValueError("This plate was stored without its sheets, please upload the workbook again for per-sheet drift correction")
+        drift_groups = AnalysisEngine.SHEET_COLUMN
+    elif AnalysisEngine.SHEET_COLUMN in plate_df.columns:
+        # A shallow copy drops the column without copying the rest of the plate
+        plate_df = plate_df.copy(deep=False)
+        plate_df.pop(AnalysisEngine.SHEET_COLUMN)
 
-    # Calculate 'relative_well_number' column
-    analysis_df = AnalysisUtilities.calculate_relative_well_number(analysis_df)
+    results_store = ResultsStore(RESULTS_DB_PATH)
 
-    # calculate the slopes
-    slope_phl_vl2_phl_bl1 = AnalysisUtilities.calculate_slope_phl_vl2_phl_bl1(analysis_df)
-    slope_yemk_vl2_yemk_bl1 = AnalysisUtilities.calculate_slope_yemk_vl2_bl1(analysis_df)
+    # Campaign normalised z-scores only need the campaign's running aggregates, not its earlier plates
+    reference_stats = None
+    if campaign and normalisation == AnalysisEngine.NORMALISE_CAMPAIGN:
+        with trace.stage('campaign_stats'):
+            reference_stats = results_store.get_campaign_stats(campaign)
 
-    # Calculate and populate the corrected slope for ph1_vl2_bl1
-    analysis_df = AnalysisUtilities.calculate_slope_corrected_phl_vl2_bl1(analysis_df, slope_phl_vl2_phl_bl1)
-    analysis_df = AnalysisUtilities.calculate_slope_corrected_yemk_vl2_bl1(analysis_df, slope_yemk_vl2_yemk_bl1)
+    # Calculate the ratios, drift correction, cutoffs, z-scores and hits of every channel of the assay in a single pass
+    with trace.stage('statistics'):
+        result = AnalysisEngine.analyse(plate_df, cutoff_multiplier=cutoff_multiplier, hit_threshold=hit_threshold, assay=assay,
+                                        drift_groups=drift_groups, reference_stats=reference_stats, clip_iterations=clip_iterations)
+    analysis_df = result.frame
 
-    # calculate the means
-    mean_phl_vl2_phl_bl1 = AnalysisUtilities.calculate_mean_phl_vl2_phl_bl1(analysis_df)
-    mean_yemk_vl2_yemk_bl1 = AnalysisUtilities.calculate_mean_yemk_vl2_yemk_bl1(analysis_df)
+    # Write the requested workbooks; several are written on the export pool while the run is recorded
+    exports = start_exports(analysis_df, new_sheet_name, workspace, outputs or list(OUTPUTS), formats or [XLSX_FORMAT])
 
-    # calculate the standard deviations
-    sd_phl_vl2_phl_bl1 = AnalysisUtilities.calculate_sd_phl_vl2_phl_bl1(analysis_df)
-    sd_yemk_vl2_yemk_bl1 = AnalysisUtilities.calculate_sd_yemk_vl2_yemk_bl1(analysis_df)
+    try:
+        # Record the z-scores and hits of this run; the All_P_YEMK_pHL_Live and All_hits workbooks are rendered from the store on download
+        if history_source is not None:
+            with trace.stage('record_results'):
+                results_store.append_run(analysis_df, assay.get_channel_names(), source=history_source, plate_id=plate_id,
+                                         hit_masks=result.hit_masks)
 
-    # calculate the cuttoffs
-    cuttoff_phl_vl2_phl_bl1 = AnalysisUtilities.calculate_cuttoff_phl_vl2_phl_bl1(mean_phl_vl2_phl_bl1, sd_phl_vl2_phl_bl1)
-    cuttoff_yemk_vl2_yemk_bl1 = AnalysisUtilities.calculate_cuttoff_yemk_vl2_yemk_bl1(mean_yemk_vl2_yemk_bl1, sd_yemk_vl2_yemk_bl1)
+                # Uploaded plates add to their campaign's statistics, re-analyses of a stored plate do not count it twice
+                if campaign:
+                    results_store.add_campaign_stats(campaign, result.aggregates)
+    finally:
+        # Wait for the exports, published atomically into the job's workspace when there is one
+        with trace.stage('write_exports'):
+            export_paths = finish_exports(workspace, exports)
 
-    # populate the cutoff_PHL_VL2_BL1_below_cuttoff if above the cutoff don't include
-    analysis_df = AnalysisUtilities.populate_cutoff_PHL_VL2_BL1_below_cuttoff(analysis_df, cuttoff_phl_vl2_phl_bl1)
-    analysis_df = AnalysisUtilities.populate_cutoff_yemk_vl2_bl1_below_cuttoff(analysis_df, cuttoff_yemk_vl2_yemk_bl1)
+    trace.bytes_written += sum(os.path.getsize(path) for path in export_paths)
 
-    #calculate correct mean or phl_vl2_phl_bl1 and yemk_vl2_yemk_bl1
-    corrected_mean_phl_vl2_phl_bl1 = AnalysisUtilities.calculate_corrected_mean_phl_vl2_phl_bl1(analysis_df)
-    corrected_mean_yemk_vl2_yemk_bl1 = AnalysisUtilities.calculate_corrected_mean_yemk_vl2_yemk_bl1(analysis_df)
+def get_export_executor():
+    # Created on first use, in the process that runs the jobs
+    global export_executor
 
-    # calculate correct standard deviation for ph1 and yemk
-    corrected_sd_phl_vl2_phl_bl1 = AnalysisUtilities.calculate_corrected_sd_phl_vl2_phl_bl1(analysis_df)
-    corrected_sd_yemk_vl2_yemk_bl1 = AnalysisUtilities.calculate_corrected_sd_yemk_vl2_yemk_bl1(analysis_df)
+    with export_executor_lock:
+        if export_executor is None:
+            export_executor = ProcessPoolExecutor(max_workers=app.config['EXPORT_WORKERS'],
+                                                  mp_context=multiprocessing.get_context(EXPORT_START_METHOD))
 
-    #populate ph1 and yemk z score
-    analysis_df = AnalysisUtilities.populate_phl_z_score(analysis_df, corrected_mean_phl_vl2_phl_bl1, corrected_sd_phl_vl2_phl_bl1)
-    analysis_df = AnalysisUtilities.populate_yemk_z_score(analysis_df, corrected_mean_yemk_vl2_yemk_bl1, corrected_sd_yemk_vl2_yemk_bl1)
+    return export_executor
 
-    #calculate live mean and standard deviation
-    live_mean = AnalysisUtilities.calculate_live_mean(analysis_df)
-    live_sd = AnalysisUtilities.calculate_live_sd(analysis_df)
+def reset_export_executor(broken_executor):
+    # A worker that died, e.g. out of memory, breaks the whole pool: the next export starts a new one
+    global export_executor
 
-    #populate live z score
-    analysis_df = AnalysisUtilities.populate_live_z_score(analysis_df, live_mean, live_sd)
+    with export_executor_lock:
+        if export_executor is broken_executor:
+            export_executor = None
 
-    #populate the hits
-    analysis_df = AnalysisUtilities.populate_hits_phl_z_score(analysis_df)
-    analysis_df = AnalysisUtilities.populate_hits_yemk_z_score(analysis_df)
-    analysis_df = AnalysisUtilities.populate_hits_live_z_score(analysis_df)
+    broken_executor.shutdown(wait=False)
 
-    #write the All_Plates_YEMK_pHL_Live Excel file
-    AnalysisUtilities.export_All_Plates_YEMK_pHL_Live(analysis_df, 'downloads/All_P_YEMK_pHL_Live.xlsx','All_P_YEMK_pHL_Live')
+def submit_export(function, *args):
+    # A pool broken by an earlier job, e.g. a worker killed out of memory, is replaced before submitting
+    executor = get_export_executor()
+    try:
+        return executor.submit(function, *args)
+    except BrokenProcessPool:
+        reset_export_executor(executor)
+        return get_export_executor().submit(function, *args)
 
-    #write All hits excel file exclude all rows that don't have a hit in at least 1 of the three z numbers
-    AnalysisUtilities.export_All_hits(analysis_df, 'downloads/All_hits.xlsx','All_hits')
+def run_export(function, *args):
+    # Written in this process, with the outcome in a future like the pool's
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+
+    return future
+
+def start_exports(analysis_df, sheet_name, workspace, outputs, formats):
+    """
+    Start writing the job's requested files, one task per output and format.
+
+    A single task is written right away in this process. Several are submitted to the export
+    pool, each sent only the columns its file holds, and are written while the job goes on.
+
+    Parameters:
+    - analysis_df (pd.DataFrame): The analysed plate.
+    - sheet_name (str): The name of the analysis sheet.
+    - workspace (JobWorkspace): The job's workspace, or None to write into "downloads/".
+    - outputs (list): The requested OUTPUTS; those that are not JOB_EXPORTS need no writing.
+    - formats (list): The requested FORMATS.
+
+    Returns:
+    - list: (file name, path written to, future) of every export.
+    """
+    tasks = []
+    for output in outputs:
+        if output not in JOB_EXPORTS:
+            continue
+
+        function, columns = JOB_EXPORTS[output]
+        export_df = analysis_df if columns is None else analysis_df[columns]
+
+        for file_format in formats:
+            file_name = get_output_file_name(output, file_format)
+            path = os.path.join(JobWorkspace.DOWNLOADS_ROOT, file_name) if workspace is None else workspace.new_temp_path(file_name)
+
+            if file_format == XLSX_FORMAT:
+                tasks.append((file_name, path, function, (export_df, path, sheet_name)))
+            else:
+                tasks.append((file_name, path, TableFormats.write, (export_df, path, file_format)))
+
+    # Sending the plate to a worker only pays off when the pool writes several files at once
+    start = run_export if len(tasks) == 1 else submit_export
+
+    return [(file_name, path, start(function, *args)) for file_name, path, function, args in tasks]
+
+def get_output_file_name(output, file_format=XLSX_FORMAT):
+    if file_format == XLSX_FORMAT:
+        return OUTPUTS[output]
+
+    return TableFormats.get_file_name(OUTPUTS[output], file_format)
+
+def finish_exports(workspace, exports):
+    """
+    Wait for the exports of start_exports and publish them.
+
+    Every export is waited for before any is published, so a failed export leaves none of the job's workbooks behind.
+
+    Parameters:
+    - workspace (JobWorkspace): The job's workspace, or None when the exports were written into "downloads/".
+    - exports (list): The exports returned by start_exports.
+
+    Returns:
+    - list: The paths of the published workbooks.
+    """
+    errors = [future.exception() for _, _, future in exports]
+
+    if any(error is not None for error in errors):
+        if workspace is not None:
+            for _, path, _ in exports:
+                workspace.discard(path)
+        raise next(error for error in errors if error is not None)
+
+    if workspace is None:
+        return [path for _, path, _ in exports]
+
+    return [workspace.commit(file_name, path) for file_name, path, _ in exports]
+
+@app.errorhandler(HTTPException)
+def handle_http_error(e):
+    # Clients that asked for JSON, like the upload form's fetch, get the reason instead of an error page
+    if wants_json():
+        return jsonify({'error': e.description}), e.code
+
+    return e
+
+def wants_json():
+    # JSON bodies, and requests preferring JSON over HTML in their Accept header
+    return request.is_json or request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json'
+
+@app.context_processor
+def inject_formats():
+    # The output formats offered on the upload and re-analyse forms
+    return {'formats': FORMATS}
 
-    # Write analysis sheet
-    AnalysisUtilities.write_analysis_sheet(analysis_df, "downloads/LC2-032_KCP1 pHL-YEMK DC 20231030.xlsx", new_sheet_name)
-    
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -102,61 +341,763 @@ def combine_sheets():
     # Handle file and form data
     input_file = request.files['input_file']
     file_type = request.form['selected_radio_id']
+    options = get_analysis_options(request.form)
+
+    # The radio buttons name the assay ("PL1", "XXXX"), looked up case-insensitively in the registry
+    try:
+        assay = get_assay(file_type)
+    except KeyError:
+        abort(400)
+
+    # Reject files without the assay's sheets and columns before queueing the full parse
+    problems = validate(input_file, assay)
+    if problems:
+        abort(400, description=" ".join(problems))
+
+    # Keep typical uploads in memory, only large ones are saved into the job's workspace
+    job_id = JobQueue.new_job_id()
+    workspace = JobWorkspace(job_id).create()
+    input_file_name = secure_filename(input_file.filename) or "upload.xlsx"
+
+    input_file.stream.seek(0, os.SEEK_END)
+    upload_size = input_file.stream.tell()
+    input_file.stream.seek(0)
+
+    if upload_size > app.config['UPLOAD_SPILL_THRESHOLD']:
+        uploaded_file = workspace.input_path(input_file_name)
+        input_file.save(uploaded_file)
+    else:
+        uploaded_file = input_file.read()
+
+    remove_expired_workspaces()
+
+    # The parsed plate is identified by the workbook contents, the outputs by the plate and the analysis parameters
+    plate_id = ResultCache.make_key(uploaded_file, get_plate_parameters(assay))
+    cache_key = get_cache_key(plate_id, options, assay)
+
+    response = start_job(job_id, workspace, input_file_name, plate_id, assay, cache_key,
+                         run_analysis_job, job_id, uploaded_file, input_file_name, assay.name, plate_id, options, cache_key,
+                         outputs=options.get('outputs'), formats=options.get('formats'))
+
+    if wants_json():
+        return get_job_json_response(job_id, response[1])
+
+    return response
+
+@app.route('/plates/<plate_id>/reanalyse', methods=['POST'])
+def reanalyse_plate(plate_id):
+    # Re-run the statistics on a previously parsed plate with new thresholds, without reading the workbook again
+    values = request.get_json(silent=True) or request.form
+    options = get_analysis_options(values)
+
+    try:
+        assay = get_assay(values.get('assay'))
+    except KeyError:
+        abort(400)
+
+    try:
+        if not plate_store.contains(plate_id):
+            abort(404)
+    except ValueError:
+        abort(404)
+
+    job_id = JobQueue.new_job_id()
+    workspace = JobWorkspace(job_id).create()
+    input_file_name = values.get('input_file_name') or f"plate {plate_id[:12]}"
+    cache_key = get_cache_key(plate_id, options, assay)
+
+    remove_expired_workspaces()
+
+    response = start_job(job_id, workspace, input_file_name, plate_id, assay, cache_key,
+                         run_reanalysis_job, job_id, plate_id, input_file_name, assay.name, options, cache_key,
+                         outputs=options.get('outputs'), formats=options.get('formats'))
+
+    if request.is_json:
+        return get_job_json_response(job_id, response[1])
+
+    return response
+
+def get_job_json_response(job_id, status_code):
+    # The job's status and where to poll it, for clients that asked for JSON
+    status = get_job_status(job_id)
+    status.pop('result', None)
+
+    return jsonify(dict(status, status_url=url_for('job_status', job_id=job_id),
+                        result_url=url_for('job_result', job_id=job_id))), status_code
+
+def get_cached_result(job_id, workspace, input_file_name, plate_id, assay, cache_key, outputs=None, formats=None):
+    # Outputs already computed for the same plate and parameters are answered from the cache
+    if cache_key is None or result_cache.get(cache_key, workspace) is None:
+        return None
+
+    workspace.cleanup_inputs()
+    result = get_job_result(input_file_name, plate_id, assay.name, outputs, formats)
+    workspace.write_manifest({'job_id': job_id, 'status': JobQueue.STATUS_FINISHED, 'result': result})
+    metrics_registry.record_job('cached')
+
+    return result
+
+def start_job(job_id, workspace, input_file_name, plate_id, assay, cache_key, job_function, *job_args, outputs=None, formats=None,
+              keep_inputs=False):
+    result = get_cached_result(job_id, workspace, input_file_name, plate_id, assay, cache_key, outputs, formats)
+    if result is not None:
+        return render_template('download.html',
+                               job_id=job_id,
+                               status=JobQueue.STATUS_FINISHED,
+                               input_file_name=result['input_file_name'],
+                               output_file_names=result['output_file_names'],
+                               plate_id=plate_id,
+                               assay=assay.name), 200
+
+    # Run the analysis on the worker pool; the download page polls for the result
+    try:
+        workspace.write_manifest({'job_id': job_id, 'status': JobQueue.STATUS_QUEUED})
+        job_queue.submit(job_function, *job_args, job_id=job_id, on_done=record_job_metrics)
+    except QueueFullError as e:
+        metrics_registry.record_job('rejected')
+        # Chunked uploads keep their workbook, so the analysis can be started again without sending it again
+        if not keep_inputs:
+            workspace.cleanup_inputs()
+        workspace.write_manifest({'job_id': job_id, 'status': JobQueue.STATUS_FAILED, 'error': str(e)})
+        return render_template('download.html', input_file_name=input_file_name, status=JobQueue.STATUS_FAILED, error=str(e)), 503
+
+    return render_template('download.html',
+                           input_file_name=input_file_name,
+                           job_id=job_id,
+                           status=JobQueue.STATUS_QUEUED), 202
+
+def get_analysis_options(values):
+    # Optional overrides of the outlier cutoff multiplier and of the hit z-score threshold
+    options = {}
+
+    for name in ('cutoff_multiplier', 'hit_threshold'):
+        value = values.get(name)
+        if value in (None, ''):
+            continue
+        try:
+            options[name] = float(value)
+        except (TypeError, ValueError):
+            abort(400)
+
+    # Rounds of outlier clipping, 1 being the single cutoff of the original analysis
+    clip_iterations = values.get('clip_iterations')
+    if clip_iterations not in (None, ''):
+        try:
+            options['clip_iterations'] = int(clip_iterations)
+        except (TypeError, ValueError):
+            abort(400)
+        if not 1 <= options['clip_iterations'] <= AnalysisEngine.MAX_CLIP_ITERATIONS:
+            abort(400)
+
+    # Fit the drift across the whole workbook (default) or per sheet
+    drift_mode = values.get('drift_mode')
+    if drift_mode not in (None, ''):
+        if drift_mode not in AnalysisEngine.DRIFT_MODES:
+            abort(400)
+        options['drift_mode'] = drift_mode
+
+    # Campaign the plate belongs to, and whether its z-scores are taken against the whole campaign
+    campaign = (values.get('campaign') or '').strip()
+    if campaign:
+        options['campaign'] = campaign
+
+    normalisation = values.get('normalisation')
+    if normalisation not in (None, ''):
+        if normalisation not in AnalysisEngine.NORMALISATIONS or (normalisation == AnalysisEngine.NORMALISE_CAMPAIGN and not campaign):
+            abort(400)
+        options['normalisation'] = normalisation
+
+    # Outputs to produce, all of them when none is selected
+    outputs = values.getlist('outputs') if hasattr(values, 'getlist') else values.get('outputs')
+    if outputs:
+        if isinstance(outputs, str):
+            outputs = [outputs]
+        if any(output not in OUTPUTS for output in outputs):
+            abort(400)
+        # Kept in OUTPUTS order, so the download links do not depend on the order of the form fields
+        options['outputs'] = [output for output in OUTPUTS if output in outputs]
+
+    # Formats of the job's own outputs, xlsx when none is selected
+    formats = values.getlist('formats') if hasattr(values, 'getlist') else values.get('formats')
+    if formats:
+        if isinstance(formats, str):
+            formats = [formats]
+        if any(file_format not in FORMATS for file_format in formats):
+            abort(400)
+        options['formats'] = [file_format for file_format in FORMATS if file_format in formats]
+
+    return options
+
+def get_cache_key(plate_id, options, assay):
+    # Campaign normalised outputs depend on the plates analysed before, so they are never served from the cache
+    if options.get('normalisation') == AnalysisEngine.NORMALISE_CAMPAIGN:
+        return None
+
+    return ResultCache.make_key(plate_id.encode(), get_analysis_parameters(options, assay))
+
+def get_plate_parameters(assay):
+    # Everything besides the workbook contents that determines the parsed plate
+    return {
+        'assay': assay.name,
+        'sheet1': assay.sheet_names[0],
+        'sheet2': assay.sheet_names[1],
+        'renamed_columns': assay.renamed_columns,
+        'sheet_column': AnalysisEngine.SHEET_COLUMN,
+    }
+
+def get_analysis_parameters(options, assay):
+    # Everything besides the parsed plate that determines the outputs of a job
+    return {
+        'final_sheet': "Analysis",
+        'channels': [[channel.name, channel.numerator, channel.denominator, channel.cutoff_multiplier, channel.hit_threshold]
+                     for channel in assay.channels],
+        'viability': [[viability.name, viability.column, viability.gate_channel, viability.hit_threshold]
+                      for viability in assay.viability],
+        'cutoff_multiplier': options.get('cutoff_multiplier', AnalysisEngine.CUTOFF_MULTIPLIER),
+        'hit_threshold': options.get('hit_threshold', AnalysisEngine.HIT_THRESHOLD),
+        'drift_mode': options.get('drift_mode', AnalysisEngine.DRIFT_GLOBAL),
+        'clip_iterations': options.get('clip_iterations', AnalysisEngine.CLIP_ITERATIONS),
+        'campaign': options.get('campaign'),
+        'normalisation': options.get('normalisation', AnalysisEngine.NORMALISE_PLATE),
+        'formats': options.get('formats', [XLSX_FORMAT]),
+    }
+
+def get_job_result(input_file_name, plate_id=None, assay_name=None, outputs=None, formats=None):
+    # The job's own outputs are listed in every requested format, the history workbooks are always xlsx
+    output_file_names = []
+    for output in outputs or OUTPUTS:
+        for file_format in (formats or [XLSX_FORMAT]) if output in JOB_EXPORTS else [XLSX_FORMAT]:
+            output_file_names.append(get_output_file_name(output, file_format))
+
+    return {
+        'input_file_name': input_file_name,
+        'output_file_names': output_file_names,
+        'plate_id': plate_id,
+        'assay': assay_name,
+    }
+
+def record_job_metrics(future):
+    # Runs in the web process, the trace comes back with the result from thread and process workers alike
+    if future.cancelled() or future.exception() is not None:
+        metrics_registry.record_job(JobQueue.STATUS_FAILED)
+    else:
+        metrics_registry.record_job(JobQueue.STATUS_FINISHED, future.result().get('trace'))
+
+def run_job(job_id, cache_key, generate):
+    workspace = JobWorkspace(job_id)
+    workspace.write_manifest({'job_id': job_id, 'status': JobQueue.STATUS_RUNNING})
+    trace = JobTrace(job_id, trace_memory=app.config['TRACE_MEMORY'])
+
+    try:
+        result = generate(workspace, trace)
+    except Exception as e:
+        workspace.write_manifest({'job_id': job_id, 'status': JobQueue.STATUS_FAILED, 'error': str(e)})
+        raise
+    finally:
+        trace.stop_memory_trace()
+        # Remove this job's spilled upload only, other jobs may still be reading theirs
+        workspace.cleanup_inputs()
+
+    # Keep the job's own outputs for repeated requests; the history workbooks are always rendered from the store
+    output_paths = {file_name: workspace.output_path(file_name) for file_name in result['output_file_names']
+                    if file_name not in HISTORY_VIEWS}
+    if cache_key is not None and output_paths and all(os.path.isfile(path) for path in output_paths.values()):
+        result_cache.put(cache_key, output_paths)
+
+    # The job's stage timings, rows, bytes and peak memory, also served at /jobs/<job_id>/trace
+    result['trace'] = trace.to_dict()
+    workspace.write_manifest({'job_id': job_id, 'status': JobQueue.STATUS_FINISHED, 'result': result})
+
+    return result
+
+def run_analysis_job(job_id, uploaded_file, input_file_name, assay_name, plate_id=None, options=None, cache_key=None):
+    # Jobs receive the assay name so they stay picklable for the process pool
+    assay = get_assay(assay_name)
+    plate_parameters = get_plate_parameters(assay)
+    sheet1 = plate_parameters['sheet1']
+    sheet2 = plate_parameters['sheet2']
+    final_sheet = get_analysis_parameters(options or {}, assay)['final_sheet']
+
+    def generate(workspace, trace):
+        # Generate the Excel files of the assay's channels using your processing function
+        generate_files_phl_bl1_yemk_vl1(uploaded_file, sheet1, sheet2, final_sheet, workspace, input_file_name, plate_id,
+                                        assay=assay, trace=trace, **(options or {}))
+
+        return get_job_result(input_file_name, plate_id, assay.name, (options or {}).get('outputs'), (options or {}).get('formats'))
+
+    return run_job(job_id, cache_key, generate)
 
-    validate(input_file,file_type)
+def run_workbook_job(file_path, assay, options=None):
+    """
+    Analyse a workbook on disk as a job of its own, outside of a request, e.g. for the watch-folder daemon.
 
-    sheet1 = "Samples"
-    sheet2 = "High Controls"
-    final_sheet = "Analysis"
+    The job runs in the calling thread, with the same workspace, manifest, result cache and results
+    store as an upload, so its outputs can be downloaded from /jobs/<job_id>/result.
 
-    # Save the uploaded Excel file
-    uploaded_file_path = os.path.join("uploads", input_file.filename)
-    input_file.save(uploaded_file_path)
+    Parameters:
+    - file_path (str): The workbook.
+    - assay (AssaySpec): The assay of the workbook.
+    - options (dict): Analysis options, as returned by get_analysis_options.
 
-    if file_type == "pl1":
-        # Generate the Excel phl_bl1_yemk_vl1 files using your processing function
-        generate_files_phl_bl1_yemk_vl1(uploaded_file_path, sheet1, sheet2, final_sheet)
-    elif file_type == "XXXX":
-        # Generate the Excel XXXX files using your processing function
-        generate_files_phl_bl1_yemk_vl1(uploaded_file_path, sheet1, sheet2, final_sheet)
+    Returns:
+    - tuple: The job id and the job result.
+    """
+    options = options or {}
+    job_id = JobQueue.new_job_id()
+    workspace = JobWorkspace(job_id).create()
+    input_file_name = os.path.basename(file_path)
 
-    # Clear the contents of the "uploads" folder
-    clear_uploads_folder()
+    plate_id = ResultCache.make_key(file_path, get_plate_parameters(assay))
+    cache_key = get_cache_key(plate_id, options, assay)
+
+    result = get_cached_result(job_id, workspace, input_file_name, plate_id, assay, cache_key,
+                               options.get('outputs'), options.get('formats'))
+    if result is None:
+        result = run_analysis_job(job_id, file_path, input_file_name, assay.name, plate_id, options, cache_key)
+
+    return job_id, result
+
+def run_reanalysis_job(job_id, plate_id, input_file_name, assay_name, options=None, cache_key=None):
+    assay = get_assay(assay_name)
+    final_sheet = get_analysis_parameters(options or {}, assay)['final_sheet']
+
+    def generate(workspace, trace):
+        with trace.stage('load_plate'):
+            plate_df = plate_store.load(plate_id)
+        if plate_df is None:
+            raise FileNotFoundError(f"Plate {plate_id} is no longer available, please upload the workbook again")
+
+        # Threshold tuning runs are not recorded in the results history
+        analyse_plate(plate_df, final_sheet, workspace, assay=assay, trace=trace, **(options or {}))
+
+        return get_job_result(input_file_name, plate_id, assay.name, (options or {}).get('outputs'), (options or {}).get('formats'))
+
+    return run_job(job_id, cache_key, generate)
+
+def get_job_status(job_id):
+    # Jobs queued by this process are tracked in memory, the workspace manifest covers jobs of other workers
+    status = job_queue.get_status(job_id)
+
+    if status is None:
+        try:
+            status = JobWorkspace(job_id).read_manifest()
+        except ValueError:
+            return None
+
+    return status
+
+def remove_expired_workspaces():
+    max_age_seconds = app.config['OUTPUT_RETENTION_SECONDS']
+    JobWorkspace.remove_expired(JobWorkspace.UPLOADS_ROOT, max_age_seconds)
+    JobWorkspace.remove_expired(JobWorkspace.DOWNLOADS_ROOT, max_age_seconds)
+
+@app.route('/campaigns/<campaign>/stats')
+def campaign_stats(campaign):
+    aggregates = ResultsStore(RESULTS_DB_PATH).get_campaign_stats(campaign)
+
+    if not aggregates:
+        abort(404)
+
+    return jsonify({channel: stats.to_dict() for channel, stats in aggregates.items()})
+
+@app.route('/metrics')
+def metrics():
+    # Queue gauges help size ANALYSIS_WORKERS: pending jobs above the worker count are waiting
+    gauges = {
+        'workers': ("Analysis jobs run at once.", job_queue.max_workers),
+        'pending_jobs': ("Analysis jobs queued or running.", job_queue.get_pending_count()),
+    }
+
+    return Response(metrics_registry.render(gauges), mimetype=MetricsRegistry.CONTENT_TYPE)
+
+@app.route('/jobs/<job_id>/trace')
+def job_trace(job_id):
+    status = get_job_status(job_id)
+
+    # Only jobs that ran to completion have a trace, outputs served from the cache do not
+    if status is None or 'trace' not in (status.get('result') or {}):
+        abort(404)
+
+    return jsonify(status['result']['trace'])
+
+@app.route('/api/hits')
+def query_hits():
+    # Hits of every recorded run, filtered by ?channel=, ?well=, ?min_z=, ?max_z=, ?start=, ?end=, ?plate_id=, ?run_id=
+    # and paged with ?limit= and the ?cursor= of the previous page; ?hits_only=0 includes the wells that did not hit
+    args = request.args
+
+    try:
+        min_z = float(args['min_z']) if args.get('min_z') else None
+        max_z = float(args['max_z']) if args.get('max_z') else None
+        run_id = int(args['run_id']) if args.get('run_id') else None
+        limit = int(args.get('limit') or 100)
+
+        page = ResultsStore(RESULTS_DB_PATH).query_scores(channel=args.get('channel') or None,
+                                                          well_number=args.get('well') or None,
+                                                          min_z=min_z,
+                                                          max_z=max_z,
+                                                          start=args.get('start') or None,
+                                                          end=args.get('end') or None,
+                                                          plate_id=args.get('plate_id') or None,
+                                                          run_id=run_id,
+                                                          hits_only=args.get('hits_only', '1').lower() not in ('0', 'false', 'no'),
+                                                          limit=limit,
+                                                          cursor=args.get('cursor') or None)
+    except ValueError:
+        abort(400)
+
+    if page['next_cursor'] is not None:
+        page['next_url'] = url_for('query_hits', **dict(args.items(), cursor=page['next_cursor']))
+
+    return jsonify(page)
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify(result_cache.get_stats())
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    status = get_job_status(job_id)
+
+    if status is None:
+        abort(404)
+
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    status = get_job_status(job_id)
+
+    if status is None:
+        abort(404)
+
+    if status['status'] == JobQueue.STATUS_FAILED:
+        return render_template('download.html', job_id=job_id, status=status['status'], error=status['error']), 500
+
+    if status['status'] != JobQueue.STATUS_FINISHED:
+        return render_template('download.html', job_id=job_id, status=status['status']), 202
 
     # Provide download links on the webpage
-    return render_template('download.html', 
-                           input_file_name=input_file.filename,
-                           output_file_names=["LC2-032_KCP1 pHL-YEMK DC 20231030.xlsx", "All_P_YEMK_pHL_Live.xlsx", "All_hits.xlsx"])
+    return render_template('download.html',
+                           job_id=job_id,
+                           status=status['status'],
+                           input_file_name=status['result']['input_file_name'],
+                           output_file_names=status['result']['output_file_names'],
+                           plate_id=status['result'].get('plate_id'),
+                           assay=status['result'].get('assay'))
 
 @app.route('/download_file')
 def download_file():
     filename = request.args.get('filename')
-    file_path = os.path.join("downloads", filename)
 
-    if os.path.exists(file_path):
-        return send_file(file_path, as_attachment=True)
-    else:
+    if not filename:
         abort(404)
 
-def clear_uploads_folder():
-    # Define the path to the "uploads" folder
-    uploads_folder_path = "uploads"
-
-    # Check if the folder exists
-    if os.path.exists(uploads_folder_path):
-        # Iterate over the files in the folder and remove them
-        for file_name in os.listdir(uploads_folder_path):
-            file_path = os.path.join(uploads_folder_path, file_name)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            except Exception as e:
-                print(f"Failed to delete {file_path}. Reason: {e}")
-    else:
-        print("The 'uploads' folder does not exist.")
+    if filename in HISTORY_VIEWS:
+        return download_history_view(filename)
+
+    # Job outputs live in the job's workspace
+    try:
+        workspace = JobWorkspace(request.args.get('job_id', ''))
+    except ValueError:
+        abort(404)
+
+    # Published outputs never change, so clients revalidate with If-None-Match and resume with Range
+    file_format = TableFormats.get_format(filename)
+    mimetype = TableFormats.MEDIA_TYPES[file_format] if file_format else None
+
+    return send_from_directory(workspace.output_dir, filename, as_attachment=True, mimetype=mimetype, conditional=True, etag=True)
+
+def get_history_etag(filename, runs_df):
+    # Recorded runs never change, so a history workbook is identified by the runs it shows
+    run_ids = runs_df['run_id'].tolist()
+    digest = hashlib.sha256(json.dumps([filename, run_ids]).encode()).hexdigest()
+
+    return digest[:32]
+
+def download_history_view(filename):
+    # Render the history workbook from the results store, optionally limited by ?start=, ?end= and ?runs=1,2,3
+    view, base_sheet_name = HISTORY_VIEWS[filename]
+    runs = request.args.get('runs')
+    results_store = ResultsStore(RESULTS_DB_PATH)
+
+    try:
+        run_ids = [int(run_id) for run_id in runs.split(',')] if runs else None
+        runs_df = results_store.select_runs(start=request.args.get('start'), end=request.args.get('end'), run_ids=run_ids)
+    except ValueError:
+        abort(400)
+
+    # Answer polls for an unchanged history without rendering it; weak as the xlsx bytes are not reproducible
+    etag = get_history_etag(filename, runs_df)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    sheets = results_store.generate_run_sheets(runs_df, view, base_sheet_name)
+
+    if app.config['STREAM_DOWNLOADS'] and request.range is None:
+        # Send the workbook while it is being written
+        chunks = iter_counted(StreamingExcelWriter.iter_workbook_chunks(sheets), 'render_history', metrics_registry)
+        response = Response(stream_with_context(chunks),
+                            mimetype=StreamingExcelWriter.CONTENT_TYPE,
+                            headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+        response.set_etag(etag, weak=True)
+        return response
+
+    # Otherwise, and for Range requests, spool the workbook to a temporary file first so the response has a Content-Length
+    excel_file = tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024)
+    started = time.perf_counter()
+    StreamingExcelWriter.write_frames(excel_file, sheets)
+    metrics_registry.observe_stage('render_history', time.perf_counter() - started)
+    length = excel_file.tell()
+    metrics_registry.add_bytes_written(length)
+    excel_file.seek(0)
+
+    response = send_file(excel_file, as_attachment=True, download_name=filename, mimetype=StreamingExcelWriter.CONTENT_TYPE,
+                         etag=False)
+    response.set_etag(etag, weak=True)
+    response.content_length = length
+
+    # If-Range needs a strong ETag: resuming against an earlier render gets the whole workbook again (200), not bytes
+    # spliced from two renders whose timestamps differ
+    if 'If-Range' in request.headers:
+        return response
+
+    # Answer a Range with 206 and the requested bytes of this render
+    return response.make_conditional(request, accept_ranges=True, complete_length=length)
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    # Start a chunked upload: the file name and analysis settings are checked now, the workbook once it is assembled
+    values = request.get_json(silent=True) or request.form
+
+    try:
+        options = get_analysis_options(values)
+    except HTTPException:
+        return get_upload_error(400, "Invalid analysis options, e.g. a threshold that is not a number or an unknown output.")
+
+    try:
+        assay = get_assay(values.get('selected_radio_id'))
+    except KeyError:
+        return get_upload_error(400, f"Unknown assay: {values.get('selected_radio_id')!r}")
+
+    file_name = secure_filename(values.get('file_name') or '')
+    problems = validate_file_name(file_name, assay)
+    if problems:
+        return get_upload_error(400, " ".join(problems))
+
+    try:
+        size = int(values.get('size'))
+    except (TypeError, ValueError):
+        return get_upload_error(400, "size must be the workbook's size in bytes")
+    if size <= 0:
+        return get_upload_error(400, "The workbook is empty")
+    if size > app.config['UPLOAD_MAX_BYTES']:
+        return get_upload_error(413, f"The workbook is larger than {app.config['UPLOAD_MAX_BYTES']} bytes")
+
+    sha256 = values.get('sha256')
+    if sha256 and (len(sha256) != 64 or any(character not in '0123456789abcdefABCDEF' for character in sha256)):
+        return get_upload_error(400, "sha256 must be the hex digest of the workbook")
+
+    remove_expired_workspaces()
+
+    # The upload id is the id of the job that will analyse it
+    job_id = JobQueue.new_job_id()
+    workspace = JobWorkspace(job_id).create()
+    upload = ChunkedUpload(workspace)
+    manifest = upload.create(file_name, size, sha256, {'assay': assay.name, 'options': options})
+
+    return jsonify(dict(upload.get_status(manifest),
+                        chunk_size=app.config['UPLOAD_CHUNK_BYTES'],
+                        upload_url=url_for('upload_chunk', upload_id=job_id))), 201
+
+def get_upload_error(status_code, message):
+    # The upload API always answers in JSON, so clients can show the reason
+    return jsonify({'error': message}), status_code
+
+def get_upload(upload_id):
+    # None for an id that cannot be an upload
+    try:
+        return ChunkedUpload(JobWorkspace(upload_id))
+    except ValueError:
+        return None
+
+def get_upload_job_response(upload_id, status_code=200):
+    # An assembled upload answers with its job, like a JSON re-analysis request
+    status = get_job_status(upload_id) or {'job_id': upload_id, 'status': JobQueue.STATUS_QUEUED}
+    status.pop('result', None)
+
+    return jsonify(dict(status, upload_id=upload_id,
+                        status_url=url_for('job_status', job_id=upload_id),
+                        result_url=url_for('job_result', job_id=upload_id))), status_code
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    # Where to resume from: the number of bytes received so far
+    upload = get_upload(upload_id)
+    manifest = upload.load() if upload is not None else None
+
+    if manifest is None:
+        # Uploads are removed once their job has read them
+        if upload is None or get_job_status(upload_id) is None:
+            return get_upload_error(404, f"Unknown upload {upload_id}")
+        return get_upload_job_response(upload_id)
+
+    return jsonify(dict(upload.get_status(manifest), chunk_size=app.config['UPLOAD_CHUNK_BYTES']))
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    # Append one chunk, sent with "Upload-Offset: <offset>" and "Upload-Checksum: sha256|crc32 <digest>" headers
+    upload = get_upload(upload_id)
+    if upload is None:
+        return get_upload_error(404, f"Unknown upload {upload_id}")
+
+    if upload.load() is None:
+        if get_job_status(upload_id) is None:
+            return get_upload_error(404, f"Unknown upload {upload_id}")
+        # The last chunk again, its response was lost after the job started
+        return get_upload_job_response(upload_id)
+
+    if request.content_length is None:
+        return get_upload_error(411, "Chunks must be sent with a Content-Length")
+    if request.content_length > app.config['UPLOAD_CHUNK_BYTES']:
+        return get_upload_error(413, f"Chunks are at most {app.config['UPLOAD_CHUNK_BYTES']} bytes")
+
+    try:
+        offset = int(request.headers['Upload-Offset'])
+        checksum = ChunkedUpload.parse_checksum(request.headers.get('Upload-Checksum'))
+    except KeyError:
+        return get_upload_error(400, "Upload-Offset header is required")
+    except ValueError as e:
+        return get_upload_error(400, str(e))
+
+    try:
+        offset, completed = upload.append(offset, request.get_data(cache=False), checksum)
+    except UploadOffsetError as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except UploadChecksumError as e:
+        return get_upload_error(422, str(e))
+    except ValueError as e:
+        return get_upload_error(400, str(e))
+    except FileNotFoundError:
+        return get_upload_error(404, f"Unknown upload {upload_id}")
+
+    # The analysis starts as soon as the last chunk is in
+    if completed:
+        return start_upload_job(upload_id, upload)
+
+    manifest = upload.load()
+    if manifest is not None and manifest['status'] == ChunkedUpload.STATUS_COMPLETE:
+        return get_upload_job_response(upload_id)
+
+    return jsonify({'upload_id': upload_id, 'offset': offset, 'status': ChunkedUpload.STATUS_RECEIVING})
+
+@app.route('/uploads/<upload_id>/analyse', methods=['POST'])
+def analyse_upload(upload_id):
+    # Start the analysis of an assembled upload again, e.g. after the queue was full
+    upload = get_upload(upload_id)
+    manifest = upload.load() if upload is not None else None
+
+    if manifest is None or manifest['status'] != ChunkedUpload.STATUS_COMPLETE:
+        return get_upload_error(404, f"No complete upload {upload_id}")
+
+    status = get_job_status(upload_id)
+    if status is not None and status['status'] != JobQueue.STATUS_FAILED:
+        return get_upload_job_response(upload_id)
+
+    return start_upload_job(upload_id, upload)
+
+def start_upload_job(upload_id, upload):
+    manifest = upload.load()
+    assay = get_assay(manifest['settings']['assay'])
+    options = manifest['settings']['options']
+    file_path = upload.get_file_path(manifest)
+    input_file_name = manifest['file_name']
+
+    # The sheets and header row can only be checked on the assembled workbook
+    problems = validate_workbook(input_file_name, file_path, assay)
+    if problems:
+        upload.workspace.cleanup_inputs()
+        return get_upload_error(400, " ".join(problems))
+
+    plate_id = ResultCache.make_key(file_path, get_plate_parameters(assay))
+    cache_key = get_cache_key(plate_id, options, assay)
+
+    response = start_job(upload_id, upload.workspace, input_file_name, plate_id, assay, cache_key,
+                         run_analysis_job, upload_id, file_path, input_file_name, assay.name, plate_id, options, cache_key,
+                         outputs=options.get('outputs'), formats=options.get('formats'), keep_inputs=True)
+
+    return get_upload_job_response(upload_id, response[1])
+
+@app.route('/probe', methods=['POST'])
+def probe():
+    # Check an upload's sheets and header row for the form, without analysing it
+    input_file = request.files.get('input_file')
+    if input_file is None:
+        abort(400)
+
+    try:
+        assay = get_assay(request.form.get('selected_radio_id'))
+    except KeyError:
+        abort(400)
+
+    problems = validate(input_file, assay)
+
+    return jsonify({'valid': not problems, 'problems': problems})
+
+def validate(input_file, assay):
+    """
+    Check an upload against an assay from its file name and xlsx manifest, reading no data rows.
+
+    Parameters:
+    - input_file (FileStorage): The uploaded workbook; its stream is rewound afterwards.
+    - assay (AssaySpec): The assay selected on the form.
+
+    Returns:
+    - list: Human readable problems, empty for a valid upload.
+    """
+    try:
+        return validate_workbook(input_file.filename or "", input_file.stream, assay)
+    finally:
+        input_file.stream.seek(0)
+
+def validate_workbook(file_name, source, assay):
+    """
+    Check a workbook's name, sheets and header row against an assay, reading no data rows.
+
+    Parameters:
+    - file_name (str): The workbook's file name.
+    - source (str or file-like): The workbook's path, or a stream of its contents.
+    - assay (AssaySpec): The assay the workbook should belong to.
+
+    Returns:
+    - list: Human readable problems, empty for a valid workbook.
+    """
+    problems = validate_file_name(file_name, assay)
+    if problems:
+        return problems
+
+    try:
+        workbook_probe = WorkbookReader.probe(source, assay.sheet_names)
+    except ValueError as e:
+        return [str(e)]
+
+    return WorkbookReader.check_structure(workbook_probe, assay.sheet_names, len(assay.renamed_columns))
+
+def validate_file_name(file_name, assay):
+    # The checks that need nothing but the file name
+    if not file_name.lower().endswith('.xlsx'):
+        return ["Invalid file type. Please upload an Excel (.xlsx) file."]
+
+    if not is_assay_file_name(file_name, assay):
+        return [f"Invalid file name: {assay.name.upper()} workbooks have \"{assay.file_keyword}\" in their name."]
+
+    return []
 
-def validate(input_file,file_type):
-    pass
+def is_assay_file_name(file_name, assay):
+    # The same check as containsValidKeyword in script.js: the keyword anywhere in the name, case sensitive
+    return assay.file_keyword in file_name
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,282 @@
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class JobTrace:
+    """
+    Stage timings and counters of one analysis job.
+
+    A trace is a plain record filled in while the job runs: the wall time of every stage,
+    the rows analysed and the bytes read and written. It is returned with the job result as
+    a dict, so traces of jobs run on a process pool reach the web process and its
+    MetricsRegistry.
+
+    With trace_memory the job's peak memory is measured with tracemalloc, which slows the
+    job down. tracemalloc is process-wide: it runs while any traced job does, and a job's
+    peak is the highest allocated memory during its run above what was allocated when it
+    started, so it includes the jobs running alongside it on a thread pool.
+    """
+
+    # The traced jobs running in this process, whose peaks are folded in before tracemalloc's peak is reset
+    memory_lock = threading.Lock()
+    memory_traces = []
+
+    def __init__(self, job_id=None, trace_memory=False):
+        self.job_id = job_id
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.stages = []
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.memory_base = None
+        self.peak_memory_bytes = None
+
+        if trace_memory:
+            self.start_memory_trace()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the body of a with block as one stage.
+
+        Parameters:
+        - name (str): The stage name, used as the metrics label.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({'name': name, 'seconds': time.perf_counter() - started})
+
+    @staticmethod
+    def fold_memory_peaks():
+        # Give every traced job the peak since the last reset, then start a new peak window
+        _, peak = tracemalloc.get_traced_memory()
+        for trace in JobTrace.memory_traces:
+            trace.peak_memory_bytes = max(trace.peak_memory_bytes, peak - trace.memory_base)
+        tracemalloc.reset_peak()
+
+    def start_memory_trace(self):
+        with self.memory_lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self.fold_memory_peaks()
+
+            self.memory_base = tracemalloc.get_traced_memory()[0]
+            self.peak_memory_bytes = 0
+            self.memory_traces.append(self)
+
+    def stop_memory_trace(self):
+        with self.memory_lock:
+            if self not in self.memory_traces:
+                return
+
+            self.fold_memory_peaks()
+            self.memory_traces.remove(self)
+
+            # Stop tracing with the last traced job, so untraced jobs run at full speed again
+            if not self.memory_traces:
+                tracemalloc.stop()
+
+    @staticmethod
+    def get_worker_peak_rss():
+        # Lifetime high water mark of the worker process's resident memory, shared by every job it ran
+        if resource is None:
+            return None
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+    def to_dict(self):
+        self.stop_memory_trace()
+
+        return {
+            'job_id': self.job_id,
+            'started_at': self.started_at,
+            'seconds': time.perf_counter() - self.started,
+            'stages': list(self.stages),
+            'rows': self.rows,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'worker_peak_rss_bytes': self.get_worker_peak_rss(),
+        }
+
+
+class MetricsRegistry:
+    """
+    Process-wide job metrics, rendered in the Prometheus text exposition format.
+
+    Stage and job durations are kept as cumulative histograms, rows and bytes as counters.
+    Every web worker process has its own registry; Prometheus sums them per instance.
+    """
+
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    # Upper bounds of the duration histogram buckets, in seconds
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    PREFIX = 'plate_analysis'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_histograms = {}
+        self.job_histogram = self.new_histogram()
+        self.jobs = {}
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.peak_memory_bytes = 0
+        self.worker_peak_rss_bytes = 0
+
+    def new_histogram(self):
+        return {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+
+    def observe(self, histogram, seconds):
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+    def observe_stage(self, name, seconds):
+        with self.lock:
+            histogram = self.stage_histograms.setdefault(name, self.new_histogram())
+            self.observe(histogram, seconds)
+
+    def add_bytes_written(self, count):
+        with self.lock:
+            self.bytes_written += count
+
+    def record_job(self, status, trace=None):
+        """
+        Add a finished or failed job.
+
+        Parameters:
+        - status (str): The final job status, used as the label of the jobs counter.
+        - trace (dict): The job's JobTrace.to_dict(), when it got far enough to return one.
+        """
+        with self.lock:
+            self.jobs[status] = self.jobs.get(status, 0) + 1
+
+            if trace is None:
+                return
+
+            self.observe(self.job_histogram, trace['seconds'])
+            for stage in trace['stages']:
+                self.observe(self.stage_histograms.setdefault(stage['name'], self.new_histogram()), stage['seconds'])
+
+            self.rows += trace['rows']
+            self.bytes_read += trace['bytes_read']
+            self.bytes_written += trace['bytes_written']
+            if trace['peak_memory_bytes'] is not None:
+                self.peak_memory_bytes = max(self.peak_memory_bytes, trace['peak_memory_bytes'])
+            if trace['worker_peak_rss_bytes'] is not None:
+                self.worker_peak_rss_bytes = max(self.worker_peak_rss_bytes, trace['worker_peak_rss_bytes'])
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+
+        # Escape the label values as the exposition format requires
+        pairs = []
+        for name, value in labels.items():
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            pairs.append(f'{name}="{value}"')
+
+        return '{' + ','.join(pairs) + '}'
+
+    def format_histogram(self, name, histogram, labels=None):
+        labels = labels or {}
+        lines = []
+        for bound, count in zip(self.BUCKETS, histogram['buckets']):
+            lines.append(f"{name}_bucket{self.format_labels(dict(labels, le=bound))} {count}")
+        lines.append(f"{name}_bucket{self.format_labels(dict(labels, le='+Inf'))} {histogram['count']}")
+        lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+        lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+
+        return lines
+
+    def render(self, gauges=None):
+        """
+        Render the metrics in the Prometheus text exposition format.
+
+        Parameters:
+        - gauges (dict): Extra point-in-time values, name -> (help text, value), e.g. the queue depth.
+
+        Returns:
+        - str: The exposition text.
+        """
+        prefix = self.PREFIX
+        lines = []
+
+        with self.lock:
+            lines += [f"# HELP {prefix}_stage_seconds Wall time of each stage of the analysis jobs.",
+                      f"# TYPE {prefix}_stage_seconds histogram"]
+            for name in sorted(self.stage_histograms):
+                lines += self.format_histogram(f"{prefix}_stage_seconds", self.stage_histograms[name], {'stage': name})
+
+            lines += [f"# HELP {prefix}_job_seconds Wall time of the analysis jobs.",
+                      f"# TYPE {prefix}_job_seconds histogram"]
+            lines += self.format_histogram(f"{prefix}_job_seconds", self.job_histogram)
+
+            lines += [f"# HELP {prefix}_jobs_total Analysis jobs by final status.",
+                      f"# TYPE {prefix}_jobs_total counter"]
+            for status in sorted(self.jobs):
+                lines.append(f"{prefix}_jobs_total{self.format_labels({'status': status})} {self.jobs[status]}")
+
+            counters = [
+                ('rows_total', "Plate rows analysed.", self.rows),
+                ('read_bytes_total', "Bytes of uploaded workbooks read.", self.bytes_read),
+                ('written_bytes_total', "Bytes of workbooks written.", self.bytes_written),
+            ]
+            for name, help_text, value in counters:
+                lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} counter", f"{prefix}_{name} {value}"]
+
+            lines += [f"# HELP {prefix}_job_peak_memory_bytes Highest peak memory allocated during one job, measured with TRACE_MEMORY only.",
+                      f"# TYPE {prefix}_job_peak_memory_bytes gauge",
+                      f"{prefix}_job_peak_memory_bytes {self.peak_memory_bytes}"]
+
+            lines += [f"# HELP {prefix}_worker_peak_resident_bytes Highest lifetime peak resident memory of a process that ran jobs.",
+                      f"# TYPE {prefix}_worker_peak_resident_bytes gauge",
+                      f"{prefix}_worker_peak_resident_bytes {self.worker_peak_rss_bytes}"]
+
+        for name, (help_text, value) in (gauges or {}).items():
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} gauge", f"{prefix}_{name} {value}"]
+
+        return "\n".join(lines) + "\n"
+
+
+def iter_counted(chunks, stage_name, registry):
+    """
+    Pass a streamed response body through, recording its bytes and the time it took to produce.
+
+    Parameters:
+    - chunks (iterable): The response body chunks.
+    - stage_name (str): The stage the time is recorded under.
+    - registry (MetricsRegistry): Where to record it.
+
+    Returns:
+    - generator: The same chunks.
+    """
+    started = time.perf_counter()
+    byte_count = 0
+    try:
+        for chunk in chunks:
+            byte_count += len(chunk)
+            yield chunk
+    finally:
+        registry.observe_stage(stage_name, time.perf_counter() - started)
+        registry.add_bytes_written(byte_count)
@@ -0,0 +1,126 @@
+import os
+import tempfile
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+class PlateStore:
+    """
+    On-disk store of parsed plates, keyed by the hash of the uploaded workbook.
+
+    A plate is the cleaned, renamed DataFrame from prepare_analysis_df, saved as an
+    uncompressed Arrow IPC file that is memory-mapped on load. Re-analysing a plate with
+    other thresholds therefore skips Excel parsing entirely. Without pyarrow installed the
+    plates are pickled instead.
+    """
+
+    def __init__(self, store_dir, max_entries=512):
+        self.store_dir = store_dir
+        self.max_entries = max_entries
+
+    @staticmethod
+    def get_extension():
+        return '.arrow' if pa is not None else '.pkl'
+
+    def plate_path(self, plate_id):
+        # Plate ids are hex digests, so they are safe to use as file names
+        if not plate_id or not all(character in '0123456789abcdef' for character in plate_id):
+            raise ValueError(f"Invalid plate id: {plate_id!r}")
+
+        return os.path.join(self.store_dir, plate_id + self.get_extension())
+
+    def contains(self, plate_id):
+        return os.path.isfile(self.plate_path(plate_id))
+
+    def save(self, plate_id, plate_df):
+        """
+        Persist a parsed plate.
+
+        Parameters:
+        - plate_id (str): The plate id.
+        - plate_df (pd.DataFrame): The cleaned, renamed plate.
+
+        Returns:
+        - str: The path of the saved plate.
+        """
+        final_path = self.plate_path(plate_id)
+
+        # The store directory is created with its first plate
+        os.makedirs(self.store_dir, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='.', dir=self.store_dir)
+        os.close(file_descriptor)
+
+        try:
+            if pa is not None:
+                table = pa.Table.from_pandas(plate_df, preserve_index=False)
+                with pa.OSFile(temp_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            else:
+                plate_df.to_pickle(temp_path)
+
+            os.replace(temp_path, final_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+        self.evict()
+
+        return final_path
+
+    def load(self, plate_id):
+        """
+        Load a parsed plate.
+
+        Parameters:
+        - plate_id (str): The plate id.
+
+        Returns:
+        - pd.DataFrame: The plate, or None when it is not in the store.
+        """
+        path = self.plate_path(plate_id)
+
+        try:
+            if pa is not None:
+                with pa.memory_map(path, 'r') as source:
+                    plate_df = pa.ipc.open_file(source).read_all().to_pandas()
+            else:
+                plate_df = pd.read_pickle(path)
+
+            # Mark the plate as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return plate_df
+
+    def evict(self):
+        """
+        Remove the least recently used plates beyond max_entries.
+
+        Returns:
+        - int: The number of plates removed.
+        """
+        plates = []
+        for entry in os.scandir(self.store_dir):
+            if entry.is_file() and not entry.name.startswith('.'):
+                try:
+                    plates.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+
+        plates.sort()
+        expired = plates[:max(len(plates) - self.max_entries, 0)]
+
+        for _, path in expired:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+        return len(expired)
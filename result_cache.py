@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+
+class ResultCache:
+    """
+    Bounded on-disk cache of analysis outputs keyed by upload contents and parameters.
+
+    Each entry is a directory named after the SHA-256 of the uploaded bytes and the
+    analysis parameters. Entries are published with an atomic rename and evicted least
+    recently used first once the cache exceeds max_bytes or max_entries.
+    """
+
+    # Bump when a change to the analysis makes previously cached outputs stale
+    CACHE_VERSION = 1
+
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024, max_entries=256):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(source, parameters):
+        """
+        Hash an upload together with the parameters it is analysed with.
+
+        Parameters:
+        - source (str or bytes): The path to the uploaded workbook, or its contents.
+        - parameters (dict): JSON serialisable analysis parameters.
+
+        Returns:
+        - str: The hex digest identifying the cache entry.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps({'cache_version': ResultCache.CACHE_VERSION, 'parameters': parameters}, sort_keys=True).encode())
+
+        if isinstance(source, (bytes, bytearray)):
+            digest.update(source)
+        else:
+            with open(source, 'rb') as source_file:
+                for chunk in iter(lambda: source_file.read(ResultCache.HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+
+        return digest.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, key, workspace):
+        """
+        Copy the cached outputs of an entry into a job workspace.
+
+        Parameters:
+        - key (str): The cache key.
+        - workspace (JobWorkspace): The workspace to publish the outputs to.
+
+        Returns:
+        - dict: The manifest stored with the entry, or None on a miss.
+        """
+        entry_dir = self.entry_dir(key)
+
+        try:
+            with open(os.path.join(entry_dir, 'manifest.json')) as manifest_file:
+                manifest = json.load(manifest_file)
+
+            for filename in manifest['files']:
+                cached_path = os.path.join(entry_dir, filename)
+                workspace.publish(filename, lambda temp_path: shutil.copyfile(cached_path, temp_path))
+
+            # Mark the entry as recently used
+            os.utime(entry_dir)
+        except (FileNotFoundError, KeyError, ValueError):
+            # Missing, or evicted by another worker while being read
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+
+        return manifest
+
+    def put(self, key, files, metadata=None):
+        """
+        Store outputs under a key.
+
+        Parameters:
+        - key (str): The cache key.
+        - files (dict): Output file name -> path of the file to cache.
+        - metadata (dict): Extra JSON serialisable data stored in the manifest.
+
+        Returns:
+        - None
+        """
+        entry_dir = self.entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+
+        # Build the entry next to its final location and rename it into place; the cache directory is created on first use
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='.', dir=self.cache_dir)
+        try:
+            for filename, path in files.items():
+                shutil.copyfile(path, os.path.join(temp_dir, filename))
+
+            with open(os.path.join(temp_dir, 'manifest.json'), 'w') as manifest_file:
+                json.dump({'files': list(files), 'created_at': time.time(), **(metadata or {})}, manifest_file)
+
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # Another worker cached the same key first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            if not os.path.isdir(entry_dir):
+                raise
+
+        self.evict()
+
+    @staticmethod
+    def get_dir_size(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is within its limits.
+
+        Returns:
+        - int: The number of entries removed.
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                try:
+                    entries.append((entry.stat().st_mtime, self.get_dir_size(entry.path), entry.path))
+                except FileNotFoundError:
+                    continue
+
+        entries.sort()
+        total_bytes = sum(size for _, size, _ in entries)
+        removed = 0
+
+        while entries and (total_bytes > self.max_bytes or len(entries) > self.max_entries):
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total_bytes -= size
+            removed += 1
+
+        return removed
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
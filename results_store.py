@@ -0,0 +1,386 @@
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from running_stats import RunningStats
+
+
+class ResultsStore:
+    """
+    Local SQLite store holding the z-scores and hits of every analysis run.
+
+    Appending a run costs O(run size). The All_P_YEMK_pHL_Live and All_hits history
+    workbooks are rendered from the store on demand, one sheet per run, optionally
+    limited to a date range or a set of runs. Campaign statistics are kept as one
+    running aggregate per campaign and channel. The scores are indexed by well,
+    channel and z-score so hits across every run can be queried in milliseconds.
+    """
+
+    VIEW_PLATES = 'plates'
+    VIEW_HITS = 'hits'
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            sheet_label TEXT NOT NULL,
+            source TEXT
+        );
+        CREATE TABLE IF NOT EXISTS scores (
+            run_id INTEGER NOT NULL REFERENCES runs(run_id),
+            position INTEGER NOT NULL,
+            well_number,
+            channel_index INTEGER NOT NULL,
+            channel TEXT NOT NULL,
+            z_score REAL,
+            is_hit INTEGER NOT NULL,
+            PRIMARY KEY (run_id, position, channel_index)
+        );
+        CREATE INDEX IF NOT EXISTS runs_created_at ON runs(created_at);
+        CREATE TABLE IF NOT EXISTS campaign_stats (
+            campaign TEXT NOT NULL,
+            channel TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            m2 REAL NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (campaign, channel)
+        );
+    """
+
+    # Applied in order to stores older than their position in the list, tracked with PRAGMA user_version
+    MIGRATIONS = [
+        """
+        ALTER TABLE runs ADD COLUMN plate_id TEXT;
+        CREATE INDEX IF NOT EXISTS runs_plate_id ON runs(plate_id);
+        CREATE INDEX IF NOT EXISTS scores_well ON scores(well_number, channel);
+        CREATE INDEX IF NOT EXISTS scores_channel_z ON scores(channel, z_score);
+        CREATE INDEX IF NOT EXISTS scores_hits ON scores(run_id, position, channel_index) WHERE is_hit = 1;
+        CREATE INDEX IF NOT EXISTS scores_channel_hits ON scores(channel, run_id, position, channel_index) WHERE is_hit = 1;
+        """,
+    ]
+
+    # Largest page of query_scores
+    MAX_PAGE_SIZE = 1000
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+            self.migrate(connection)
+
+    def migrate(self, connection):
+        # Up to date stores are opened without taking the write lock
+        if connection.execute("PRAGMA user_version").fetchone()[0] >= len(self.MIGRATIONS):
+            return
+
+        # Read the version again under the write lock so concurrent workers migrate once
+        connection.execute("BEGIN IMMEDIATE")
+
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            # executescript would commit the open transaction, run the statements one by one instead
+            for statement in migration.split(';'):
+                if statement.strip():
+                    connection.execute(statement)
+            connection.execute(f"PRAGMA user_version = {number}")
+
+    @contextmanager
+    def connect(self):
+        # Commit on success, roll back on error, and always release the file handle
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def append_run(self, analysis_df, channels, source=None, plate_id=None, hit_masks=None):
+        """
+        Record the z-scores and hits of one analysis run.
+
+        Parameters:
+        - analysis_df (pd.DataFrame): The analysis DataFrame with its 'well_number' and '<channel>_z_score' columns.
+        - channels (list): The channels to record, as returned by AssaySpec.get_channel_names.
+        - source (str): Name of the uploaded file the run was computed from.
+        - plate_id (str): Id of the parsed plate, identifying runs of the same workbook.
+        - hit_masks (dict): Channel name -> boolean array of the hits, as in AnalysisResult.hit_masks. Defaults to the
+          rows whose 'hits_<channel>_z_score' is set, and then the hits columns are required.
+
+        Returns:
+        - int: The id of the new run.
+        """
+        created_at = datetime.now()
+        row_count = len(analysis_df)
+
+        positions = np.arange(row_count)
+        well_numbers = analysis_df['well_number'].tolist()
+
+        rows = []
+        for channel_index, channel in enumerate(channels):
+            # NaN z-scores become NULL
+            z_scores = analysis_df[f"{channel}_z_score"].to_numpy(dtype=np.float64)
+            if hit_masks is not None:
+                is_hit = np.asarray(hit_masks[channel], dtype=bool)
+            else:
+                is_hit = ~np.isnan(analysis_df[f"hits_{channel}_z_score"].to_numpy(dtype=np.float64))
+
+            z_values = [None if np.isnan(z) else z for z in z_scores.tolist()]
+            rows.extend(zip(positions.tolist(), well_numbers, [channel_index] * row_count, [channel] * row_count, z_values, is_hit.astype(int).tolist()))
+
+        with self.connect() as connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (created_at, sheet_label, source, plate_id) VALUES (?, ?, ?, ?)",
+                (created_at.isoformat(timespec='seconds'), created_at.strftime('%Y-%m-%d_%H-%M-%S'), source, plate_id),
+            )
+            run_id = cursor.lastrowid
+            connection.executemany(
+                "INSERT INTO scores (run_id, position, well_number, channel_index, channel, z_score, is_hit) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(run_id,) + row for row in rows],
+            )
+
+        return run_id
+
+    def get_campaign_stats(self, campaign):
+        """
+        Load the running aggregates of a campaign.
+
+        Parameters:
+        - campaign (str): The campaign name.
+
+        Returns:
+        - dict: Channel name -> RunningStats, empty for a new campaign.
+        """
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT channel, count, mean, m2 FROM campaign_stats WHERE campaign = ?", (campaign,)
+            ).fetchall()
+
+        return {channel: RunningStats(count, mean, m2) for channel, count, mean, m2 in rows}
+
+    def add_campaign_stats(self, campaign, aggregates):
+        """
+        Merge the aggregates of one plate into the running aggregates of a campaign.
+
+        Parameters:
+        - campaign (str): The campaign name.
+        - aggregates (dict): Channel name -> RunningStats of the plate.
+
+        Returns:
+        - dict: Channel name -> RunningStats of the campaign after the merge.
+        """
+        updated_at = datetime.now().isoformat(timespec='seconds')
+        merged = {}
+
+        with self.connect() as connection:
+            # Take the write lock before reading so concurrent plates are merged one after the other
+            connection.execute("BEGIN IMMEDIATE")
+
+            for channel, plate_stats in aggregates.items():
+                row = connection.execute(
+                    "SELECT count, mean, m2 FROM campaign_stats WHERE campaign = ? AND channel = ?", (campaign, channel)
+                ).fetchone()
+                merged[channel] = (RunningStats(*row) if row else RunningStats()).merge(plate_stats)
+
+                connection.execute(
+                    "INSERT OR REPLACE INTO campaign_stats (campaign, channel, count, mean, m2, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (campaign, channel, merged[channel].count, merged[channel].mean, merged[channel].m2, updated_at),
+                )
+
+        return merged
+
+    @staticmethod
+    def parse_date_bound(value, end=False):
+        # A bare date as an end bound includes the whole day
+        if value is None:
+            return None
+
+        bound = datetime.fromisoformat(value)
+        if end and len(value) == 10:
+            bound += timedelta(days=1)
+
+        return bound.isoformat(timespec='seconds')
+
+    def select_runs(self, start=None, end=None, run_ids=None):
+        """
+        List the runs within a date range and/or a set of run ids.
+
+        Parameters:
+        - start (str): ISO date or datetime of the earliest run to include.
+        - end (str): ISO date or datetime of the latest run to include.
+        - run_ids (list): Only include these runs.
+
+        Returns:
+        - pd.DataFrame: The matching runs ordered by run id.
+        """
+        conditions = []
+        parameters = []
+
+        start_bound = self.parse_date_bound(start)
+        if start_bound is not None:
+            conditions.append("created_at >= ?")
+            parameters.append(start_bound)
+
+        end_bound = self.parse_date_bound(end, end=True)
+        if end_bound is not None:
+            conditions.append("created_at < ?" if len(end) == 10 else "created_at <= ?")
+            parameters.append(end_bound)
+
+        if run_ids:
+            conditions.append(f"run_id IN ({', '.join('?' * len(run_ids))})")
+            parameters.extend(run_ids)
+
+        query = "SELECT run_id, created_at, sheet_label, source FROM runs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY run_id"
+
+        with self.connect() as connection:
+            return pd.read_sql_query(query, connection, params=parameters)
+
+    @staticmethod
+    def format_cursor(row):
+        return f"{row['run_id']}.{row['position']}.{row['channel_index']}"
+
+    @staticmethod
+    def parse_cursor(cursor):
+        # The cursor is the (run_id, position, channel_index) key of the last row of the previous page
+        parts = cursor.split('.')
+        if len(parts) != 3:
+            raise ValueError(f"Invalid cursor: {cursor!r}")
+
+        return tuple(int(part) for part in parts)
+
+    def query_scores(self, channel=None, well_number=None, min_z=None, max_z=None, start=None, end=None,
+                     plate_id=None, run_id=None, hits_only=True, limit=100, cursor=None):
+        """
+        Find the scores of every run matching the filters, one page at a time.
+
+        Pages are keyed on (run_id, position, channel_index) rather than an offset, so
+        fetching a late page costs the same as fetching the first one.
+
+        Parameters:
+        - channel (str): Only this channel, e.g. 'phl'.
+        - well_number (str): Only this well.
+        - min_z (float): Lowest z-score to include.
+        - max_z (float): Highest z-score to include.
+        - start (str): ISO date or datetime of the earliest run to include.
+        - end (str): ISO date or datetime of the latest run to include.
+        - plate_id (str): Only runs of this plate.
+        - run_id (int): Only this run.
+        - hits_only (bool): Only the scores that were a hit.
+        - limit (int): Page size, at most MAX_PAGE_SIZE.
+        - cursor (str): The next_cursor of the previous page.
+
+        Returns:
+        - dict: 'scores', a list of dicts ordered by run, well position and channel, and
+          'next_cursor', None on the last page.
+        """
+        if not 1 <= limit <= self.MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {self.MAX_PAGE_SIZE}")
+
+        conditions = []
+        parameters = []
+
+        # Literal condition so SQLite can use the partial index of the hits
+        if hits_only:
+            conditions.append("s.is_hit = 1")
+
+        for column, value in (("s.channel", channel), ("s.well_number", well_number), ("r.plate_id", plate_id), ("s.run_id", run_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                parameters.append(value)
+
+        if min_z is not None:
+            conditions.append("s.z_score >= ?")
+            parameters.append(min_z)
+        if max_z is not None:
+            conditions.append("s.z_score <= ?")
+            parameters.append(max_z)
+
+        start_bound = self.parse_date_bound(start)
+        if start_bound is not None:
+            conditions.append("r.created_at >= ?")
+            parameters.append(start_bound)
+
+        end_bound = self.parse_date_bound(end, end=True)
+        if end_bound is not None:
+            conditions.append("r.created_at < ?" if len(end) == 10 else "r.created_at <= ?")
+            parameters.append(end_bound)
+
+        if cursor:
+            conditions.append("(s.run_id, s.position, s.channel_index) > (?, ?, ?)")
+            parameters.extend(self.parse_cursor(cursor))
+
+        query = ("SELECT s.run_id, s.position, s.channel_index, r.created_at, r.source, r.plate_id,"
+                 " s.well_number, s.channel, s.z_score, s.is_hit"
+                 " FROM scores s JOIN runs r ON r.run_id = s.run_id")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        # One extra row tells whether there is a next page
+        query += " ORDER BY s.run_id, s.position, s.channel_index LIMIT ?"
+        parameters.append(limit + 1)
+
+        with self.connect() as connection:
+            connection.row_factory = sqlite3.Row
+            rows = [dict(row) for row in connection.execute(query, parameters).fetchall()]
+
+        next_cursor = self.format_cursor(rows[limit - 1]) if len(rows) > limit else None
+        scores = []
+        for row in rows[:limit]:
+            row['is_hit'] = bool(row['is_hit'])
+            scores.append(row)
+
+        return {'scores': scores, 'next_cursor': next_cursor}
+
+    def load_run_frame(self, connection, run_id, view):
+        """
+        Rebuild the sheet of one run in the layout of the legacy history workbooks.
+
+        Parameters:
+        - connection (sqlite3.Connection): An open connection to the store.
+        - run_id (int): The run to load.
+        - view (str): VIEW_PLATES for the z-scores of every well, VIEW_HITS for the hit wells only.
+
+        Returns:
+        - pd.DataFrame: The sheet contents.
+        """
+        scores_df = pd.read_sql_query(
+            "SELECT position, well_number, channel_index, channel, z_score, is_hit FROM scores WHERE run_id = ? ORDER BY position, channel_index",
+            connection,
+            params=[run_id],
+        )
+        channels = scores_df.drop_duplicates('channel_index').sort_values('channel_index')['channel'].tolist()
+        channel_count = max(len(channels), 1)
+
+        # Rows are stored position-major, so each run reshapes into a positions x channels block
+        z_scores = scores_df['z_score'].to_numpy(dtype=np.float64).reshape(-1, channel_count)
+        is_hit = scores_df['is_hit'].to_numpy(dtype=bool).reshape(-1, channel_count)
+        well_numbers = scores_df['well_number'].to_numpy()[::channel_count]
+
+        if view == self.VIEW_HITS:
+            hit_rows = is_hit.any(axis=1)
+            columns = {'well_number': well_numbers[hit_rows]}
+            for channel_index, channel in enumerate(channels):
+                columns[f"hits_{channel}_z_score"] = np.where(is_hit[hit_rows, channel_index], z_scores[hit_rows, channel_index], np.nan)
+        else:
+            columns = {'well_number': well_numbers}
+            for channel_index, channel in enumerate(channels):
+                columns[f"{channel}_z_score"] = z_scores[:, channel_index]
+
+        return pd.DataFrame(columns)
+
+    def generate_run_sheets(self, runs_df, view, base_sheet_name):
+        with self.connect() as connection:
+            for run in runs_df.itertuples():
+                yield f"{base_sheet_name}_{run.sheet_label}", self.load_run_frame(connection, run.run_id, view)
+
+        # A workbook needs at least one sheet
+        if runs_df.empty:
+            yield base_sheet_name, pd.DataFrame(columns=['well_number'])
@@ -0,0 +1,71 @@
+import math
+
+
+class RunningStats:
+    """
+    Count, mean and sum of squared deviations (M2) of a stream of values.
+
+    Two aggregates merge exactly with Chan et al.'s parallel update, so campaign-wide
+    statistics are kept up to date by merging in one plate at a time instead of
+    recomputing them from every plate seen so far.
+    """
+
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = int(count)
+        self.mean = float(mean) if self.count else 0.0
+        self.m2 = float(m2) if self.count else 0.0
+
+    @staticmethod
+    def from_mean_sd(count, mean, sd):
+        """
+        Rebuild the aggregate of count values from their mean and sample standard deviation.
+
+        Parameters:
+        - count (int): The number of values.
+        - mean (float): Their mean.
+        - sd (float): Their sample standard deviation (ddof=1), NaN for a single value.
+
+        Returns:
+        - RunningStats: The aggregate of the values.
+        """
+        if count == 0:
+            return RunningStats()
+
+        m2 = sd * sd * (count - 1) if count > 1 else 0.0
+
+        return RunningStats(count, mean, m2)
+
+    def merge(self, other):
+        """
+        Combine two aggregates as if their values had been aggregated together.
+
+        Parameters:
+        - other (RunningStats): The aggregate to merge in.
+
+        Returns:
+        - RunningStats: A new aggregate.
+        """
+        if other.count == 0:
+            return RunningStats(self.count, self.mean, self.m2)
+        if self.count == 0:
+            return RunningStats(other.count, other.mean, other.m2)
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        mean = self.mean + delta * other.count / count
+        m2 = self.m2 + other.m2 + delta * delta * self.count * other.count / count
+
+        return RunningStats(count, mean, m2)
+
+    def get_sd(self):
+        # Sample standard deviation, like pandas' Series.std()
+        if self.count < 2:
+            return math.nan
+
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def get_mean(self):
+        return self.mean if self.count else math.nan
+
+    def to_dict(self):
+        return {'count': self.count, 'mean': self.get_mean(), 'sd': self.get_sd()}
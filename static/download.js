@@ -0,0 +1,29 @@
+var POLL_INTERVAL_MS = 2000;
+
+function pollJobStatus(jobId, statusElement) {
+    fetch('/jobs/' + jobId)
+        .then(function (response) {
+            return response.json();
+        })
+        .then(function (job) {
+            if (job.status === 'finished' || job.status === 'failed') {
+                // Show the download links (or the error) once the job is done
+                window.location.href = '/jobs/' + jobId + '/result';
+                return;
+            }
+
+            statusElement.textContent = 'Analysis ' + job.status + ', please wait...';
+            setTimeout(function () { pollJobStatus(jobId, statusElement); }, POLL_INTERVAL_MS);
+        })
+        .catch(function () {
+            setTimeout(function () { pollJobStatus(jobId, statusElement); }, POLL_INTERVAL_MS);
+        });
+}
+
+document.addEventListener('DOMContentLoaded', function () {
+    var statusElement = document.getElementById('job_status');
+
+    if (statusElement) {
+        pollJobStatus(statusElement.dataset.jobId, statusElement);
+    }
+});
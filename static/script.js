@@ -15,32 +15,57 @@ function validateForm() {
         return false;
     }
 
-    var isValid = true;
-
     if (!((sheetSelection === "PL1" && containsValidKeyword(fileName, "KCP1")) ||
         (sheetSelection === "XXXX" && containsValidKeyword(fileName, "XXXX")))) {
         alert("Invalid file name. Please select the correct radio button for the file.");
-        isValid = false;
+        return false;
+    }
+
+    if (!document.querySelector('input[name="outputs"]:checked')) {
+        alert("Please select at least one output.");
+        return false;
     }
 
-    var reader = new FileReader();
-    reader.onload = function (e) {
-        var data = new Uint8Array(e.target.result);
-        var workbook = XLSX.read(data, { type: 'array' });
+    var progressElement = document.getElementById('upload_progress');
 
-        if (!workbook.SheetNames.includes("Samples") ||
-            !workbook.SheetNames.includes("High Controls")) {
-            alert("The Excel file is missing required sheets. Please check the contents.");
-            isValid = false;
-        }
+    // Large workbooks are sent in resumable chunks; the server checks them once assembled and starts the analysis
+    if (fileInput.files[0].size > CHUNKED_UPLOAD_THRESHOLD) {
+        uploadInChunks(document.forms[0], fileInput.files[0], function (offset, size) {
+            progressElement.textContent = 'Uploading ' + Math.floor(100 * offset / size) + '%...';
+        })
+            .then(function (job) {
+                window.location.href = job.result_url;
+            })
+            .catch(function (error) {
+                progressElement.textContent = '';
+                alert(error.message);
+            });
 
-        if (isValid) {
-            // Submit the form if all checks pass
-            document.forms[0].submit();
-        }
-    };
+        return false;
+    }
+
+    // Send the workbook once: the server checks its sheets and header row from the xlsx manifest before queueing it
+    progressElement.textContent = 'Uploading...';
 
-    reader.readAsArrayBuffer(fileInput.files[0]);
+    fetch('/combine_sheets', {
+        method: 'POST',
+        headers: { 'Accept': 'application/json' },
+        body: new FormData(document.forms[0])
+    })
+        .then(getJson)
+        .then(function (job) {
+            if (job.result_url && job.status !== 'failed') {
+                window.location.href = job.result_url;
+                return;
+            }
+
+            progressElement.textContent = '';
+            alert("The Excel file cannot be analysed: " + (job.error || "the server answered " + job.httpStatus + "."));
+        })
+        .catch(function () {
+            progressElement.textContent = '';
+            alert("The workbook could not be sent, please check the connection and try again.");
+        });
 
     return false;
 }
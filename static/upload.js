@@ -0,0 +1,187 @@
+// Workbooks above this size are sent in chunks to /uploads, so a dropped connection only costs the chunk in flight
+var CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+
+// Attempts per chunk before giving up, waiting a little longer after each failure
+var CHUNK_ATTEMPTS = 5;
+var RETRY_DELAY_MS = 1000;
+
+var CRC32_TABLE = null;
+
+function crc32(bytes) {
+    if (CRC32_TABLE === null) {
+        CRC32_TABLE = [];
+        for (var n = 0; n < 256; n++) {
+            var c = n;
+            for (var k = 0; k < 8; k++) {
+                c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+            }
+            CRC32_TABLE.push(c >>> 0);
+        }
+    }
+
+    var crc = 0xFFFFFFFF;
+    for (var i = 0; i < bytes.length; i++) {
+        crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    }
+    return ((crc ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, '0');
+}
+
+function toHex(buffer) {
+    return Array.from(new Uint8Array(buffer)).map(function (b) {
+        return b.toString(16).padStart(2, '0');
+    }).join('');
+}
+
+function getChunkChecksum(buffer) {
+    // SHA-256 where the browser offers it (secure contexts only), CRC32 otherwise
+    if (window.crypto && window.crypto.subtle) {
+        return window.crypto.subtle.digest('SHA-256', buffer).then(function (digest) {
+            return 'sha256 ' + toHex(digest);
+        });
+    }
+    return Promise.resolve('crc32 ' + crc32(new Uint8Array(buffer)));
+}
+
+function wait(milliseconds) {
+    return new Promise(function (resolve) {
+        setTimeout(resolve, milliseconds);
+    });
+}
+
+function getResumeKey(file) {
+    // The same file picked again after a reload resumes its upload
+    return 'upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+}
+
+function getJson(response) {
+    return response.json().catch(function () {
+        return {};
+    }).then(function (body) {
+        body.httpStatus = response.status;
+        return body;
+    });
+}
+
+function getFormSettings(form, file) {
+    // The analysis fields of the form, with the checkbox groups as lists
+    var settings = { file_name: file.name, size: file.size };
+    new FormData(form).forEach(function (value, name) {
+        if (name === 'input_file') {
+            return;
+        }
+        if (name === 'outputs' || name === 'formats') {
+            (settings[name] = settings[name] || []).push(value);
+        } else {
+            settings[name] = value;
+        }
+    });
+    return settings;
+}
+
+function createUpload(form, file) {
+    var key = getResumeKey(file);
+    var uploadId = window.localStorage ? localStorage.getItem(key) : null;
+
+    // Resume an unfinished upload of the same file where the server has it
+    var resumed = uploadId ? fetch('/uploads/' + uploadId).then(getJson) : Promise.resolve({ httpStatus: 404 });
+
+    return resumed.then(function (upload) {
+        if (upload.httpStatus === 200 && upload.offset !== undefined) {
+            return upload;
+        }
+
+        return fetch('/uploads', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(getFormSettings(form, file))
+        }).then(getJson).then(function (upload) {
+            if (upload.httpStatus !== 201) {
+                throw new Error(upload.error || 'The upload was refused (' + upload.httpStatus + ').');
+            }
+            if (window.localStorage) {
+                localStorage.setItem(key, upload.upload_id);
+            }
+            return upload;
+        });
+    });
+}
+
+function sendChunk(upload, file, offset, attempt) {
+    var chunk = file.slice(offset, Math.min(offset + upload.chunk_size, file.size));
+
+    return chunk.arrayBuffer().then(function (buffer) {
+        return getChunkChecksum(buffer).then(function (checksum) {
+            return fetch('/uploads/' + upload.upload_id, {
+                method: 'PUT',
+                headers: { 'Upload-Offset': String(offset), 'Upload-Checksum': checksum },
+                body: buffer
+            });
+        });
+    }).then(getJson).catch(function () {
+        return { httpStatus: 0 };
+    }).then(function (response) {
+        if (response.httpStatus === 200 || response.httpStatus === 201 || response.httpStatus === 202 || response.httpStatus === 503) {
+            return response;
+        }
+        if (response.httpStatus === 409) {
+            // The server has a different offset, e.g. after a lost response: continue from there
+            return { offset: response.offset, status: 'receiving' };
+        }
+        if (attempt >= CHUNK_ATTEMPTS || [400, 404, 413].indexOf(response.httpStatus) !== -1) {
+            throw new Error(response.error || 'The upload failed, please try again.');
+        }
+
+        // Ask the server where to resume from, then send again
+        return wait(RETRY_DELAY_MS * attempt).then(function () {
+            return fetch('/uploads/' + upload.upload_id).then(getJson);
+        }).then(function (status) {
+            // An upload that is already complete goes on to its analysis
+            if (status.offset === undefined || status.status === 'complete') {
+                return status;
+            }
+            return sendChunk(upload, file, status.offset, attempt + 1);
+        });
+    });
+}
+
+function sendChunks(upload, file, onProgress) {
+    onProgress(upload.offset, file.size);
+
+    if (upload.status === 'complete') {
+        return fetch('/uploads/' + upload.upload_id + '/analyse', { method: 'POST' }).then(getJson);
+    }
+
+    return sendChunk(upload, file, upload.offset, 1).then(function (response) {
+        // The response to the last chunk is the job, the others give the next offset
+        if (response.result_url || response.httpStatus === 503) {
+            return response;
+        }
+        return sendChunks(withOffset(upload, response), file, onProgress);
+    });
+}
+
+function withOffset(upload, response) {
+    return Object.assign({}, upload, { offset: response.offset, status: response.status });
+}
+
+function uploadInChunks(form, file, onProgress) {
+    return createUpload(form, file).then(function (upload) {
+        return sendChunks(upload, file, onProgress).then(function (job) {
+            if (job.httpStatus === 503) {
+                // The queue is full: the workbook stays on the server, start its analysis again shortly
+                return wait(RETRY_DELAY_MS * CHUNK_ATTEMPTS).then(function () {
+                    return sendChunks(withOffset(upload, { offset: file.size, status: 'complete' }), file, onProgress);
+                });
+            }
+            return job;
+        }).then(function (job) {
+            if (!job.result_url) {
+                throw new Error(job.error || 'The workbook could not be analysed.');
+            }
+            if (window.localStorage) {
+                localStorage.removeItem(getResumeKey(file));
+            }
+            return job;
+        });
+    });
+}
@@ -0,0 +1,88 @@
+import gzip
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+class TableFormats:
+    """
+    Flat file encodings of an analysed plate, for tools that do not read xlsx.
+
+    CSV is written without the index, like the xlsx sheets. Gzip-compressed CSV uses a
+    fixed header timestamp so the same frame always gives the same bytes. Parquet keeps
+    the column types (categorical well names included) and needs pyarrow.
+    """
+
+    CSV = 'csv'
+    CSV_GZIP = 'csv.gz'
+    PARQUET = 'parquet'
+
+    MEDIA_TYPES = {
+        CSV: 'text/csv',
+        CSV_GZIP: 'application/gzip',
+        PARQUET: 'application/vnd.apache.parquet',
+    }
+
+    # Gzip level of the compressed CSV, favouring write speed over the last few percent of size
+    GZIP_LEVEL = 6
+
+    @staticmethod
+    def get_formats():
+        # Parquet is only offered with pyarrow installed
+        return [file_format for file_format in TableFormats.MEDIA_TYPES if file_format != TableFormats.PARQUET or pa is not None]
+
+    @staticmethod
+    def get_file_name(file_name, file_format):
+        """
+        Name the file of an output in another format, e.g. "All_hits.xlsx" -> "All_hits.csv.gz".
+
+        Parameters:
+        - file_name (str): The xlsx file name of the output.
+        - file_format (str): One of MEDIA_TYPES.
+
+        Returns:
+        - str: The file name with the format's extension.
+        """
+        return f"{os.path.splitext(file_name)[0]}.{file_format}"
+
+    @staticmethod
+    def get_format(file_name):
+        # The format of a file name made by get_file_name, None for any other file
+        for file_format in sorted(TableFormats.MEDIA_TYPES, key=len, reverse=True):
+            if file_name.endswith('.' + file_format):
+                return file_format
+
+        return None
+
+    @staticmethod
+    def write(frame, file_path, file_format):
+        """
+        Write a DataFrame in one of the flat formats.
+
+        Parameters:
+        - frame (pd.DataFrame): The table to write.
+        - file_path (str): Where to write it.
+        - file_format (str): One of get_formats().
+
+        Returns:
+        - str: The path written to.
+        """
+        if file_format not in TableFormats.get_formats():
+            raise ValueError(f"Unsupported format: {file_format!r}")
+
+        if file_format == TableFormats.CSV:
+            frame.to_csv(file_path, index=False)
+        elif file_format == TableFormats.CSV_GZIP:
+            # No file name and mtime=0 keep the gzip header, and so the file, the same for the same frame
+            with open(file_path, 'wb') as raw_file, \
+                    gzip.GzipFile(filename='', mode='wb', compresslevel=TableFormats.GZIP_LEVEL, fileobj=raw_file, mtime=0) as gzip_file:
+                frame.to_csv(gzip_file, index=False, encoding='utf-8')
+        else:
+            pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), file_path)
+
+        return file_path
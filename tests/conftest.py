@@ -0,0 +1,11 @@
+import os
+import shutil
+import tempfile
+
+# Everything the app writes goes to a scratch data root, set before any module reads DATA_ROOT
+DATA_ROOT = tempfile.mkdtemp(prefix='plate-analysis-tests-')
+os.environ['DATA_ROOT'] = DATA_ROOT
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(DATA_ROOT, ignore_errors=True)
@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from analysis_engine import AnalysisEngine
+from assays import PHL_YEMK_CHANNELS, PHL_YEMK_COLUMNS, AssaySpec, get_assay
+from benchmarks.generate_plates import PlateGenerator
+from benchmarks.run_benchmarks import run_statistics_chain
+from utilities import AnalysisUtilities
+
+# The engine and the chain do the same float64 arithmetic in a different order
+RTOL = 1e-9
+
+# A pHL only read-out of the KCP1 panel, without the YEMK channel and the live gate
+PHL_ONLY_ASSAY = AssaySpec('phl_only', "KCP1", ["Samples", "High Controls"], PHL_YEMK_COLUMNS, PHL_YEMK_CHANNELS[:1])
+
+
+def read_combined_df(tmp_path, wells, hit_rate, seed):
+    # The workbook rows as read, in float64 like the original upload path
+    file_path = PlateGenerator.write_workbook(str(tmp_path / f"KCP1_{wells}.xlsx"), wells, 1, hit_rate, seed)
+
+    return AnalysisUtilities.prepare_analysis_df(file_path, "Samples", "High Controls", AnalysisUtilities.remove_columns_names_list())
+
+
+def run_legacy_chain(combined_df):
+    # The original AnalysisUtilities chain, in the order the web app called it
+    analysis_df = AnalysisUtilities.rewrite_column_names(combined_df.copy(), AnalysisUtilities.get_old_column_names(combined_df),
+                                                         AnalysisUtilities.get_renamed_column_names(), AnalysisUtilities.get_new_column_names())
+
+    return run_statistics_chain(analysis_df)
+
+
+def get_legacy_stats(legacy_df):
+    # The means and standard deviations the chain takes the z-scores against
+    return {
+        'phl': (AnalysisUtilities.calculate_corrected_mean_phl_vl2_phl_bl1(legacy_df),
+                AnalysisUtilities.calculate_corrected_sd_phl_vl2_phl_bl1(legacy_df)),
+        'yemk': (AnalysisUtilities.calculate_corrected_mean_yemk_vl2_yemk_bl1(legacy_df),
+                 AnalysisUtilities.calculate_corrected_sd_yemk_vl2_yemk_bl1(legacy_df)),
+        'live': (AnalysisUtilities.calculate_live_mean(legacy_df), AnalysisUtilities.calculate_live_sd(legacy_df)),
+    }
+
+
+def assert_columns_close(result_df, legacy_df, column):
+    np.testing.assert_allclose(result_df[column].to_numpy(dtype=np.float64), legacy_df[column].to_numpy(dtype=np.float64),
+                               rtol=RTOL, equal_nan=True, err_msg=column)
+
+
+def assert_matches_legacy_chain(result, legacy_df, assay):
+    legacy_stats = get_legacy_stats(legacy_df)
+
+    for channel in assay.channels:
+        for column in (channel.ratio_column, channel.corrected_column, channel.below_cutoff_column, channel.z_score_column,
+                       channel.hits_column):
+            assert_columns_close(result.frame, legacy_df, column)
+
+        mean, sd = legacy_stats[channel.name]
+        np.testing.assert_allclose(result.stats[channel.name]['corrected_mean'], mean, rtol=RTOL)
+        np.testing.assert_allclose(result.stats[channel.name]['corrected_sd'], sd, rtol=RTOL)
+
+    for viability in assay.viability:
+        for column in (viability.z_score_column, viability.hits_column):
+            assert_columns_close(result.frame, legacy_df, column)
+
+        mean, sd = legacy_stats[viability.name]
+        np.testing.assert_allclose(result.stats[viability.name]['mean'], mean, rtol=RTOL)
+        np.testing.assert_allclose(result.stats[viability.name]['sd'], sd, rtol=RTOL)
+
+    # The chain marks a hit by filling the hits column, the engine by its mask
+    for channel in assay.channels + assay.viability:
+        legacy_mask = legacy_df[channel.hits_column].notna().to_numpy()
+        np.testing.assert_array_equal(result.hit_masks[channel.name], legacy_mask, err_msg=channel.name)
+        assert int(result.hit_masks[channel.name].sum()) == int(legacy_mask.sum())
+
+
+def test_single_channel_96_well_plate(tmp_path):
+    combined_df = read_combined_df(tmp_path, 96, hit_rate=0.05, seed=1)
+
+    result = AnalysisEngine.analyse(combined_df, assay=PHL_ONLY_ASSAY)
+    legacy_df = run_legacy_chain(combined_df)
+
+    assert_matches_legacy_chain(result, legacy_df, PHL_ONLY_ASSAY)
+    assert result.hit_masks['phl'].any()
+    assert 'yemk_z_score' not in result.frame.columns
+
+
+def test_three_channel_384_well_plate(tmp_path):
+    combined_df = read_combined_df(tmp_path, 384, hit_rate=0.05, seed=2)
+    assay = get_assay()
+
+    result = AnalysisEngine.analyse(combined_df, assay=assay)
+    legacy_df = run_legacy_chain(combined_df)
+
+    assert_matches_legacy_chain(result, legacy_df, assay)
+    assert [channel.name for channel in assay.channels + assay.viability] == ['phl', 'yemk', 'live']
+    assert all(result.hit_masks[name].any() for name in ('phl', 'yemk', 'live'))
+
+
+def test_output_columns_match_legacy_chain(tmp_path):
+    combined_df = read_combined_df(tmp_path, 96, hit_rate=0.05, seed=3)
+
+    result = AnalysisEngine.analyse(combined_df)
+    legacy_df = run_legacy_chain(combined_df)
+
+    assert result.frame.columns.tolist() == legacy_df.columns.tolist()
+    pd.testing.assert_frame_equal(result.frame, legacy_df, check_dtype=False, rtol=RTOL)
+
+
+@pytest.mark.parametrize('wells', [96, 384])
+def test_cutoff_and_threshold_overrides(tmp_path, wells):
+    combined_df = read_combined_df(tmp_path, wells, hit_rate=0.05, seed=4)
+
+    result = AnalysisEngine.analyse(combined_df, cutoff_multiplier=2.0, hit_threshold=-3)
+
+    # The chain with the same settings passed to every step
+    legacy_df = AnalysisUtilities.rewrite_column_names(combined_df.copy(), AnalysisUtilities.get_old_column_names(combined_df),
+                                                       AnalysisUtilities.get_renamed_column_names(), AnalysisUtilities.get_new_column_names())
+    legacy_df = AnalysisUtilities.calculate_pHL_VL2_BL1(legacy_df)
+    legacy_df = AnalysisUtilities.calculate_yemk_vl2_bl1(legacy_df)
+    legacy_df = AnalysisUtilities.calculate_relative_well_number(legacy_df)
+    legacy_df = AnalysisUtilities.calculate_slope_corrected_phl_vl2_bl1(legacy_df, AnalysisUtilities.calculate_slope_phl_vl2_phl_bl1(legacy_df))
+    legacy_df = AnalysisUtilities.calculate_slope_corrected_yemk_vl2_bl1(legacy_df, AnalysisUtilities.calculate_slope_yemk_vl2_bl1(legacy_df))
+    cutoff_phl = AnalysisUtilities.calculate_cuttoff_phl_vl2_phl_bl1(AnalysisUtilities.calculate_mean_phl_vl2_phl_bl1(legacy_df),
+                                                                     AnalysisUtilities.calculate_sd_phl_vl2_phl_bl1(legacy_df), 2.0)
+    cutoff_yemk = AnalysisUtilities.calculate_cuttoff_yemk_vl2_yemk_bl1(AnalysisUtilities.calculate_mean_yemk_vl2_yemk_bl1(legacy_df),
+                                                                        AnalysisUtilities.calculate_sd_yemk_vl2_yemk_bl1(legacy_df), 2.0)
+    legacy_df = AnalysisUtilities.populate_cutoff_PHL_VL2_BL1_below_cuttoff(legacy_df, cutoff_phl)
+    legacy_df = AnalysisUtilities.populate_cutoff_yemk_vl2_bl1_below_cuttoff(legacy_df, cutoff_yemk)
+    legacy_stats = get_legacy_stats(legacy_df)
+    legacy_df = AnalysisUtilities.populate_phl_z_score(legacy_df, *legacy_stats['phl'])
+    legacy_df = AnalysisUtilities.populate_yemk_z_score(legacy_df, *legacy_stats['yemk'])
+    legacy_df = AnalysisUtilities.populate_live_z_score(legacy_df, *legacy_stats['live'])
+    legacy_df = AnalysisUtilities.populate_hits_phl_z_score(legacy_df, -3)
+    legacy_df = AnalysisUtilities.populate_hits_yemk_z_score(legacy_df, -3)
+    legacy_df = AnalysisUtilities.populate_hits_live_z_score(legacy_df, -3)
+
+    assert_matches_legacy_chain(result, legacy_df, get_assay())
+
+
+def test_float32_plate_stays_within_float32_rounding(tmp_path):
+    # The web app analyses the plate as read_plate returns it, with float32 measurements
+    file_path = PlateGenerator.write_workbook(str(tmp_path / "KCP1_384.xlsx"), 384, 1, 0.05, 5)
+    plate_df = AnalysisUtilities.read_plate(file_path, "Samples", "High Controls")
+    combined_df = AnalysisUtilities.prepare_analysis_df(file_path, "Samples", "High Controls", AnalysisUtilities.remove_columns_names_list())
+
+    assert plate_df['phl_vl2'].dtype == np.float32
+    compact = AnalysisEngine.analyse(plate_df)
+    full = AnalysisEngine.analyse(combined_df)
+
+    for channel in get_assay().channels + get_assay().viability:
+        np.testing.assert_allclose(compact.frame[channel.z_score_column], full.frame[channel.z_score_column], rtol=1e-5, atol=1e-5,
+                                   equal_nan=True)
+        np.testing.assert_array_equal(compact.hit_masks[channel.name], full.hit_masks[channel.name])
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import time
+
+import pytest
+
+from benchmarks.generate_plates import PlateGenerator
+from chunked_upload import ChunkedUpload, UploadChecksumError, UploadOffsetError
+from job_queue import JobQueue
+from workspace import JobWorkspace
+
+WORKBOOK = bytes(range(256)) * 40
+
+
+def sha256(data):
+    return ChunkedUpload.compute_checksum('sha256', data)
+
+
+def new_upload(tmp_path, data=WORKBOOK, declared_sha256=None):
+    workspace = JobWorkspace(JobQueue.new_job_id(), str(tmp_path / 'uploads'), str(tmp_path / 'downloads')).create()
+    upload = ChunkedUpload(workspace)
+    upload.create('KCP1_test.xlsx', len(data), declared_sha256 or hashlib.sha256(data).hexdigest())
+
+    return upload
+
+
+def read_upload(upload):
+    with open(upload.get_file_path(upload.load()), 'rb') as upload_file:
+        return upload_file.read()
+
+
+def test_chunks_are_appended_in_order(tmp_path):
+    upload = new_upload(tmp_path)
+    first, second = WORKBOOK[:4096], WORKBOOK[4096:]
+
+    assert upload.append(0, first, ('sha256', sha256(first))) == (4096, False)
+    assert upload.get_status(upload.load())['status'] == ChunkedUpload.STATUS_RECEIVING
+
+    # Either checksum is accepted per chunk
+    assert upload.append(4096, second, ('crc32', ChunkedUpload.compute_checksum('crc32', second))) == (len(WORKBOOK), True)
+
+    manifest = upload.load()
+    assert read_upload(upload) == WORKBOOK
+    assert manifest['status'] == ChunkedUpload.STATUS_COMPLETE
+    assert [(chunk['offset'], chunk['length']) for chunk in manifest['chunks']] == [(0, 4096), (4096, len(second))]
+    assert upload.get_status(manifest)['offset'] == len(WORKBOOK)
+
+
+def test_resent_chunk_is_acknowledged_once(tmp_path):
+    upload = new_upload(tmp_path)
+    chunk = WORKBOOK[:4096]
+
+    assert upload.append(0, chunk, ('sha256', sha256(chunk))) == (4096, False)
+
+    # The response was lost and the client sends the same chunk again, with either checksum
+    assert upload.append(0, chunk, ('sha256', sha256(chunk))) == (4096, False)
+    assert upload.append(0, chunk, ('crc32', ChunkedUpload.compute_checksum('crc32', chunk))) == (4096, False)
+
+    assert read_upload(upload) == chunk
+    assert len(upload.load()['chunks']) == 1
+
+
+def test_wrong_offset_gives_the_offset_to_resume_from(tmp_path):
+    upload = new_upload(tmp_path)
+    upload.append(0, WORKBOOK[:4096], ('sha256', sha256(WORKBOOK[:4096])))
+
+    # A chunk from further on, as after a lost chunk
+    later = WORKBOOK[8192:9000]
+    with pytest.raises(UploadOffsetError) as error:
+        upload.append(8192, later, ('sha256', sha256(later)))
+    assert error.value.offset == 4096
+
+    # A different chunk at an offset already received
+    other = WORKBOOK[100:200]
+    with pytest.raises(UploadOffsetError) as error:
+        upload.append(0, other, ('sha256', sha256(other)))
+    assert error.value.offset == 4096
+
+    assert read_upload(upload) == WORKBOOK[:4096]
+
+
+def test_chunk_past_the_declared_size_is_rejected(tmp_path):
+    upload = new_upload(tmp_path, WORKBOOK[:1000])
+    overrun = WORKBOOK[:1001]
+
+    with pytest.raises(ValueError, match="past the declared size"):
+        upload.append(0, overrun, ('sha256', sha256(overrun)))
+
+    assert read_upload(upload) == b''
+    assert upload.load()['chunks'] == []
+
+
+def test_chunk_not_matching_its_checksum_is_rejected(tmp_path):
+    upload = new_upload(tmp_path)
+    chunk = WORKBOOK[:4096]
+
+    with pytest.raises(UploadChecksumError):
+        upload.append(0, chunk, ('sha256', sha256(chunk[:-1] + b'\x00')))
+
+    assert read_upload(upload) == b''
+
+
+def test_file_not_matching_its_sha256_starts_over(tmp_path):
+    upload = new_upload(tmp_path, declared_sha256='0' * 64)
+    first, second = WORKBOOK[:4096], WORKBOOK[4096:]
+    upload.append(0, first, ('sha256', sha256(first)))
+
+    with pytest.raises(UploadChecksumError):
+        upload.append(4096, second, ('sha256', sha256(second)))
+
+    manifest = upload.load()
+    assert read_upload(upload) == b''
+    assert manifest['chunks'] == []
+    assert manifest['status'] == ChunkedUpload.STATUS_RECEIVING
+
+    # The upload is sent again from the start
+    assert upload.append(0, first, ('sha256', sha256(first))) == (4096, False)
+
+
+def test_last_chunk_starts_the_job(tmp_path, monkeypatch):
+    import main
+
+    # Small chunks, so the workbook is sent in several
+    monkeypatch.setitem(main.app.config, 'UPLOAD_CHUNK_BYTES', 16 * 1024)
+    file_path = PlateGenerator.write_workbook(str(tmp_path / "KCP1_upload.xlsx"), 384, 1, 0.01, 7)
+    with open(file_path, 'rb') as workbook_file:
+        data = workbook_file.read()
+
+    client = main.app.test_client()
+    created = client.post('/uploads', json={'file_name': os.path.basename(file_path), 'size': len(data),
+                                            'sha256': hashlib.sha256(data).hexdigest(), 'selected_radio_id': 'PL1'})
+    assert created.status_code == 201
+    upload = created.get_json()
+    chunk_size = upload['chunk_size']
+    assert len(data) > chunk_size
+
+    response = None
+    for offset in range(0, len(data), chunk_size):
+        chunk = data[offset:offset + chunk_size]
+        response = client.put(upload['upload_url'], data=chunk,
+                              headers={'Upload-Offset': str(offset), 'Upload-Checksum': f"sha256 {sha256(chunk)}"})
+        if offset + chunk_size < len(data):
+            assert response.status_code == 200
+            assert response.get_json() == {'upload_id': upload['upload_id'], 'offset': offset + len(chunk),
+                                           'status': ChunkedUpload.STATUS_RECEIVING}
+
+    # The response to the last chunk is the job analysing the upload
+    job = response.get_json()
+    assert response.status_code == 202
+    assert job['job_id'] == upload['upload_id']
+
+    deadline = time.monotonic() + 60
+    while (status := client.get(job['status_url']).get_json())['status'] not in (JobQueue.STATUS_FINISHED, JobQueue.STATUS_FAILED):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+    assert status['status'] == JobQueue.STATUS_FINISHED, status.get('error')
+    assert os.path.exists(JobWorkspace(job['job_id']).output_path(main.ANALYSIS_FILE_NAME))
+
+    # The last chunk sent again, after its response was lost, answers with the same job
+    resent = client.put(upload['upload_url'], data=chunk,
+                        headers={'Upload-Offset': str(offset), 'Upload-Checksum': f"sha256 {sha256(chunk)}"})
+    assert resent.status_code == 200
+    assert resent.get_json()['job_id'] == job['job_id']
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+from excel_writer import StreamingExcelWriter
+from workbook_reader import WorkbookReader
+
+
+def test_downcast_numeric_narrows_counts_and_measurements():
+    frame = pd.DataFrame({
+        'well_number': ['A01', 'A02', 'A03'],
+        'total_count': np.array([1200, 3400, 4999], dtype=np.int64),
+        'phl_vl2': [512.3456789, 498.25, np.nan],
+    })
+
+    WorkbookReader.downcast_numeric(frame)
+
+    assert frame['total_count'].dtype == np.int32
+    assert frame['phl_vl2'].dtype == np.float32
+    assert frame['well_number'].dtype == object
+    np.testing.assert_allclose(frame['phl_vl2'], [512.3456789, 498.25, np.nan], rtol=WorkbookReader.FLOAT32_RTOL)
+
+
+def test_downcast_numeric_keeps_values_float32_cannot_hold():
+    frame = pd.DataFrame({
+        'too_large': [1e300, 1.0],
+        'too_small': [1e-44, 1.0],
+        'too_large_for_int32': np.array([2 ** 40, 1], dtype=np.int64),
+    })
+
+    WorkbookReader.downcast_numeric(frame)
+
+    assert frame['too_large'].dtype == np.float64
+    assert frame['too_small'].dtype == np.float64
+    assert frame['too_large_for_int32'].dtype == np.int64
+
+
+def test_downcast_numeric_tolerance():
+    frame = pd.DataFrame({'value': [1.0 + 1e-9, 2.0]})
+
+    # A tolerance tighter than float32's rounding keeps the column as it was read
+    WorkbookReader.downcast_numeric(frame, float_rtol=1e-12)
+    assert frame['value'].dtype == np.float64
+
+    WorkbookReader.downcast_numeric(frame)
+    assert frame['value'].dtype == np.float32
+
+
+def test_float32_cells_are_written_with_their_shortest_decimal():
+    frame = pd.DataFrame({'live_percentage': np.array([80.12, np.nan], dtype=np.float32), 'count': [1, 2]})
+
+    rows = list(StreamingExcelWriter.iter_rows(frame))
+
+    assert rows == [(80.12, 1), (None, 2)]
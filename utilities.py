@@ -1,8 +1,10 @@
+import numpy as np
 import pandas as pd
-from scipy.stats import linregress
-from datetime import datetime
 import os
-from flask import Flask, render_template, request, redirect
+from analysis_engine import AnalysisEngine
+from workbook_reader import WorkbookReader
+from excel_writer import StreamingExcelWriter
+from workspace import JobWorkspace
 
 class AnalysisUtilities:
     
@@ -54,35 +56,50 @@ class AnalysisUtilities:
         return renamed_column_names_list
 
     @staticmethod
-    def prepare_analysis_df(file_path, sheet1, sheet2, remove_columns_names):
+    def prepare_analysis_df(file_path, sheet1, sheet2, remove_columns_names, sheet_column=None):
 
-        # Create DataFrames for "Samples" and "High Controls" sheets
-        samples_df = pd.read_excel(file_path, sheet_name=sheet1)
+        # Open the workbook once and stream the "Samples" and "High Controls" rows, dropping empty, mean and SD rows as they are read
+        combined_df = WorkbookReader.read_sheets(file_path, [sheet1, sheet2], remove_columns_names, sheet_column)
 
-        high_controls_df = pd.read_excel(file_path, sheet_name=sheet2)
+        return combined_df
 
-        # Combine the DataFrames into one
-        combined_df = pd.concat([samples_df, high_controls_df], ignore_index=True)
+    @staticmethod
+    def read_plate(file_path, sheet1, sheet2, renamed_column_names_list=None, sheet_column=None):
+        """
+        Read the plate of a workbook: the "Samples" and "High Controls" rows with the instrument columns renamed.
 
-        # Remove empty rows
-        combined_df = combined_df.dropna(how='all')
+        Parameters:
+        - file_path (str, bytes or file-like): The path to the workbook, or its contents.
+        - sheet1 (str): The samples sheet name.
+        - sheet2 (str): The high controls sheet name.
+        - renamed_column_names_list (list): The new names of the instrument columns, defaults to get_renamed_column_names().
+        - sheet_column (str): When given, an extra last column recording the sheet of every row, used for per-sheet drift correction.
 
-        # Convert values in "X1" column to lowercase and remove rows where the value is "mean" or "sd"
-        combined_df = combined_df[~combined_df[combined_df.columns[0]].str.lower().isin(remove_columns_names)]
+        Returns:
+        - pd.DataFrame: The cleaned, renamed plate without derived columns, in its compact dtypes: categorical
+          well and sheet names, int32/float32 wherever that keeps every value.
+        """
+        combined_df = AnalysisUtilities.prepare_analysis_df(file_path, sheet1, sheet2, AnalysisUtilities.remove_columns_names_list(), sheet_column)
 
-        return combined_df
+        # Shrink the numeric columns that lose nothing in 32 bits, e.g. the event counts
+        WorkbookReader.downcast_numeric(combined_df)
+
+        # rename the instrument columns, the sheet column keeps its name
+        old_column_name_list = [name for name in AnalysisUtilities.get_old_column_names(combined_df) if name != sheet_column]
+        if renamed_column_names_list is None:
+            renamed_column_names_list = AnalysisUtilities.get_renamed_column_names()
+
+        return combined_df.rename(columns=dict(zip(old_column_name_list, renamed_column_names_list)), copy=False)
 
     @staticmethod
     def rewrite_column_names(combined_df, old_column_name_list, renamed_column_names_list, new_column_names_list):
-        analysis_df = combined_df.copy()  # Create a copy to avoid modifying the original DataFrame
-
-        # Rename existing columns
-        for old_name, new_name in zip(old_column_name_list, renamed_column_names_list):
-            analysis_df.rename(columns={old_name: new_name}, inplace=True)
+        # Rename existing columns in a new frame that shares the instrument columns instead of copying them;
+        # the calculate_*/populate_* steps only add or replace columns, so combined_df is left unchanged
+        analysis_df = combined_df.rename(columns=dict(zip(old_column_name_list, renamed_column_names_list)), copy=False)
 
-        # Add new empty columns
+        # Add new empty columns, typed as float so they are not object columns of ''
         for new_name in new_column_names_list:
-            analysis_df[new_name] = ''
+            analysis_df[new_name] = np.nan
 
         return analysis_df
 
@@ -141,7 +158,7 @@ class AnalysisUtilities:
         - float: The slope of the linear regression.
         """
         # Perform linear regression
-        slope, _, _, _, _ = linregress(analysis_df['relative_well_number'], analysis_df['pHL_VL2_BL1'])
+        slope = AnalysisEngine.least_squares_slope(analysis_df['relative_well_number'].to_numpy(dtype=float), analysis_df['pHL_VL2_BL1'].to_numpy(dtype=float))
 
         return slope
     
@@ -157,7 +174,7 @@ class AnalysisUtilities:
         - float: The slope of the linear regression.
         """
         # Perform linear regression
-        slope, _, _, _, _ = linregress(analysis_df['relative_well_number'], analysis_df['yemk_vl2_bl1'])
+        slope = AnalysisEngine.least_squares_slope(analysis_df['relative_well_number'].to_numpy(dtype=float), analysis_df['yemk_vl2_bl1'].to_numpy(dtype=float))
 
         return slope
 
@@ -226,16 +243,16 @@ class AnalysisUtilities:
         return sd_yemk_vl2_yemk_bl1
 
     @staticmethod
-    def calculate_cuttoff_phl_vl2_phl_bl1(mean_phl_vl2_phl_bl1, sd_phl_vl2_phl_bl1):
+    def calculate_cuttoff_phl_vl2_phl_bl1(mean_phl_vl2_phl_bl1, sd_phl_vl2_phl_bl1, cutoff_multiplier=1.5):
 
-        cutoff = mean_phl_vl2_phl_bl1 + (1.5 * sd_phl_vl2_phl_bl1)
+        cutoff = mean_phl_vl2_phl_bl1 + (cutoff_multiplier * sd_phl_vl2_phl_bl1)
 
         return cutoff
 
     @staticmethod
-    def calculate_cuttoff_yemk_vl2_yemk_bl1(mean_yemk_vl2_yemk_bl1, sd_yemk_vl2_yemk_bl1):
+    def calculate_cuttoff_yemk_vl2_yemk_bl1(mean_yemk_vl2_yemk_bl1, sd_yemk_vl2_yemk_bl1, cutoff_multiplier=1.5):
         
-        cutoff = mean_yemk_vl2_yemk_bl1 + (1.5 * sd_yemk_vl2_yemk_bl1)
+        cutoff = mean_yemk_vl2_yemk_bl1 + (cutoff_multiplier * sd_yemk_vl2_yemk_bl1)
 
         return cutoff
 
@@ -380,102 +397,52 @@ class AnalysisUtilities:
         return analysis_df
     
     @staticmethod
-    def populate_hits_phl_z_score(analysis_df):
+    def populate_hits_phl_z_score(analysis_df, hit_threshold=-5):
+        # The z-score column is still empty (NaN) when no value survived the cutoff
+        z_score = pd.to_numeric(analysis_df['phl_z_score'], errors='coerce')
+
         # Use boolean indexing to filter rows based on conditions
-        condition = (analysis_df['cutoff_PHL_VL2_BL1_below_cuttoff'].notna()) & (analysis_df['phl_z_score'] < -5)
+        condition = (analysis_df['cutoff_PHL_VL2_BL1_below_cuttoff'].notna()) & (z_score < hit_threshold)
 
-        # Populate 'hits_phl_z_score' based on the condition
-        analysis_df.loc[condition, 'hits_phl_z_score'] = analysis_df.loc[condition, 'phl_z_score']
+        # 'hits_phl_z_score' holds the z-score of the hits and NaN elsewhere
+        analysis_df['hits_phl_z_score'] = z_score.where(condition).astype('float64')
 
         return analysis_df
     
     @staticmethod
-    def populate_hits_yemk_z_score(analysis_df):
+    def populate_hits_yemk_z_score(analysis_df, hit_threshold=-5):
+        # The z-score column is still empty (NaN) when no value survived the cutoff
+        z_score = pd.to_numeric(analysis_df['yemk_z_score'], errors='coerce')
+
         # Use boolean indexing to filter rows based on conditions
-        condition = (analysis_df['cutoff_yemk_vl2_bl1_below_cuttoff'].notna()) & (analysis_df['yemk_z_score'] < -5)
+        condition = (analysis_df['cutoff_yemk_vl2_bl1_below_cuttoff'].notna()) & (z_score < hit_threshold)
 
-        # Populate 'hits_yemk_z_score' based on the condition
-        analysis_df.loc[condition, 'hits_yemk_z_score'] = analysis_df.loc[condition, 'yemk_z_score']
+        # 'hits_yemk_z_score' holds the z-score of the hits and NaN elsewhere
+        analysis_df['hits_yemk_z_score'] = z_score.where(condition).astype('float64')
 
         return analysis_df
 
     @staticmethod
-    def populate_hits_live_z_score(analysis_df):
+    def populate_hits_live_z_score(analysis_df, hit_threshold=-5):
+        # The z-score column is still empty (NaN) when no value survived the cutoff
+        z_score = pd.to_numeric(analysis_df['live_z_score'], errors='coerce')
+
         # Use boolean indexing to filter rows based on conditions
-        condition = analysis_df['live_z_score'] < -5
+        condition = z_score < hit_threshold
 
-        # Populate 'hits_live_z_score' based on the condition
-        analysis_df.loc[condition, 'hits_live_z_score'] = analysis_df.loc[condition, 'live_z_score']
+        # 'hits_live_z_score' holds the z-score of the hits and NaN elsewhere
+        analysis_df['hits_live_z_score'] = z_score.where(condition).astype('float64')
 
         return analysis_df
     
-    @staticmethod
-    def export_All_Plates_YEMK_pHL_Live(analysis_df, excel_file_path, base_sheet_name):
-        # Select relevant columns from analysis_df
-        selected_columns = ['well_number', 'phl_z_score', 'yemk_z_score', 'live_z_score']
-        export_df = analysis_df[selected_columns]
-
-        # Format datetime for readability
-        formatted_datetime = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-
-        # Append formatted datetime to the base sheet name
-        sheet_name = f"{base_sheet_name}_{formatted_datetime}"
-        # Check if the file exists
-        file_exists = os.path.isfile(excel_file_path)
-
-        # Create the file if it doesn't exist
-        if not file_exists:
-            export_df.to_excel(excel_file_path, sheet_name=sheet_name, index=False)
-        else:
-            # Export the selected columns to a new sheet if the file exists
-            with pd.ExcelWriter(excel_file_path, engine='openpyxl', mode='a') as writer:
-                export_df.to_excel(writer, sheet_name=sheet_name, index=False)
-        return export_df
-    
-    @staticmethod
-    def export_All_hits(analysis_df, excel_file_path, base_sheet_name):
-        
-        # Select relevant columns from analysis_df
-        selected_columns = ['well_number', 'hits_phl_z_score', 'hits_yemk_z_score', 'hits_live_z_score']
-
-        # Filter out rows where all specified columns don't have any numeric values
-        export_df = analysis_df[analysis_df[selected_columns].applymap(lambda x: isinstance(x, (int, float))).any(axis=1)]
-
-        # Include only the selected columns in export_df
-        export_df = export_df[selected_columns]
-
-        # Format datetime for readability
-        formatted_datetime = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-
-        # Append formatted datetime to the base sheet name
-        sheet_name = f"{base_sheet_name}_{formatted_datetime}"
-        # Check if the file exists
-        file_exists = os.path.isfile(excel_file_path)
-
-        # Create the file if it doesn't exist
-        if not file_exists:
-            export_df.to_excel(excel_file_path, sheet_name=sheet_name, index=False, engine='openpyxl')
-        else:
-            # Export the selected columns to a new sheet if the file exists
-            with pd.ExcelWriter(excel_file_path, engine='openpyxl', mode='a') as writer:
-                export_df.to_excel(writer, sheet_name=sheet_name, index=False)
-
-        return export_df
-    
     @staticmethod
     def write_analysis_sheet(analysis_df, file_path, new_sheet_name):
-        # Extract the file name from the original file path
-        original_file_name = os.path.basename(file_path)
-
-        # Construct the new file name by adding "downloads/" to the front
-        new_file_path = os.path.join("downloads", f"{original_file_name}")
-
-        # Check if the "Analysis" sheet already exists and delete it in the new file
-        with pd.ExcelWriter(new_file_path, engine='openpyxl') as writer:
-            if new_sheet_name in writer.sheets:
-                writer.book.remove(writer.sheets[new_sheet_name])
+        # Bare file names are written to "downloads/", paths with a directory (e.g. a job workspace) are used as given
+        new_file_path = file_path
+        if not os.path.dirname(file_path):
+            new_file_path = os.path.join(JobWorkspace.DOWNLOADS_ROOT, file_path)
 
-            # Write the DataFrame to a new sheet named "Analysis" in the new file
-            analysis_df.to_excel(writer, sheet_name=new_sheet_name, index=False)
+        # Stream the DataFrame row by row to a new sheet named "Analysis" in the new file
+        StreamingExcelWriter.write_frames(new_file_path, [(new_sheet_name, analysis_df)])
 
         return new_file_path
@@ -0,0 +1,442 @@
+import argparse
+import os
+import signal
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from analysis_engine import AnalysisEngine
+from assays import DEFAULT_ASSAY, get_assay
+from workspace import JobWorkspace
+
+DEFAULT_LEDGER_PATH = os.path.join(JobWorkspace.DOWNLOADS_ROOT, "watch_ledger.sqlite3")
+
+
+class WatchLedger:
+    """
+    Durable record of the workbooks the watcher has taken up, in a small SQLite database.
+
+    A file is identified by its path, size and modification time: a workbook is analysed
+    once however often the watcher restarts, and again only when it is replaced by a new
+    file. Files left "processing" by a crash are retried up to MAX_ATTEMPTS times.
+    """
+
+    STATUS_PROCESSING = 'processing'
+    STATUS_FINISHED = 'finished'
+    STATUS_FAILED = 'failed'
+    STATUS_REJECTED = 'rejected'
+
+    MAX_ATTEMPTS = 3
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            job_id TEXT,
+            error TEXT,
+            detected_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            PRIMARY KEY (path, size, mtime_ns)
+        );
+        CREATE INDEX IF NOT EXISTS files_finished_at ON files(finished_at);
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self.connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(self.SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # Commit on success, roll back on error, and always release the file handle
+        connection = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get_done_keys(self):
+        """
+        List the files that are not to be analysed again.
+
+        Returns:
+        - set: (path, size, mtime_ns) of every file finished, failed, rejected or out of attempts.
+        """
+        with self.connect() as connection:
+            rows = connection.execute(
+                "SELECT path, size, mtime_ns FROM files WHERE status != ? OR attempts >= ?",
+                (self.STATUS_PROCESSING, self.MAX_ATTEMPTS),
+            ).fetchall()
+
+        return set(rows)
+
+    def start(self, key, detected_at):
+        # Recorded before the analysis starts, so a crash leaves the file marked as attempted
+        path, size, mtime_ns = key
+        with self.connect() as connection:
+            connection.execute(
+                """
+                INSERT INTO files (path, size, mtime_ns, status, attempts, detected_at, started_at) VALUES (?, ?, ?, ?, 1, ?, ?)
+                ON CONFLICT (path, size, mtime_ns) DO UPDATE SET status = excluded.status, attempts = attempts + 1,
+                                                                 started_at = excluded.started_at
+                """,
+                (path, size, mtime_ns, self.STATUS_PROCESSING, detected_at, time.time()),
+            )
+
+    def finish(self, key, status, job_id=None, error=None):
+        path, size, mtime_ns = key
+        with self.connect() as connection:
+            connection.execute(
+                "UPDATE files SET status = ?, job_id = ?, error = ?, finished_at = ? WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (status, job_id, error, time.time(), path, size, mtime_ns),
+            )
+
+    def get_summary(self):
+        """
+        Count the files by status and summarise the latency of the analysed ones.
+
+        Returns:
+        - dict: 'counts' by status, and the mean and longest 'wait_seconds' (detected to started) and
+          'analysis_seconds' (started to finished) of the finished files.
+        """
+        with self.connect() as connection:
+            counts = dict(connection.execute("SELECT status, COUNT(*) FROM files GROUP BY status").fetchall())
+            latency = connection.execute(
+                """
+                SELECT AVG(started_at - detected_at), MAX(started_at - detected_at),
+                       AVG(finished_at - started_at), MAX(finished_at - started_at)
+                FROM files WHERE status = ?
+                """,
+                (self.STATUS_FINISHED,),
+            ).fetchone()
+
+        return {
+            'counts': counts,
+            'wait_seconds': {'mean': latency[0], 'max': latency[1]},
+            'analysis_seconds': {'mean': latency[2], 'max': latency[3]},
+        }
+
+
+class FolderWatcher:
+    """
+    Poll an instrument export directory and analyse every new workbook once it is complete.
+
+    A file is taken up once its name passes the assay's file name check and its size and
+    modification time have not changed for settle_seconds, i.e. the instrument or the copy
+    has finished writing it. Files are analysed one at a time in the order they appeared.
+    """
+
+    def __init__(self, directory, ledger, assay, analyse, validate, settle_seconds=2.0, recursive=False):
+        """
+        Parameters:
+        - directory (str): The directory to watch.
+        - ledger (WatchLedger): Where the taken up files are recorded.
+        - assay (AssaySpec): The assay of the workbooks.
+        - analyse (callable): Called with a workbook path, returns the job id and the job result.
+        - validate (callable): Called with a file name and a workbook path, returns a list of problems.
+        - settle_seconds (float): How long a file must stay unchanged before it is analysed.
+        - recursive (bool): Also watch the subdirectories.
+        """
+        self.directory = directory
+        self.ledger = ledger
+        self.assay = assay
+        self.analyse = analyse
+        self.validate = validate
+        self.settle_seconds = settle_seconds
+        self.recursive = recursive
+
+        self.done = ledger.get_done_keys()
+        # Files seen but not yet stable: path -> {'key', 'detected_at', 'stable_since'}
+        self.pending = {}
+        self.queue_depth = 0
+
+    def is_candidate(self, name):
+        # Skip Excel's "~$" lock files and hidden partial copies
+        if name.startswith('~$') or name.startswith('.'):
+            return False
+
+        return name.lower().endswith('.xlsx') and self.assay.file_keyword in name
+
+    def list_files(self):
+        """
+        List the candidate workbooks of the directory.
+
+        Returns:
+        - list: (path, size, mtime_ns) of every candidate, the key of the file in the ledger.
+        """
+        files = []
+        directories = [self.directory]
+
+        while directories:
+            try:
+                entries = list(os.scandir(directories.pop()))
+            except FileNotFoundError:
+                continue
+
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        if self.recursive and not entry.name.startswith('.'):
+                            directories.append(entry.path)
+                    elif entry.is_file() and self.is_candidate(entry.name):
+                        stat = entry.stat()
+                        files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+                except FileNotFoundError:
+                    # Removed or renamed between the listing and the stat
+                    continue
+
+        return files
+
+    def poll(self, now=None):
+        """
+        Scan the directory once and pick the files that have settled.
+
+        Parameters:
+        - now (float): The current time, defaults to time.time().
+
+        Returns:
+        - list: (key, detected_at) of the settled files, oldest first.
+        """
+        now = time.time() if now is None else now
+        seen = set()
+
+        for key in self.list_files():
+            if key in self.done:
+                continue
+
+            path = key[0]
+            seen.add(path)
+            entry = self.pending.get(path)
+
+            if entry is None:
+                self.pending[path] = {'key': key, 'detected_at': now, 'stable_since': now}
+            elif entry['key'] != key:
+                # Still being written, wait for it to settle again
+                entry['key'] = key
+                entry['stable_since'] = now
+
+        # Forget files that disappeared before they settled
+        for path in [path for path in self.pending if path not in seen]:
+            del self.pending[path]
+
+        ready = [entry for entry in self.pending.values() if now - entry['stable_since'] >= self.settle_seconds]
+        ready.sort(key=lambda entry: entry['detected_at'])
+
+        return [(entry['key'], entry['detected_at']) for entry in ready]
+
+    def process(self, key, detected_at):
+        """
+        Validate and analyse one settled workbook, recording the outcome in the ledger.
+
+        Parameters:
+        - key (tuple): The (path, size, mtime_ns) of the file.
+        - detected_at (float): When the watcher first saw the file.
+
+        Returns:
+        - dict: The outcome: 'status', 'job_id', 'error', 'wait_seconds' and 'analysis_seconds'.
+        """
+        path = key[0]
+        started_at = time.time()
+        self.ledger.start(key, detected_at)
+
+        job_id = None
+        error = None
+
+        try:
+            problems = self.validate(os.path.basename(path), path)
+            if problems:
+                status = WatchLedger.STATUS_REJECTED
+                error = " ".join(problems)
+            else:
+                job_id, _ = self.analyse(path)
+                status = WatchLedger.STATUS_FINISHED
+        except Exception as e:
+            # A bad workbook is recorded and skipped, the watcher carries on
+            status = WatchLedger.STATUS_FAILED
+            error = f"{type(e).__name__}: {e}"
+
+        self.ledger.finish(key, status, job_id, error)
+        self.done.add(key)
+        self.pending.pop(path, None)
+
+        return {
+            'status': status,
+            'job_id': job_id,
+            'error': error,
+            'wait_seconds': started_at - detected_at,
+            'analysis_seconds': time.time() - started_at,
+        }
+
+    def run_once(self, stop_event=None):
+        """
+        Scan the directory and analyse the settled workbooks.
+
+        Parameters:
+        - stop_event (threading.Event): When set, no further workbook is started.
+
+        Returns:
+        - int: The number of workbooks taken up.
+        """
+        ready = self.poll()
+        self.report_queue_depth(len(self.pending))
+
+        for key, detected_at in ready:
+            if stop_event is not None and stop_event.is_set():
+                break
+
+            # The file may have changed again since the scan
+            try:
+                stat = os.stat(key[0])
+            except FileNotFoundError:
+                self.pending.pop(key[0], None)
+                continue
+            if (stat.st_size, stat.st_mtime_ns) != key[1:]:
+                continue
+
+            outcome = self.process(key, detected_at)
+            print(f"{outcome['status']} {key[0]}"
+                  + (f" job {outcome['job_id']}" if outcome['job_id'] else "")
+                  + f" (waited {outcome['wait_seconds']:.1f}s, analysed in {outcome['analysis_seconds']:.2f}s)"
+                  + (f": {outcome['error']}" if outcome['error'] else ""), flush=True)
+            self.report_queue_depth(len(self.pending))
+
+        return len(ready)
+
+    def report_queue_depth(self, depth):
+        # Printed when it changes, so an idle watcher stays quiet
+        if depth != self.queue_depth:
+            print(f"queue depth {depth}", flush=True)
+            self.queue_depth = depth
+
+    def run(self, interval=1.0, stop_event=None):
+        """
+        Watch the directory until stop_event is set.
+
+        Parameters:
+        - interval (float): Seconds between scans.
+        - stop_event (threading.Event): Set to stop after the current workbook.
+        """
+        stop_event = stop_event or threading.Event()
+
+        while not stop_event.is_set():
+            self.run_once(stop_event)
+            stop_event.wait(interval)
+
+
+def add_arguments(parser):
+    parser.add_argument('directory', help="instrument export directory to watch")
+    parser.add_argument('--ledger', default=DEFAULT_LEDGER_PATH, help="ledger of the taken up files (default: %s)" % DEFAULT_LEDGER_PATH)
+    parser.add_argument('--assay', default=None, help="assay of the workbooks, e.g. PL1 (default: %s)" % DEFAULT_ASSAY)
+    parser.add_argument('--settle-seconds', type=float, default=2.0,
+                        help="seconds a file must stay unchanged before it is analysed (default: 2)")
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between scans (default: 1)")
+    parser.add_argument('--recursive', action='store_true', help="also watch the subdirectories")
+    parser.add_argument('--once', action='store_true', help="scan once, analyse the settled files and exit")
+    parser.add_argument('--status', action='store_true', help="print the ledger summary and exit")
+    parser.add_argument('--cutoff-multiplier', type=float, default=None, help="outlier cutoff in SD (default: 1.5)")
+    parser.add_argument('--hit-threshold', type=float, default=None, help="z-score below which a well is a hit (default: -5)")
+    parser.add_argument('--drift-mode', choices=AnalysisEngine.DRIFT_MODES, default=None,
+                        help="fit the drift across the whole workbook or per sheet (default: global)")
+    parser.add_argument('--clip-iterations', type=int, default=None, help="maximum rounds of outlier clipping (default: 1)")
+    parser.add_argument('--campaign', default=None, help="add every workbook to this campaign's statistics")
+    parser.add_argument('--normalisation', choices=AnalysisEngine.NORMALISATIONS, default=None,
+                        help="take the z-scores against each plate or the whole campaign (default: plate)")
+    parser.add_argument('--formats', nargs='+', default=None, help="formats of the analysis output, e.g. xlsx csv (default: xlsx)")
+
+
+def get_options(args, formats):
+    # The same options an upload takes, left out when not given so the defaults and cache keys match
+    if args.normalisation == AnalysisEngine.NORMALISE_CAMPAIGN and not args.campaign:
+        raise ValueError("--normalisation campaign needs --campaign")
+    if args.clip_iterations is not None and not 1 <= args.clip_iterations <= AnalysisEngine.MAX_CLIP_ITERATIONS:
+        raise ValueError(f"--clip-iterations must be between 1 and {AnalysisEngine.MAX_CLIP_ITERATIONS}")
+    if args.formats and any(file_format not in formats for file_format in args.formats):
+        raise ValueError(f"--formats must be among {', '.join(formats)}")
+
+    options = {name: getattr(args, name) for name in ('cutoff_multiplier', 'hit_threshold', 'drift_mode', 'clip_iterations', 'normalisation')
+               if getattr(args, name) is not None}
+    if args.campaign:
+        options['campaign'] = args.campaign
+    if args.formats:
+        options['formats'] = [file_format for file_format in formats if file_format in args.formats]
+
+    return options
+
+
+def print_status(ledger):
+    summary = ledger.get_summary()
+    counts = summary['counts']
+
+    print(", ".join(f"{status} {counts.get(status, 0)}" for status in (WatchLedger.STATUS_FINISHED, WatchLedger.STATUS_FAILED,
+                                                                      WatchLedger.STATUS_REJECTED, WatchLedger.STATUS_PROCESSING)))
+    for name in ('wait_seconds', 'analysis_seconds'):
+        if summary[name]['mean'] is not None:
+            print(f"{name}: mean {summary[name]['mean']:.2f}, max {summary[name]['max']:.2f}")
+
+
+def run_from_args(args):
+    ledger = WatchLedger(args.ledger)
+
+    if args.status:
+        print_status(ledger)
+        return 0
+
+    if not os.path.isdir(args.directory):
+        raise ValueError(f"Not a directory: {args.directory}")
+
+    # The web app is only imported to analyse, the jobs share its workspaces, caches and results store
+    import main as web_app
+
+    assay = get_assay(args.assay)
+    options = get_options(args, web_app.FORMATS)
+
+    watcher = FolderWatcher(args.directory, ledger, assay,
+                            analyse=lambda path: web_app.run_workbook_job(path, assay, options),
+                            validate=lambda file_name, path: web_app.validate_workbook(file_name, path, assay),
+                            settle_seconds=args.settle_seconds,
+                            recursive=args.recursive)
+
+    if args.once:
+        # Files seen for the first time settle during the wait
+        watcher.poll()
+        time.sleep(args.settle_seconds)
+        watcher.run_once()
+        print_status(ledger)
+        return 0
+
+    # Stop after the current workbook on Ctrl-C or SIGTERM
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    print(f"Watching {args.directory} for {assay.name.upper()} workbooks (\"{assay.file_keyword}\" in the name)", flush=True)
+    try:
+        watcher.run(args.interval, stop_event)
+    except KeyboardInterrupt:
+        pass
+
+    print_status(ledger)
+
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch an instrument export directory and analyse every new workbook.")
+    add_arguments(parser)
+
+    return run_from_args(parser.parse_args(argv))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,399 @@
+import io
+import os
+import posixpath
+import re
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import infer_dtype, union_categoricals
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:
+    CalamineWorkbook = None
+
+
+class WorkbookReader:
+    """
+    Read the instrument sheets of a workbook in a single open.
+
+    Rows are streamed sheet by sheet and blank or summary (mean/sd) rows are dropped
+    while reading. The Rust based python-calamine parser is used when it is installed,
+    otherwise openpyxl in read-only mode.
+
+    probe() checks the structure of an upload from the xlsx zip entries alone: the sheet
+    names from the workbook part and the header row of the requested sheets, without
+    parsing any data rows.
+    """
+
+    CELL_REFERENCE_PATTERN = re.compile(r'^([A-Z]+)')
+
+    # Rows converted to typed columns at a time, bounding the row tuples alive while reading
+    CHUNK_ROWS = 4096
+
+    # Largest relative change allowed when downcast_numeric stores a float column as float32 (about 7
+    # significant digits); the instrument reports its measurements with fewer digits than that
+    FLOAT32_RTOL = 1e-6
+
+    @staticmethod
+    def iter_sheet_rows_openpyxl(source, sheet_names):
+        # openpyxl is only imported when it is actually used, it is slow to import
+        from openpyxl import load_workbook
+
+        # Open the workbook once in read-only mode and stream the requested sheets
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        try:
+            for sheet_name in sheet_names:
+                yield sheet_name, workbook[sheet_name].iter_rows(values_only=True)
+        finally:
+            workbook.close()
+
+    @staticmethod
+    def iter_sheet_rows_calamine(source, sheet_names):
+        if isinstance(source, (str, os.PathLike)):
+            workbook = CalamineWorkbook.from_path(os.fspath(source))
+        else:
+            workbook = CalamineWorkbook.from_filelike(source)
+        for sheet_name in sheet_names:
+            sheet = workbook.get_sheet_by_name(sheet_name)
+            # calamine reports empty cells as '' where openpyxl uses None
+            rows = ([None if value == '' else value for value in row] for row in sheet.iter_rows())
+            yield sheet_name, rows
+
+    @staticmethod
+    def iter_sheet_rows(source, sheet_names):
+        """
+        Stream the rows of the given sheets, opening the workbook once.
+
+        Parameters:
+        - source (str, bytes or file-like): The path to the workbook, or its contents.
+        - sheet_names (list): The sheets to read, in order.
+
+        Returns:
+        - generator: (sheet_name, rows) pairs where rows iterates over tuples of cell values.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+
+        if CalamineWorkbook is not None:
+            return WorkbookReader.iter_sheet_rows_calamine(source, sheet_names)
+
+        return WorkbookReader.iter_sheet_rows_openpyxl(source, sheet_names)
+
+    @staticmethod
+    def get_local_name(tag):
+        # Transitional and strict workbooks use different namespaces for the same elements
+        return tag.rsplit('}', 1)[-1]
+
+    @staticmethod
+    def get_column_index(cell_reference):
+        # "A1" -> 0, "AB7" -> 27
+        index = 0
+        for letter in WorkbookReader.CELL_REFERENCE_PATTERN.match(cell_reference).group(1):
+            index = index * 26 + ord(letter) - ord('A') + 1
+
+        return index - 1
+
+    @staticmethod
+    def read_sheet_parts(archive):
+        # Sheet name -> path of its part inside the zip, in workbook order
+        targets = {}
+        with archive.open('xl/_rels/workbook.xml.rels') as rels_file:
+            for _, element in iterparse(rels_file):
+                if WorkbookReader.get_local_name(element.tag) == 'Relationship':
+                    target = element.get('Target', '')
+                    # Targets are relative to xl/ unless absolute within the package
+                    if target.startswith('/'):
+                        targets[element.get('Id')] = target.lstrip('/')
+                    else:
+                        targets[element.get('Id')] = posixpath.normpath(posixpath.join('xl', target))
+
+        sheet_parts = {}
+        with archive.open('xl/workbook.xml') as workbook_file:
+            for _, element in iterparse(workbook_file):
+                if WorkbookReader.get_local_name(element.tag) == 'sheet':
+                    relationship_id = next((value for name, value in element.attrib.items()
+                                            if WorkbookReader.get_local_name(name) == 'id'), None)
+                    sheet_parts[element.get('name')] = targets.get(relationship_id)
+
+        return sheet_parts
+
+    @staticmethod
+    def read_first_row(archive, sheet_part):
+        # Stop parsing at the end of the first row, the data rows are never read
+        cells = {}
+        with archive.open(sheet_part) as sheet_file:
+            for _, element in iterparse(sheet_file):
+                name = WorkbookReader.get_local_name(element.tag)
+                if name == 'c':
+                    cell_type = element.get('t', 'n')
+                    value = None
+                    for child in element.iter():
+                        child_name = WorkbookReader.get_local_name(child.tag)
+                        if child_name == 'v' or (child_name == 't' and cell_type == 'inlineStr'):
+                            value = (value or '') + (child.text or '')
+                    cells[WorkbookReader.get_column_index(element.get('r', 'A'))] = (cell_type, value)
+                elif name == 'row':
+                    break
+
+        if not cells:
+            return []
+
+        return [cells.get(index, ('n', None)) for index in range(max(cells) + 1)]
+
+    @staticmethod
+    def read_shared_strings(archive, count):
+        # Only the first count shared strings are needed for the header cells
+        strings = []
+        if count == 0 or 'xl/sharedStrings.xml' not in archive.namelist():
+            return strings
+
+        with archive.open('xl/sharedStrings.xml') as strings_file:
+            parts = []
+            for event, element in iterparse(strings_file, events=('start', 'end')):
+                name = WorkbookReader.get_local_name(element.tag)
+                if event == 'start' and name == 'si':
+                    parts = []
+                elif event == 'end' and name == 't':
+                    parts.append(element.text or '')
+                elif event == 'end' and name == 'si':
+                    strings.append(''.join(parts))
+                    element.clear()
+                    if len(strings) >= count:
+                        break
+
+        return strings
+
+    @staticmethod
+    def probe(source, sheet_names=None):
+        """
+        Read the sheet names and header rows of an xlsx workbook from its zip entries.
+
+        Parameters:
+        - source (str, bytes or file-like): The path to the workbook, or its contents.
+        - sheet_names (list): The sheets whose header row is read, all sheets when None.
+
+        Returns:
+        - dict: 'sheet_names', every sheet in workbook order, and 'headers', sheet name -> list of header values
+          for the requested sheets that exist.
+
+        Raises:
+        - ValueError: When the source is not an xlsx workbook.
+        """
+        if isinstance(source, (bytes, bytearray)):
+            source = io.BytesIO(source)
+
+        try:
+            with zipfile.ZipFile(source) as archive:
+                sheet_parts = WorkbookReader.read_sheet_parts(archive)
+
+                first_rows = {}
+                for sheet_name, sheet_part in sheet_parts.items():
+                    if sheet_names is None or sheet_name in sheet_names:
+                        first_rows[sheet_name] = WorkbookReader.read_first_row(archive, sheet_part)
+
+                # Shared string cells hold an index into the workbook's string table
+                string_indexes = [int(value) for row in first_rows.values() for cell_type, value in row
+                                  if cell_type == 's' and value is not None]
+                strings = WorkbookReader.read_shared_strings(archive, max(string_indexes) + 1 if string_indexes else 0)
+        except (zipfile.BadZipFile, KeyError, SyntaxError, AttributeError, ValueError, IndexError) as e:
+            raise ValueError(f"Not a valid xlsx workbook: {e}") from e
+
+        headers = {}
+        for sheet_name, row in first_rows.items():
+            header = []
+            for cell_type, value in row:
+                if value is not None and cell_type == 's':
+                    value = strings[int(value)] if int(value) < len(strings) else None
+                header.append(value)
+            headers[sheet_name] = header
+
+        return {'sheet_names': list(sheet_parts), 'headers': headers}
+
+    @staticmethod
+    def check_structure(probe, sheet_names, column_count):
+        """
+        List what keeps a probed workbook from being analysed.
+
+        Parameters:
+        - probe (dict): The result of probe().
+        - sheet_names (list): The sheets the analysis reads.
+        - column_count (int): The number of instrument columns every sheet must have.
+
+        Returns:
+        - list: Human readable problems, empty for a valid workbook.
+        """
+        problems = []
+        for sheet_name in sheet_names:
+            if sheet_name not in probe['sheet_names']:
+                problems.append(f"The workbook has no \"{sheet_name}\" sheet")
+                continue
+
+            header = probe['headers'].get(sheet_name, [])
+            named_columns = sum(1 for value in header if value not in (None, ''))
+            if named_columns < column_count:
+                problems.append(f"The \"{sheet_name}\" sheet has {named_columns} named columns, {column_count} are needed")
+
+        return problems
+
+    @staticmethod
+    def get_header(row):
+        # Name empty header cells the same way pd.read_excel does
+        return [f"Unnamed: {i}" if value is None else value for i, value in enumerate(row)]
+
+    @staticmethod
+    def is_kept_row(row, remove_row_labels):
+        # Drop empty rows
+        if all(value is None for value in row):
+            return False
+
+        # Drop summary rows such as "Mean" and "SD"
+        label = row[0]
+        return not (isinstance(label, str) and label.lower() in remove_row_labels)
+
+    @staticmethod
+    def make_frame(records, columns):
+        """
+        Convert a chunk of row tuples to typed columns, text columns becoming categorical.
+
+        Well names and sheet names repeat on every plate, so a categorical column holds one
+        small integer code per row instead of one string object per row.
+
+        Parameters:
+        - records (list): The row tuples.
+        - columns (list): The column names.
+
+        Returns:
+        - pd.DataFrame: The chunk.
+        """
+        frame = pd.DataFrame.from_records(records, columns=columns)
+
+        for name in frame.columns[frame.dtypes == object]:
+            if infer_dtype(frame[name], skipna=True) == 'string':
+                frame[name] = pd.Categorical(frame[name])
+
+        return frame
+
+    @staticmethod
+    def concat_frames(frames):
+        """
+        Stack chunks, aligning their columns by name like pd.concat and merging the categories of categorical columns.
+
+        Parameters:
+        - frames (list): The chunks, in order.
+
+        Returns:
+        - pd.DataFrame: The stacked rows with a fresh RangeIndex.
+        """
+        names = []
+        for frame in frames:
+            names.extend(name for name in frame.columns if name not in names)
+
+        # Empty chunks only contribute their column names
+        frames = [frame for frame in frames if len(frame)] or [pd.DataFrame(columns=names)]
+        if len(frames) == 1:
+            return frames[0].reindex(columns=names)
+
+        columns = {}
+        for name in names:
+            pieces = [frame[name] if name in frame.columns else None for frame in frames]
+            present = [piece for piece in pieces if piece is not None]
+
+            if all(isinstance(piece.dtype, pd.CategoricalDtype) for piece in present):
+                # Missing pieces become missing values, as pd.concat does
+                categoricals = [piece.array if piece is not None else pd.Categorical([None] * len(frame), categories=pd.Index([], dtype=object))
+                                for piece, frame in zip(pieces, frames)]
+                columns[name] = union_categoricals(categoricals)
+            else:
+                series = [piece if piece is not None else pd.Series(np.nan, index=frame.index)
+                          for piece, frame in zip(pieces, frames)]
+                columns[name] = pd.concat(series, ignore_index=True).array
+
+        return pd.DataFrame(columns, copy=False)
+
+    @staticmethod
+    def downcast_numeric(frame, float_rtol=None):
+        """
+        Store integer columns as int32 and float columns as float32 wherever the values fit.
+
+        Instrument counts fit int32 exactly. Float columns, the measurements, become float32 when
+        every value stays within float_rtol of the value read; a column with values out of the
+        float32 range or too small to keep their digits stays float64. The engine computes in
+        float64 from the float32 values, so ratios and z-scores move by about float32's rounding.
+
+        Parameters:
+        - frame (pd.DataFrame): The frame, modified in place.
+        - float_rtol (float): Largest relative change allowed per float value, defaults to FLOAT32_RTOL.
+
+        Returns:
+        - pd.DataFrame: The same frame.
+        """
+        if float_rtol is None:
+            float_rtol = WorkbookReader.FLOAT32_RTOL
+        int32 = np.iinfo(np.int32)
+
+        for name in frame.columns:
+            values = frame[name].to_numpy()
+
+            if values.dtype == np.int64 and (len(values) == 0 or (values.min() >= int32.min and values.max() <= int32.max)):
+                frame[name] = values.astype(np.int32)
+            elif values.dtype == np.float64:
+                with np.errstate(invalid='ignore', over='ignore'):
+                    compact = values.astype(np.float32)
+                    if np.allclose(compact.astype(np.float64), values, rtol=float_rtol, atol=0.0, equal_nan=True):
+                        frame[name] = compact
+
+        return frame
+
+    @staticmethod
+    def read_sheets(source, sheet_names, remove_row_labels, sheet_column=None):
+        """
+        Read and stack the given sheets, dropping empty and summary rows as they are read.
+
+        Equivalent to reading every sheet with pd.read_excel, concatenating them, dropping
+        empty rows and removing rows whose first column is one of remove_row_labels, except
+        that text columns are categorical. Rows are converted to typed columns every
+        CHUNK_ROWS rows instead of being held as tuples until the end.
+
+        Parameters:
+        - source (str, bytes or file-like): The path to the workbook, or its contents.
+        - sheet_names (list): The sheets to read, in order.
+        - remove_row_labels (list): Lowercase first-column labels of rows to drop.
+        - sheet_column (str): When given, the name of an extra last column holding the sheet every row was read from.
+
+        Returns:
+        - pd.DataFrame: The combined rows of all sheets.
+        """
+        frames = []
+        header = None
+        records = []
+
+        def get_columns():
+            return header if sheet_column is None else header + [sheet_column]
+
+        for sheet_name, rows in WorkbookReader.iter_sheet_rows(source, sheet_names):
+            label = (sheet_name,) if sheet_column is not None else ()
+            sheet_header = None
+            for row in rows:
+                if sheet_header is None:
+                    sheet_header = WorkbookReader.get_header(row)
+                    # Sheets with a different layout are aligned by column name when concatenated
+                    if header is not None and sheet_header != header:
+                        frames.append(WorkbookReader.make_frame(records, get_columns()))
+                        records = []
+                    header = sheet_header
+                    continue
+
+                row = tuple(row[:len(header)]) + (None,) * (len(header) - len(row))
+                if WorkbookReader.is_kept_row(row, remove_row_labels):
+                    records.append(row + label)
+
+                    if len(records) >= WorkbookReader.CHUNK_ROWS:
+                        frames.append(WorkbookReader.make_frame(records, get_columns()))
+                        records = []
+
+        frames.append(WorkbookReader.make_frame(records, get_columns() if header is not None else None))
+
+        return WorkbookReader.concat_frames(frames)
@@ -0,0 +1,131 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+
+# Uploads, outputs and caches live under one data directory, the app directory unless DATA_ROOT is set,
+# so files are written and served from the same place whichever directory the server is started from
+DATA_ROOT = os.path.abspath(os.environ.get('DATA_ROOT', os.path.dirname(os.path.abspath(__file__))))
+
+
+class JobWorkspace:
+    """
+    Job-scoped input and output directories.
+
+    Each job reads its upload from uploads/<job_id>/ and publishes its outputs to
+    downloads/<job_id>/ under DATA_ROOT, so concurrent jobs never share a file. Outputs are written to a
+    temporary file next to their final name and renamed into place, so readers only ever
+    see complete files. A job.json manifest next to the outputs records the job status
+    so any worker process can answer status requests.
+    """
+
+    MANIFEST_NAME = 'job.json'
+
+    JOB_ID_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+    UPLOADS_ROOT = os.path.join(DATA_ROOT, 'uploads')
+    DOWNLOADS_ROOT = os.path.join(DATA_ROOT, 'downloads')
+
+    def __init__(self, job_id, uploads_root=None, downloads_root=None):
+        if not self.JOB_ID_PATTERN.match(job_id):
+            raise ValueError(f"Invalid job id: {job_id!r}")
+
+        self.job_id = job_id
+        self.input_dir = os.path.join(uploads_root or self.UPLOADS_ROOT, job_id)
+        self.output_dir = os.path.join(downloads_root or self.DOWNLOADS_ROOT, job_id)
+
+    def create(self):
+        os.makedirs(self.input_dir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        return self
+
+    def input_path(self, filename):
+        return os.path.join(self.input_dir, os.path.basename(filename))
+
+    def output_path(self, filename):
+        return os.path.join(self.output_dir, os.path.basename(filename))
+
+    def publish(self, filename, write_function):
+        """
+        Atomically publish an output file.
+
+        Parameters:
+        - filename (str): The name of the output inside the job's output directory.
+        - write_function (callable): Called with a temporary path to write the file to.
+
+        Returns:
+        - str: The path of the published file.
+        """
+        temp_path = self.new_temp_path(filename)
+
+        try:
+            write_function(temp_path)
+        except BaseException:
+            self.discard(temp_path)
+            raise
+
+        return self.commit(filename, temp_path)
+
+    def new_temp_path(self, filename):
+        # A hidden temporary file next to the output, published by commit or removed by discard
+        file_descriptor, temp_path = tempfile.mkstemp(prefix='.', suffix=os.path.splitext(filename)[1], dir=self.output_dir)
+        os.close(file_descriptor)
+
+        return temp_path
+
+    def commit(self, filename, temp_path):
+        final_path = self.output_path(filename)
+        os.replace(temp_path, final_path)
+
+        return final_path
+
+    @staticmethod
+    def discard(temp_path):
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+    def write_manifest(self, manifest):
+        def write_json(temp_path):
+            with open(temp_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file)
+
+        return self.publish(self.MANIFEST_NAME, write_json)
+
+    def read_manifest(self):
+        try:
+            with open(self.output_path(self.MANIFEST_NAME)) as manifest_file:
+                return json.load(manifest_file)
+        except FileNotFoundError:
+            return None
+
+    def cleanup_inputs(self):
+        # Only this job's upload directory is removed
+        shutil.rmtree(self.input_dir, ignore_errors=True)
+
+    @staticmethod
+    def remove_expired(downloads_root, max_age_seconds):
+        """
+        Remove job output directories older than max_age_seconds.
+
+        Parameters:
+        - downloads_root (str): The directory holding the job output directories.
+        - max_age_seconds (float): Retention period of job outputs.
+
+        Returns:
+        - int: The number of directories removed.
+        """
+        if not os.path.isdir(downloads_root):
+            return 0
+
+        removed = 0
+        expiry = time.time() - max_age_seconds
+
+        for name in os.listdir(downloads_root):
+            path = os.path.join(downloads_root, name)
+            if JobWorkspace.JOB_ID_PATTERN.match(name) and os.path.isdir(path) and os.path.getmtime(path) < expiry:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+
+        return removed